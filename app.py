@@ -1,102 +1,290 @@
+import json
 import os
-import shutil
 import signal
-import sqlite3
 import sys
-from typing import Optional
+import threading
+import time
+from typing import Dict, List, Optional, Set
 
 from flask import Flask
 
+import database
 import job_manager
+import key_pool
+import metrics
+import retention
+import storage
 from job_manager import JobStatus
 from queue_executor import QueueExecutor
 from routes import route_app
 
+
+def _parse_mapping(value: str) -> Dict[str, int]:
+    """ Parses a comma separated list of name:number """
+    return {lane.strip(): int(number) for lane, number in (
+        item.split(":") for item in value.split(",") if item.strip())}
+
+
 # Static variables
 JOBS_FOLDER_PATH = os.getenv("CSR_JOBS", os.getcwd() + "/jobs/")
 SQLITE_DB_PATH = os.path.join(os.getenv("CSR_DB", os.getcwd()), "sqlite.db")
+# Where the files of the jobs (config, key and CSR) are stored: "flat" (a folder per job in JOBS_FOLDER_PATH),
+# "sharded" (the folders of the jobs spread over sub-folders of JOBS_FOLDER_PATH, for large stores), "sqlite" (in the
+# database, next to the jobs) or "object" (in the object store at OBJECT_STORE_URL: s3://bucket/prefix, which requires
+# boto3, or file:///path for a local stand-in). Use migrate_storage.py to move the existing jobs to another backend.
+STORAGE_BACKEND = os.getenv("CSR_STORAGE", "flat")
+OBJECT_STORE_URL = os.getenv("CSR_OBJECT_STORE", "file://" + os.path.join(os.getenv("CSR_DB", os.getcwd()), "objects"))
+# Backend used to generate the keys and CSRs, either "cryptography" (in-process) or "openssl"
+GENERATION_BACKEND = os.getenv("CSR_BACKEND", "cryptography")
+# Number of worker processes generating jobs in parallel, defaults to the number of cores
+WORKER_COUNT = int(os.getenv("CSR_WORKERS", os.cpu_count() or 1))
+# Time (seconds) after which the generation of a job is stopped and the job marked as an error
+GENERATION_TIMEOUT = float(os.getenv("CSR_GENERATION_TIMEOUT", 60))
+# Pre-generated RSA keys, refilled up to the high watermark once a size drops below the low watermark
+KEY_POOL_PATH = os.getenv("CSR_KEY_POOL", os.path.join(os.getenv("CSR_DB", os.getcwd()), "key_pool"))
+KEY_POOL_LOW = int(os.getenv("CSR_KEY_POOL_LOW", 2))
+KEY_POOL_HIGH = int(os.getenv("CSR_KEY_POOL_HIGH", 10))
+# Socket used to wake up the queue executor when a job is queued, the queue is also checked every interval (seconds)
+QUEUE_SOCKET_PATH = os.path.join(os.getenv("CSR_DB", os.getcwd()), "queue.sock")
+QUEUE_POLL_INTERVAL = float(os.getenv("CSR_QUEUE_POLL_INTERVAL", 30))
+# Time (seconds) after which a job claimed by an executor that stopped renewing its lease can be claimed again, and
+# number of claims after which a job that never completed is marked as an error
+QUEUE_LEASE_DURATION = float(os.getenv("CSR_QUEUE_LEASE_DURATION", 300))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("CSR_QUEUE_MAX_ATTEMPTS", 3))
+# Order in which queued jobs are generated, "fair" or "fifo" (see QueueExecutor), and maximum number of workers used
+# by the jobs of a lane (RSA key size, or algorithm of the other keys) as a comma separated list of lane:workers.
+# By default 4096 bits jobs can only use half of the workers, so that other jobs are still generated quickly during a
+# bulk run of 4096 bits jobs.
+QUEUE_POLICY = os.getenv("CSR_QUEUE_POLICY", "fair")
+QUEUE_LANE_LIMITS = _parse_mapping(os.getenv("CSR_QUEUE_LANE_LIMITS", "4096:{}".format(max(1, WORKER_COUNT // 2))))
+# Admission control: maximum number of jobs in the queue, overall (0 for no limit) and by lane as a comma separated
+# list of lane:jobs, past which generation requests are refused with a 429. The time clients are asked to wait, and
+# the completion times shown for queued jobs, are estimated from the jobs generated during the last window (seconds).
+QUEUE_MAX_DEPTH = int(os.getenv("CSR_QUEUE_MAX_DEPTH", 10000))
+QUEUE_MAX_LANE_DEPTH = _parse_mapping(os.getenv("CSR_QUEUE_MAX_LANE_DEPTH", ""))
+QUEUE_RATE_WINDOW = float(os.getenv("CSR_QUEUE_RATE_WINDOW", 300))
+# SQLite tuning: journal mode (WAL lets reads proceed during writes), time (ms) to wait for a lock, and number of idle
+# connections kept open by each process
+SQLITE_JOURNAL_MODE = os.getenv("CSR_DB_JOURNAL_MODE", "WAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("CSR_DB_BUSY_TIMEOUT", 5000))
+SQLITE_POOL_SIZE = int(os.getenv("CSR_DB_POOL_SIZE", 8))
+# Number of jobs (and their files) cached in memory by each process
+JOB_CACHE_SIZE = int(os.getenv("CSR_JOB_CACHE_SIZE", 1024))
+# Interval (seconds) at which each process checks for status changes of the jobs clients are waiting on
+EVENTS_POLL_INTERVAL = float(os.getenv("CSR_EVENTS_POLL_INTERVAL", 0.2))
+# Under gevent, number of threads of each worker running the database and file operations of the requests, so that
+# a slow disk or a locked database only holds up the requests waiting on it (see io_pool). 0 runs them in the greenlets.
+IO_THREADS = int(os.getenv("CSR_IO_THREADS", 10))
+# Interval (seconds) at which each process adds the metrics it recorded to the totals served by /metrics
+METRICS_FLUSH_INTERVAL = float(os.getenv("CSR_METRICS_FLUSH_INTERVAL", 5))
+# Opt-in instrumentation, set CSR_PROFILING to 1 to enable it: Server-Timing header splitting the time of each request
+# into database, file and template rendering time, timings of the stages of the queue executor (claim, generate and
+# persist) in /metrics, and /admin/profile, which samples the stacks of a process every PROFILER_INTERVAL seconds.
+# Profiles of the queue executor are written to PROFILES_PATH before being returned.
+PROFILING = os.getenv("CSR_PROFILING", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("CSR_PROFILER_INTERVAL", 0.005))
+PROFILES_PATH = os.path.join(os.getenv("CSR_DB", os.getcwd()), "profiles")
+# Profiles reveal the code of the app (function names and file paths) and each one keeps a process busy sampling, so
+# /admin/profile only answers requests from this machine, or requests whose X-Admin-Token header is this token if it is
+# set. Behind a reverse proxy on the same machine every request looks local: set a token and block /admin/ there.
+PROFILING_TOKEN = os.getenv("CSR_PROFILING_TOKEN")
+# Retention: number of days after which the jobs with a status are deleted, counted from their last change, as a comma
+# separated list of status:days, i.e. "error:7,generated:90". Jobs are kept forever by default, queued jobs never
+# expire. Jobs that existed before their timestamps were recorded are counted from the upgrade.
+RETENTION_DAYS = [(JobStatus[status.upper()], days)
+                  for status, days in _parse_mapping(os.getenv("CSR_RETENTION", "")).items()]
+# Interval (seconds) between the runs of the reaper deleting the expired jobs, jobs deleted per transaction, pause
+# (seconds) between transactions so that live traffic isn't held up, and pages given back to the file system at once.
+# Databases created before incremental auto vacuum was enabled keep their size (freed pages are reused) until
+# "PRAGMA auto_vacuum=INCREMENTAL; VACUUM;" is run on them while the app is stopped.
+RETENTION_INTERVAL = float(os.getenv("CSR_RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(os.getenv("CSR_RETENTION_BATCH_SIZE", 100))
+RETENTION_BATCH_PAUSE = 0.1
+RETENTION_VACUUM_PAGES = 1000
+
+# Startup cleanup: progress of an interrupted cleanup, report of the last cleanup, and jobs deleted per transaction
+CLEANUP_CHECKPOINT_PATH = os.path.join(os.getenv("CSR_DB", os.getcwd()), "cleanup_checkpoint.json")
+CLEANUP_REPORT_PATH = os.path.join(os.getenv("CSR_DB", os.getcwd()), "cleanup_report.json")
+CLEANUP_BATCH_SIZE = 500
 
 # Set to none for scope, will get set in #startup_tasks
 queue_thread: Optional[QueueExecutor] = None
+# Set to stop the cleanup running in the background
+cleanup_stop_flag = threading.Event()
+# Set in #startup_tasks if a retention is configured
+reaper_thread: Optional[retention.Reaper] = None
+
+
+def _read_cleanup_checkpoint() -> Optional[str]:
+    """ Returns the id of the last job checked by an interrupted cleanup, None if the last cleanup completed """
+    try:
+        with open(CLEANUP_CHECKPOINT_PATH, "r") as f:
+            return json.load(f)["last_job_id"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def _write_cleanup_checkpoint(last_job_id: Optional[str]):
+    if last_job_id is None:
+        try:
+            os.remove(CLEANUP_CHECKPOINT_PATH)
+        except FileNotFoundError:
+            pass
+        return
+
+    tmp_path = CLEANUP_CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_job_id": last_job_id}, f)
+    os.replace(tmp_path, CLEANUP_CHECKPOINT_PATH)
+
+
+def _missing_files(status: JobStatus, names: Set[str]) -> bool:
+    """ Returns whether a job is missing one of the files it should have, given the names of the files it has """
+    required = ["conf"]
+    if status == JobStatus.GENERATED:
+        required += ["key", "csr"]
+    return any(name not in names for name in required)
+
+
+def _delete_invalid_jobs(job_ids: List[str]) -> List[str]:
+    """ Deletes a batch of jobs missing files in a single transaction. Each job is checked again inside the
+        transaction, since jobs may have been generated or created while the cleanup was running.
+        Returns the ids of the deleted jobs. """
+    deleted = []
+    with database.connection() as conn:
+        db = conn.cursor()
+        for job_id in job_ids:
+            db.execute("SELECT status FROM jobs WHERE id=?", (job_id,))
+            row = db.fetchone()
+            if row is None:
+                continue
+            if _missing_files(JobStatus(row[0]), storage.get_storage().list_names(job_id)):
+                deleted.append(job_id)
+        db.executemany("DELETE FROM jobs WHERE id=?", [(job_id,) for job_id in deleted])
+        conn.commit()
 
+    for job_id in deleted:
+        job_manager.get_cache().invalidate(job_id)
+        storage.get_storage().delete_job(job_id)  # Remove the files left, if any
+        print("Job {} removed from database due to missing files.".format(job_id))
+    return deleted
 
-def cleanup():
-    """ Cleanup the database and jobs folder by removing invalid jobs
+
+def cleanup(stop_flag: Optional[threading.Event] = None) -> Dict[str, object]:
+    """ Cleanup the database and the job storage by removing invalid jobs
         If a job is in the database but some/all of its files are missing, remove from DB and delete files, if any
-        If a job is in the jobs folder but not in the DB, don't delete the folder but log that we found a bad folder
+        If a job is in the storage but not in the DB, don't delete its files but log that we found a bad job
+
+        The storage is listed once and compared with a single query, invalid jobs are deleted in batches.
+        If stop_flag is set, the cleanup stops after the current batch and saves how far it got, the next cleanup
+        resumes from there. A report of what was found is returned, and saved to CLEANUP_REPORT_PATH.
         """
 
     print("Running cleanup operations.")
-    with sqlite3.connect(SQLITE_DB_PATH) as conn:
+    start = time.monotonic()
+    resume_after = _read_cleanup_checkpoint()
+    report: Dict[str, object] = {"started_at": time.time(), "resumed_after": resume_after, "completed": False,
+                                 "folders_scanned": 0, "jobs_checked": 0, "empty_folders_removed": 0,
+                                 "orphan_folders": 0, "invalid_jobs_removed": 0}
+
+    # Read the jobs before scanning the folders, so that every job read has had time to create its folder
+    with database.connection() as conn:
         db = conn.cursor()
-        # folder names to DB - No deletion
-        folder_names = os.listdir(JOBS_FOLDER_PATH)
-        for job_id in folder_names:
-            # If folder is empty, delete it (since no data will be lost)
-            folder_path = os.path.join(JOBS_FOLDER_PATH, job_id)
-            if len(os.listdir(folder_path)) == 0:
-                os.rmdir(folder_path)
-                print("An empty folder named {} was found in the jobs folder and was deleted.".format(job_id))
-                continue
+        if resume_after is None:
+            db.execute("SELECT id, status FROM jobs ORDER BY id")
+        else:
+            db.execute("SELECT id, status FROM jobs WHERE id > ? ORDER BY id", (resume_after,))
+        jobs = db.fetchall()
+
+    # Job id -> names of its files, and time its folder was last modified (None for backends without folders)
+    stored: Dict[str, Set[str]] = {}
+    modified: Dict[str, Optional[float]] = {}
+    for job_id, names, modified_at in storage.get_storage().list_jobs():
+        stored[job_id] = names
+        modified[job_id] = modified_at
+    report["folders_scanned"] = len(stored)
 
-            db.execute("SELECT 1 FROM jobs WHERE id=?", (job_id,))
-            rows = db.fetchall()
-            if len(rows) == 0:
-                # No jobs found in db with that id
-                print("A folder named {} was found in the jobs folder, but no job with that id could be found in the "
-                      "database.".format(job_id))
-
-        # DB to folder - delete if missing file(s)
-        db.execute("SELECT id,status FROM jobs")
-        job_ids = db.fetchall()
-        for job_id, status in job_ids:
-            status = JobStatus(status)
-            valid = True
-
-            folder_path = os.path.join(JOBS_FOLDER_PATH, job_id)
-            if not os.path.isdir(folder_path):
-                valid = False
-
-            conf_path = os.path.join(folder_path, "{}.conf".format(job_id))
-            if not os.path.isfile(conf_path):
-                valid = False
-
-            if status == JobStatus.GENERATED:
-                key_path = os.path.join(folder_path, "{}.key".format(job_id))
-                if not os.path.isfile(key_path):
-                    valid = False
-
-                csr_path = os.path.join(folder_path, "{}.csr".format(job_id))
-                if not os.path.isfile(csr_path):
-                    valid = False
-
-            if not valid:
-                # Missing at least one file, delete from DB and remove folder if present
-                db.execute("DELETE FROM jobs WHERE id=?", (job_id,))
-                conn.commit()
-                shutil.rmtree(folder_path, ignore_errors=True)  # Remove folder and sub-files
-                print("Job {} removed from database due to missing files.".format(job_id))
-    print("Completed cleanup operations.")
+    # folder names to DB - No deletion
+    if resume_after is None:
+        all_job_ids = {job_id for job_id, _ in jobs}
+    else:
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("SELECT id FROM jobs")
+            all_job_ids = {row[0] for row in db.fetchall()}
+    for job_id in set(stored) - all_job_ids:
+        # If folder is empty, delete it (since no data will be lost). Recent folders are skipped, they may belong to
+        # a job being created.
+        if not stored[job_id] and modified[job_id] is not None and modified[job_id] < time.time() - 60:
+            storage.get_storage().delete_job(job_id)
+            report["empty_folders_removed"] += 1
+            print("An empty folder named {} was found in the jobs folder and was deleted.".format(job_id))
+            continue
+        report["orphan_folders"] += 1
+        print("Files of a job named {} were found in the job storage, but no job with that id could be found in the "
+              "database.".format(job_id))
+
+    # DB to folder - delete if missing file(s)
+    invalid: List[str] = []
+    for i, (job_id, status) in enumerate(jobs):
+        if stop_flag is not None and stop_flag.is_set():
+            break
+
+        if _missing_files(JobStatus(status), stored.get(job_id, set())):
+            invalid.append(job_id)
+        report["jobs_checked"] += 1
+
+        if len(invalid) >= CLEANUP_BATCH_SIZE or (i + 1) % (CLEANUP_BATCH_SIZE * 10) == 0:
+            report["invalid_jobs_removed"] += len(_delete_invalid_jobs(invalid))
+            invalid = []
+            _write_cleanup_checkpoint(job_id)
+    else:
+        report["completed"] = True
+
+    if invalid:
+        report["invalid_jobs_removed"] += len(_delete_invalid_jobs(invalid))
+    if report["completed"]:
+        _write_cleanup_checkpoint(None)
+    elif report["jobs_checked"] > 0:
+        _write_cleanup_checkpoint(jobs[report["jobs_checked"] - 1][0])
+
+    report["duration"] = round(time.monotonic() - start, 3)
+    with open(CLEANUP_REPORT_PATH, "w") as f:
+        json.dump(report, f)
+    print("Completed cleanup operations: {}".format(report))
+    return report
 
 
 def stop_app(_, __):
     print("Stopping the app...")
+    cleanup_stop_flag.set()
     if queue_thread:  # Check if queue_thread exists, sigint could be received before thread is created
         queue_thread.stop()
+    if reaper_thread:
+        reaper_thread.stop()
     sys.exit(0)
 
 
 def startup_tasks():
     # Create the database if it doesn't exist
     job_manager.initialize_db()
+    storage.get_storage().initialize()
+    key_pool.initialize_pool()
+    metrics.initialize_metrics()
 
     # Start the queue executor thread
     global queue_thread
     queue_thread = QueueExecutor()
     queue_thread.start()
 
-    # Run the cleanup ops
-    cleanup()
+    # Run the cleanup ops in the background so that the app can serve requests right away
+    threading.Thread(target=cleanup, args=(cleanup_stop_flag,), daemon=True).start()
+
+    # Delete the expired jobs in the background
+    if RETENTION_DAYS:
+        global reaper_thread
+        reaper_thread = retention.Reaper()
+        reaper_thread.start()
 
 
 def create_app():
@@ -0,0 +1,47 @@
+""" Compares the number of jobs per second generated by each generation backend.
+
+Usage: python benchmarks/bench_backends.py [--jobs N] [--key-size 2048|4096]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csr_engine  # noqa: E402
+
+CONFIG = """\
+distinguished_name = req_distinguished_name
+req_extensions = req_ext
+prompt=no
+[req_distinguished_name]
+C = US
+ST = Texas
+L = Dallas
+O = Example
+CN = www.example.com
+[req_ext]
+subjectAltName = @alt_names
+[alt_names]
+DNS.1 = www.example.com
+DNS.2 = example.com"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--key-size", type=int, default=2048, choices=[2048, 4096])
+    args = parser.parse_args()
+
+    for backend in csr_engine.BACKENDS:
+        start = time.perf_counter()
+        for _ in range(args.jobs):
+            csr_engine.generate(CONFIG, args.key_size, backend)
+        elapsed = time.perf_counter() - start
+        print("{:<14} {:>8.2f} jobs/sec  ({} jobs in {:.2f}s)".format(backend, args.jobs / elapsed, args.jobs,
+                                                                      elapsed))
+
+
+if __name__ == '__main__':
+    main()
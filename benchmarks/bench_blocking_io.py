@@ -0,0 +1,110 @@
+""" Checks that under gevent, the requests of a worker keep being served while one of them waits on a locked database.
+
+Another process, standing in for the queue executor, holds the write lock of the database for a few seconds. In the
+meantime, one greenlet saves the config of a job, which waits for the lock, while others keep polling the status of
+jobs. With the I/O pool, the status requests keep completing during the lock. Run it again with CSR_IO_THREADS=0 to
+see every request of the worker stall until the lock is released.
+
+Meant to be used as a regression check: the exit status is 1 if the status requests stalled (none or too few of them
+completed while the database was locked) or if the config couldn't be saved once the lock was released, 0 otherwise.
+
+Requires gevent. Usage: python benchmarks/bench_blocking_io.py [--lock-duration SECONDS] [--readers N]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+
+from common import percentile, setup_environment  # noqa: E402
+
+setup_environment()
+
+import app  # noqa: E402
+import job_manager  # noqa: E402
+import metrics  # noqa: E402
+import storage  # noqa: E402
+from queue_executor import QueueExecutor  # noqa: E402
+
+# Holds a write transaction open like the executor claiming a job, until its stdin is closed
+LOCK_HOLDER = """
+import sqlite3, sys
+conn = sqlite3.connect(sys.argv[1], isolation_level=None)
+conn.execute("BEGIN IMMEDIATE")
+print("locked", flush=True)
+sys.stdin.read()
+conn.execute("COMMIT")
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lock-duration", type=float, default=3)
+    parser.add_argument("--readers", type=int, default=20)
+    args = parser.parse_args()
+    if args.lock_duration * 1000 >= app.SQLITE_BUSY_TIMEOUT:
+        parser.error("The lock duration must be shorter than the busy timeout ({} ms)".format(app.SQLITE_BUSY_TIMEOUT))
+
+    job_manager.initialize_db()
+    storage.get_storage().initialize()
+    metrics.initialize_metrics()
+    QueueExecutor()  # Creates the queue table, the executor itself isn't started
+    job_ids = job_manager.create_jobs([("prompt=no", 2048, "rsa")] * args.readers, False)
+    client = app.create_app().test_client()
+
+    holder = subprocess.Popen([sys.executable, "-c", LOCK_HOLDER, app.SQLITE_DB_PATH], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, text=True)
+    holder.stdout.readline()
+    lock_start = time.perf_counter()
+    gevent.spawn_later(args.lock_duration, holder.stdin.close)
+
+    latencies = []
+
+    def reader(job_id: str):
+        while time.perf_counter() - lock_start < args.lock_duration:
+            start = time.perf_counter()
+            client.get("/job/{}/status".format(job_id))
+            latencies.append(time.perf_counter() - start)
+            gevent.sleep(0.01)
+
+    def writer():
+        start = time.perf_counter()
+        response = client.post("/job/{}".format(job_ids[0]), data={"confFile": "prompt=yes"})
+        return time.perf_counter() - start, response.status_code
+
+    writer_greenlet = gevent.spawn(writer)
+    gevent.sleep(0.1)  # Let the writer start waiting for the lock
+    gevent.joinall([gevent.spawn(reader, job_id) for job_id in job_ids])
+    writer_greenlet.join()
+    holder.wait()
+
+    expected = args.readers * args.lock_duration / 0.01
+    writer_duration, writer_status = writer_greenlet.value
+    print("I/O threads: {}".format(app.IO_THREADS))
+    print("config saved after {:.2f}s with status {} (database locked for {:g}s)".format(
+        writer_duration, writer_status, args.lock_duration))
+    print("status requests completed while the database was locked: {} (~{:.0f} without contention)"
+          .format(len(latencies), expected))
+    if latencies:
+        print("status latency: p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    failed = False
+    if not latencies:
+        print("No status request completed while the database was locked.")
+        failed = True
+    elif len(latencies) < expected / 10:
+        print("The requests stalled while the database was locked.")
+        failed = True
+    if writer_status >= 400:
+        print("The config couldn't be saved once the database was unlocked.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
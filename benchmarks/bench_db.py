@@ -0,0 +1,70 @@
+""" Measures the latency of job lookups while another thread keeps updating job statuses, like the executor does.
+
+Run it once with the default settings and once with CSR_DB_JOURNAL_MODE=DELETE to compare with the rollback journal.
+
+Usage: python benchmarks/bench_db.py [--jobs N] [--readers N] [--duration SECONDS]
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+
+from common import percentile, setup_environment
+
+setup_environment()
+
+import app  # noqa: E402
+import job_manager  # noqa: E402
+import metrics  # noqa: E402
+import storage  # noqa: E402
+from job_manager import JobStatus  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    job_manager.initialize_db()
+    storage.get_storage().initialize()
+    metrics.initialize_metrics()
+    job_ids = job_manager.create_jobs([("prompt=no", 2048, "rsa")] * args.jobs, False)
+
+    stop = threading.Event()
+    read_latencies = []
+    write_latencies = []
+
+    def reader():
+        latencies = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            job_manager.get_job(random.choice(job_ids))
+            latencies.append(time.perf_counter() - start)
+        read_latencies.extend(latencies)
+
+    def writer():
+        while not stop.is_set():
+            start = time.perf_counter()
+            job_manager.set_job_result(random.choice(job_ids), JobStatus.GENERATED, None)
+            write_latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print("journal mode: {}".format(app.SQLITE_JOURNAL_MODE))
+    for name, latencies in [("reads", read_latencies), ("writes", write_latencies)]:
+        print("{:<7} {:>8} ops  {:>9.1f} ops/sec  p50 {:.3f} ms  p99 {:.3f} ms".format(
+            name, len(latencies), len(latencies) / args.duration, statistics.median(latencies) * 1000,
+            percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
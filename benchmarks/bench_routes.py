@@ -0,0 +1,242 @@
+""" Load and throughput benchmark of the web routes and of the generation queue. Runs offline.
+
+For each job store size, the store is seeded with that many jobs, then a mix of requests (create, generate, poll,
+fetch, list) is sent to the app while the queue executor generates the queued jobs. The latency percentiles of each
+kind of request are measured. Then the generation throughput (jobs/sec) is measured for each RSA key size, and for
+elliptic curve keys.
+
+The requests go through Flask's test client by default. Use --url to send them over HTTP to a running server instead
+(i.e. gunicorn with the gevent workers), in which case the server must use the same CSR_DB and CSR_JOBS.
+
+The results are written as JSON so that runs can be compared over time.
+
+Usage: python benchmarks/bench_routes.py [--sizes 1000,10000,100000] [--requests N] [--generate-jobs N]
+                                         [--url http://localhost:5000] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from common import ROOT, percentile, setup_environment
+
+setup_environment()
+
+import app  # noqa: E402
+import csr_engine  # noqa: E402
+import database  # noqa: E402
+import job_manager  # noqa: E402
+import metrics  # noqa: E402
+import key_pool  # noqa: E402
+import storage  # noqa: E402
+from job_manager import JobStatus  # noqa: E402
+from queue_executor import QueueExecutor  # noqa: E402
+
+CONFIG = """\
+distinguished_name = req_distinguished_name
+req_extensions = req_ext
+prompt=no
+[req_distinguished_name]
+C = US
+ST = Texas
+L = Dallas
+O = Example
+CN = www.example.com
+[req_ext]
+subjectAltName = @alt_names
+[alt_names]
+DNS.1 = www.example.com"""
+FORM = {"rsa_key_size": "2048", "country": "US", "state": "Texas", "city": "Dallas", "organization": "Example",
+        "fqdn": "www.example.com", "san": "example.com"}
+
+# Share of each kind of request in the mix
+MIX = [("create", 0.2), ("generate", 0.1), ("poll", 0.3), ("fetch", 0.2), ("list", 0.2)]
+
+
+class TestClient:
+    """ Sends the requests through Flask's test client """
+
+    def __init__(self):
+        self._client = app.create_app().test_client()
+
+    def get(self, path: str) -> int:
+        response = self._client.get(path)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    def post(self, path: str, data: dict) -> int:
+        return self._client.post(path, data=data).status_code
+
+
+class HttpClient:
+    """ Sends the requests to a running server """
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, url: str):
+        self._url = url.rstrip("/")
+        self._opener = urllib.request.build_opener(self._NoRedirect)
+
+    def _send(self, request: urllib.request.Request) -> int:
+        try:
+            with self._opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get(self, path: str) -> int:
+        return self._send(urllib.request.Request(self._url + path))
+
+    def post(self, path: str, data: dict) -> int:
+        return self._send(urllib.request.Request(self._url + path, data=urllib.parse.urlencode(data).encode()))
+
+
+def seed(size: int, key_pem: bytes, csr_pem: bytes):
+    """ Fills the job store with generated jobs until it contains size jobs """
+    with database.connection() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    for start in range(existing, size, 1000):
+        count = min(1000, size - start)
+        job_ids = job_manager.create_jobs([(CONFIG, 2048, "rsa")] * count, False)
+        # Reuse the same key and CSR, only the routes are measured here
+        for job_id in job_ids:
+            job_manager.write_job_files(job_id, key_pem, csr_pem)
+        with database.connection() as conn:
+            conn.executemany("UPDATE jobs SET status=? WHERE id=?",
+                             [(JobStatus.GENERATED.value, job_id) for job_id in job_ids])
+
+
+def run_mix(client, requests: int, generated_ids: list):
+    """ Sends a random mix of requests, returns the latencies by kind of request """
+    latencies = {name: [] for name, _ in MIX}
+    errors = {name: 0 for name, _ in MIX}
+    created_ids = []
+    names = [name for name, _ in MIX]
+    weights = [weight for _, weight in MIX]
+
+    for _ in range(requests):
+        name = random.choices(names, weights)[0]
+        start = time.perf_counter()
+        if name == "create":
+            status = client.post("/form", FORM)
+            # The id of the job isn't known from the redirect with every client, read the latest one from the DB
+            with database.connection() as conn:
+                row = conn.execute("SELECT id FROM jobs WHERE status=? ORDER BY rowid DESC LIMIT 1",
+                                   (JobStatus.CREATED.value,)).fetchone()
+            if row:
+                created_ids.append(row[0])
+        elif name == "generate":
+            if not created_ids:
+                continue
+            status = client.post("/job/{}/generate".format(created_ids.pop()), {})
+        elif name == "poll":
+            status = client.get("/job/{}/status".format(random.choice(generated_ids)))
+        elif name == "fetch":
+            status = client.get("/job/{}/bundle".format(random.choice(generated_ids)))
+        else:
+            status = client.get("/jobs?after={}".format(random.choice(generated_ids)))
+        latencies[name].append(time.perf_counter() - start)
+        if status >= 400:
+            errors[name] += 1
+
+    return {name: {"count": len(values), "errors": errors[name],
+                   "p50_ms": round(statistics.median(values) * 1000, 3) if values else None,
+                   "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None}
+            for name, values in latencies.items()}
+
+
+def measure_generation(key_algorithm: str, key_size: int, jobs: int) -> dict:
+    """ Queues jobs and measures how fast the executor generates them """
+    job_ids = job_manager.create_jobs([(CONFIG, key_size, key_algorithm)] * jobs, True)
+    start = time.perf_counter()
+    remaining = set(job_ids)
+    while remaining:
+        time.sleep(0.05)
+        with database.connection() as conn:
+            done = {row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND id IN ({})".format(",".join("?" * len(remaining))),
+                [JobStatus.GENERATED.value, JobStatus.ERROR.value] + list(remaining))}
+        remaining -= done
+    elapsed = time.perf_counter() - start
+    return {"jobs": jobs, "seconds": round(elapsed, 3), "jobs_per_sec": round(jobs / elapsed, 3)}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated job store sizes")
+    parser.add_argument("--requests", type=int, default=500, help="Requests sent per store size")
+    parser.add_argument("--generate-jobs", type=int, default=20, help="Jobs generated per key size")
+    parser.add_argument("--url", help="URL of a running server, uses Flask's test client if not specified")
+    parser.add_argument("--output", help="File to write the JSON results to, printed if not specified")
+    args = parser.parse_args()
+
+    job_manager.initialize_db()
+    storage.get_storage().initialize()
+    metrics.initialize_metrics()
+    key_pool.initialize_pool()
+    key_pem, csr_pem = csr_engine.generate(CONFIG, 2048)
+
+    executor = QueueExecutor()
+    executor.start()
+    client = HttpClient(args.url) if args.url else TestClient()
+
+    results = {
+        "timestamp": time.time(),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {"backend": app.GENERATION_BACKEND, "workers": app.WORKER_COUNT,
+                     "key_pool_low": app.KEY_POOL_LOW, "key_pool_high": app.KEY_POOL_HIGH,
+                     "client": "http" if args.url else "test_client"},
+        "routes": {},
+        "generation": {},
+    }
+
+    try:
+        for size in sorted(int(size) for size in args.sizes.split(",")):
+            print("Seeding {} jobs...".format(size), file=sys.stderr)
+            seed(size, key_pem, csr_pem)
+            with database.connection() as conn:
+                generated_ids = [row[0] for row in conn.execute(
+                    "SELECT id FROM jobs WHERE status=? ORDER BY RANDOM() LIMIT 1000", (JobStatus.GENERATED.value,))]
+            print("Sending {} requests...".format(args.requests), file=sys.stderr)
+            results["routes"][str(size)] = run_mix(client, args.requests, generated_ids)
+
+        for key_algorithm, key_size in [("rsa", 2048), ("rsa", 4096), ("p256", 256), ("ed25519", 256)]:
+            name = str(key_size) if key_algorithm == "rsa" else key_algorithm
+            print("Generating {} jobs with {} keys...".format(args.generate_jobs, name), file=sys.stderr)
+            results["generation"][name] = measure_generation(key_algorithm, key_size, args.generate_jobs)
+    finally:
+        executor.stop()
+        executor.join()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
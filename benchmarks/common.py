@@ -0,0 +1,21 @@
+""" Helpers shared by the benchmarks """
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_environment():
+    """ Makes the app importable and points it to a temporary database and jobs folder, unless CSR_DB / CSR_JOBS are
+        already set. Must be called before importing any module of the app. """
+    sys.path.insert(0, ROOT)
+    tmp_dir = tempfile.mkdtemp(prefix="csrgen-bench-")
+    os.environ.setdefault("CSR_DB", tmp_dir)
+    os.environ.setdefault("CSR_JOBS", os.path.join(tmp_dir, "jobs") + os.sep)
+    os.makedirs(os.environ["CSR_JOBS"], exist_ok=True)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
@@ -0,0 +1,323 @@
+import ipaddress
+import os
+import signal
+import subprocess
+import tempfile
+from typing import List, Optional, Tuple
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.x509.oid import NameOID
+
+import openssl_config
+from openssl_config import InvalidConfigError, UnsupportedConfigError
+
+BACKEND_CRYPTOGRAPHY = "cryptography"
+BACKEND_OPENSSL = "openssl"
+BACKENDS = [BACKEND_CRYPTOGRAPHY, BACKEND_OPENSSL]
+
+# Algorithms of the generated keys. Elliptic curve keys are generated orders of magnitude faster than RSA keys.
+KEY_ALGORITHM_RSA = "rsa"
+KEY_ALGORITHM_P256 = "p256"
+KEY_ALGORITHM_P384 = "p384"
+KEY_ALGORITHM_ED25519 = "ed25519"
+# Key size stored for the jobs using each elliptic curve algorithm, RSA jobs store the size of their key
+EC_KEY_SIZES = {
+    KEY_ALGORITHM_P256: 256,
+    KEY_ALGORITHM_P384: 384,
+    KEY_ALGORITHM_ED25519: 256,
+}
+KEY_ALGORITHMS = [KEY_ALGORITHM_RSA] + list(EC_KEY_SIZES)
+
+_CURVES = {
+    KEY_ALGORITHM_P256: ec.SECP256R1,
+    KEY_ALGORITHM_P384: ec.SECP384R1,
+}
+# Arguments of openssl req -newkey for the elliptic curve algorithms
+_OPENSSL_NEWKEY_ARGS = {
+    KEY_ALGORITHM_P256: ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"],
+    KEY_ALGORITHM_P384: ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-384"],
+    KEY_ALGORITHM_ED25519: ["-newkey", "ed25519"],
+}
+
+_NAME_OIDS = {
+    "C": NameOID.COUNTRY_NAME,
+    "countryName": NameOID.COUNTRY_NAME,
+    "ST": NameOID.STATE_OR_PROVINCE_NAME,
+    "stateOrProvinceName": NameOID.STATE_OR_PROVINCE_NAME,
+    "L": NameOID.LOCALITY_NAME,
+    "localityName": NameOID.LOCALITY_NAME,
+    "O": NameOID.ORGANIZATION_NAME,
+    "organizationName": NameOID.ORGANIZATION_NAME,
+    "OU": NameOID.ORGANIZATIONAL_UNIT_NAME,
+    "organizationalUnitName": NameOID.ORGANIZATIONAL_UNIT_NAME,
+    "CN": NameOID.COMMON_NAME,
+    "commonName": NameOID.COMMON_NAME,
+    "emailAddress": NameOID.EMAIL_ADDRESS,
+}
+
+_DIGESTS = {
+    "sha256": hashes.SHA256,
+    "sha384": hashes.SHA384,
+    "sha512": hashes.SHA512,
+}
+
+
+# The openssl process currently run by this process, so that it can be killed if this process is stopped
+_openssl_process: Optional[subprocess.Popen] = None
+# In a worker of the queue executor, the pid of the openssl process run for each job being generated, by slot. Shared
+# with the executor so that it can stop the openssl process of one job without stopping the worker.
+_openssl_pids = None
+# Slot of the job this worker is generating, None outside of #generate_job
+_slot: Optional[int] = None
+
+
+class GenerationError(Exception):
+    """ Raised when the key or CSR couldn't be generated. The message is the output shown to the user. """
+    pass
+
+
+def _build_csr(config: openssl_config.ReqConfig, private_key) -> bytes:
+    """
+    Builds and signs a CSR from a parsed config.
+
+    :raises UnsupportedConfigError: Raised if the config contains values the cryptography library refuses, in which
+    case openssl is left to produce the error message
+    """
+    # Ed25519 signatures include their own hash, no digest may be given
+    digest = None if isinstance(private_key, ed25519.Ed25519PrivateKey) else _DIGESTS[config.get_digest()]()
+    try:
+        # The values are checked by cryptography as soon as the name and the SANs are built
+        attributes = []
+        for field, value in config.get_subject():
+            if field not in _NAME_OIDS or not value:
+                raise UnsupportedConfigError("Unsupported subject field: {}".format(field))
+            attributes.append(x509.NameAttribute(_NAME_OIDS[field], value))
+
+        sans = []
+        for san_type, value in config.get_sans():
+            if san_type == "DNS":
+                sans.append(x509.DNSName(value))
+            elif san_type == "IP":
+                sans.append(x509.IPAddress(ipaddress.ip_address(value)))
+            elif san_type == "email":
+                sans.append(x509.RFC822Name(value))
+            elif san_type == "URI":
+                sans.append(x509.UniformResourceIdentifier(value))
+
+        builder = x509.CertificateSigningRequestBuilder().subject_name(x509.Name(attributes))
+        if sans:
+            builder = builder.add_extension(x509.SubjectAlternativeName(sans), critical=False)
+        csr = builder.sign(private_key, digest)
+    except ValueError as e:
+        raise UnsupportedConfigError(str(e))
+
+    return csr.public_bytes(serialization.Encoding.PEM)
+
+
+def generate_key(key_size: int, key_algorithm: str = KEY_ALGORITHM_RSA) -> bytes:
+    """
+    Generates a private key in-process.
+
+    :param key_size: The size of the RSA key to generate, ignored for the other algorithms
+    :param key_algorithm: The algorithm of the key, one of KEY_ALGORITHMS
+    :return: The PEM encoded private key, in the same PKCS#8 format openssl uses
+    """
+    if key_algorithm == KEY_ALGORITHM_RSA:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    elif key_algorithm == KEY_ALGORITHM_ED25519:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    elif key_algorithm in _CURVES:
+        private_key = ec.generate_private_key(_CURVES[key_algorithm]())
+    else:
+        raise ValueError("Unknown key algorithm: {}".format(key_algorithm))
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption())
+
+
+def describe_key(private_key_pem: bytes) -> Tuple[str, int]:
+    """
+    Finds the algorithm and the size of an existing private key, i.e. one uploaded by a user.
+
+    :param private_key_pem: The PEM encoded private key, which must not be encrypted
+    :raises ValueError: Raised if the key can't be loaded or uses an unsupported algorithm
+    :return: A tuple containing the key algorithm (one of KEY_ALGORITHMS) and the key size
+    """
+    try:
+        private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Could not load the private key, it must be PEM encoded and not encrypted: {}".format(e))
+
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return KEY_ALGORITHM_RSA, private_key.key_size
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return KEY_ALGORITHM_ED25519, EC_KEY_SIZES[KEY_ALGORITHM_ED25519]
+    if isinstance(private_key, ec.EllipticCurvePrivateKey):
+        for key_algorithm, curve in _CURVES.items():
+            if isinstance(private_key.curve, curve):
+                return key_algorithm, EC_KEY_SIZES[key_algorithm]
+    raise ValueError("Unsupported private key type, the key must be an RSA, P-256, P-384 or Ed25519 key.")
+
+
+def _generate_cryptography(config: openssl_config.ReqConfig, key_size: int, private_key_pem: Optional[bytes],
+                           key_algorithm: str) -> Tuple[bytes, bytes]:
+    """ Generates the key and CSR in-process using the cryptography library """
+    if private_key_pem is None:
+        private_key_pem = generate_key(key_size, key_algorithm)
+    try:
+        private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+    except (ValueError, TypeError) as e:
+        raise GenerationError("Could not load the private key: {}".format(e))
+
+    csr_pem = _build_csr(config, private_key)
+    return private_key_pem, csr_pem
+
+
+def kill_openssl_process() -> None:
+    """ Kills the openssl process (and its children) currently run by this process, if any """
+    process = _openssl_process
+    if process is not None and process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def init_worker(openssl_pids=None) -> None:
+    """
+    Runs in each worker process of the queue executor when it starts. When the executor stops a worker, the openssl
+    process the worker may be running is stopped too, since it runs in its own process group.
+
+    :param openssl_pids: Shared array (multiprocessing.Array of ints) in which the pid of the openssl process run for a
+        job is published, at the slot given to #generate_job. 0 while no openssl process runs.
+    """
+    global _openssl_pids
+    _openssl_pids = openssl_pids
+
+    def stop_worker(_, __):
+        kill_openssl_process()
+        os._exit(1)
+
+    signal.signal(signal.SIGTERM, stop_worker)
+
+
+def _publish_openssl_pid(pid: int) -> None:
+    """ Tells the queue executor which openssl process generates the current job, if running in one of its workers """
+    if _openssl_pids is not None and _slot is not None:
+        _openssl_pids[_slot] = pid
+
+
+def _run_openssl(cmd: List[str], timeout: Optional[float]) -> None:
+    """
+    Runs openssl in its own process group, which is killed if it doesn't finish in time.
+
+    :raises GenerationError: Raised if openssl failed or timed out
+    """
+    global _openssl_process
+    # Don't let openssl print to the console, its output is the error message
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    _openssl_process = process
+    _publish_openssl_pid(process.pid)
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_openssl_process()
+        process.wait()
+        raise GenerationError("openssl did not finish within {:g} seconds and was stopped.".format(timeout))
+    finally:
+        _publish_openssl_pid(0)
+        _openssl_process = None
+
+    if process.returncode != 0:
+        raise GenerationError(output.decode("utf-8"))
+
+
+def _generate_openssl(config_contents: str, key_size: int, private_key_pem: Optional[bytes],
+                      key_algorithm: str, timeout: Optional[float]) -> Tuple[bytes, bytes]:
+    """ Generates the key and CSR by running the openssl binary """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conf_path = os.path.join(tmp_dir, "req.conf")
+        key_path = os.path.join(tmp_dir, "req.key")
+        csr_path = os.path.join(tmp_dir, "req.csr")
+
+        with open(conf_path, "w") as f:
+            f.write(config_contents)
+
+        if private_key_pem is None:
+            if key_algorithm == KEY_ALGORITHM_RSA:
+                newkey_args = ["-newkey", "rsa:{}".format(key_size)]
+            else:
+                newkey_args = _OPENSSL_NEWKEY_ARGS[key_algorithm]
+            cmd = ["openssl", "req", "-new"] + newkey_args + ["-nodes", "-keyout", key_path, "-out", csr_path,
+                                                              "-config", conf_path]
+        else:
+            # Sign with the provided key instead of generating one
+            with open(os.open(key_path, os.O_WRONLY | os.O_CREAT, 0o600), "wb") as f:
+                f.write(private_key_pem)
+            cmd = ["openssl", "req", "-new", "-key", key_path, "-out", csr_path, "-config", conf_path]
+        _run_openssl(cmd, timeout)
+
+        with open(key_path, "rb") as f_key, open(csr_path, "rb") as f_csr:
+            return f_key.read(), f_csr.read()
+
+
+def generate(config_contents: str, key_size: int, backend: Optional[str] = None,
+             private_key_pem: Optional[bytes] = None, key_algorithm: str = KEY_ALGORITHM_RSA,
+             timeout: Optional[float] = None) -> Tuple[bytes, bytes]:
+    """
+    Generates a private key and a CSR from the contents of an OpenSSL config file.
+
+    The cryptography backend only understands the subset of the config format that this app produces. If the config
+    uses anything else (for example after being edited by hand), the openssl backend is used instead. Mistakes found in
+    the config make the generation fail without running openssl.
+
+    :param config_contents: The contents of the OpenSSL config file
+    :param key_size: The size of the RSA key to generate, ignored for the other algorithms
+    :param backend: The backend to use, one of BACKENDS. Defaults to the cryptography backend.
+    :param private_key_pem: An existing PEM encoded private key to sign the CSR with. If provided, no key is generated
+    and key_size and key_algorithm are ignored.
+    :param key_algorithm: The algorithm of the key to generate, one of KEY_ALGORITHMS
+    :param timeout: The time (seconds) after which openssl is stopped, no limit if None
+    :raises GenerationError: Raised if the files couldn't be generated
+    :return: A tuple containing the PEM encoded private key and CSR
+    """
+    if backend is None:
+        backend = BACKEND_CRYPTOGRAPHY
+    if backend not in BACKENDS:
+        raise ValueError("Unknown generation backend: {}".format(backend))
+    if key_algorithm not in KEY_ALGORITHMS:
+        raise ValueError("Unknown key algorithm: {}".format(key_algorithm))
+
+    # Configs with mistakes fail right away instead of spawning openssl
+    try:
+        config = openssl_config.parse_config(config_contents)
+    except InvalidConfigError as e:
+        raise GenerationError(str(e))
+    except UnsupportedConfigError:
+        config = None
+
+    if backend == BACKEND_CRYPTOGRAPHY and config is not None:
+        try:
+            return _generate_cryptography(config, key_size, private_key_pem, key_algorithm)
+        except UnsupportedConfigError:
+            pass  # Fall back to openssl, which will either handle the config or produce a proper error message
+
+    return _generate_openssl(config_contents, key_size, private_key_pem, key_algorithm, timeout)
+
+
+def generate_job(slot: int, config_contents: str, key_size: int, backend: Optional[str] = None,
+                 private_key_pem: Optional[bytes] = None, key_algorithm: str = KEY_ALGORITHM_RSA,
+                 timeout: Optional[float] = None) -> Tuple[bytes, bytes]:
+    """
+    Runs #generate in a worker of the queue executor, publishing the pid of the openssl process it runs (if any) at the
+    slot the executor gave to the job.
+
+    :param slot: The index in the array given to #init_worker, used by this job only while it is generated
+    """
+    global _slot
+    _slot = slot
+    try:
+        return generate(config_contents, key_size, backend, private_key_pem, key_algorithm, timeout)
+    finally:
+        _slot = None
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+
+import app
+import profiling
+
+# Idle connections of the current process, reused by the next caller of #connection
+_pool: List[sqlite3.Connection] = []
+_pool_lock = threading.Lock()
+# Connections inherited from the parent process after a fork. They are never used nor closed, since SQLite
+# connections must not be carried across a fork, but are kept referenced so that they aren't closed by the GC either.
+_forked_connections: List[sqlite3.Connection] = []
+
+
+def connect(**kwargs) -> sqlite3.Connection:
+    """
+    Opens a new connection to the database, configured for concurrent access.
+
+    :param kwargs: Extra arguments passed to sqlite3.connect, i.e. isolation_level
+    :return: The connection, the caller is responsible for closing it
+    """
+    conn = sqlite3.connect(app.SQLITE_DB_PATH, timeout=app.SQLITE_BUSY_TIMEOUT / 1000,
+                           cached_statements=256, check_same_thread=False, **kwargs)
+    # Lets the reaper give the pages of deleted jobs back to the file system (see retention). Only takes effect when the
+    # database is created, and must be set before the journal mode. It is only set on empty databases: on a database
+    # already using it, setting it again waits for the write lock.
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets readers work while the executor writes. It is persistent, but setting it again is a no-op.
+    conn.execute("PRAGMA journal_mode={}".format(app.SQLITE_JOURNAL_MODE))
+    # NORMAL is safe with WAL, a power loss can only roll back the last transactions
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout={}".format(app.SQLITE_BUSY_TIMEOUT))
+    return conn
+
+
+def _reset_after_fork() -> None:
+    """ Starts a new pool in a forked child (i.e. a gunicorn worker). The lock is replaced too, since another thread of
+        the parent may have been holding it when the process forked. """
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    _forked_connections.extend(_pool)
+    _pool.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _acquire() -> sqlite3.Connection:
+    with _pool_lock:
+        if _pool:
+            return _pool.pop()
+    return connect()
+
+
+def _release(conn: sqlite3.Connection) -> None:
+    with _pool_lock:
+        if len(_pool) < app.SQLITE_POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn.close()
+
+
+@contextmanager
+def connection() -> Iterator[sqlite3.Connection]:
+    """
+    Borrows a connection from the pool of the current process, for the current thread or greenlet.
+    Changes are committed when the block exits normally and rolled back if it raises.
+
+    Usage: with database.connection() as conn: ...
+    """
+    with profiling.span("db"):
+        conn = _acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            _release(conn)
+
+
+def add_column_if_missing(db: sqlite3.Cursor, table: str, column: str, definition: str) -> bool:
+    """
+    Adds a column to a table created by an older version of the app.
+
+    :param db: The cursor to use
+    :param table: The name of the table
+    :param column: The name of the column
+    :param definition: The type and constraints of the column, i.e. "INT NOT NULL DEFAULT 0"
+    :return: True if the column was added
+    """
+    db.execute("PRAGMA table_info({})".format(table))
+    if column in [row[1] for row in db.fetchall()]:
+        return False
+    db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+    return True
@@ -0,0 +1,68 @@
+import contextvars
+import functools
+import threading
+from typing import Callable, TypeVar
+
+import app
+
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    # Only needed when running under gunicorn's gevent workers
+    gevent = None
+
+T = TypeVar("T")
+
+# Set in the threads of the pool, so that nested calls run directly instead of going through the pool again
+_local = threading.local()
+
+
+def in_pool() -> bool:
+    """ Returns whether the caller runs in a thread of the pool """
+    return getattr(_local, "in_pool", False)
+
+
+def _is_cooperative() -> bool:
+    """ Returns whether blocking calls must go through the pool: the current process runs greenlets (i.e. it is a
+        gunicorn gevent worker), the pool is enabled and the caller isn't already in the pool """
+    return (gevent is not None and app.IO_THREADS > 0 and gevent.monkey.is_module_patched("socket")
+            and not in_pool())
+
+
+def _run_in_pool(function: Callable[..., T], args, kwargs) -> T:
+    _local.in_pool = True
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _local.in_pool = False
+
+
+def run(function: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Calls a function that blocks on the database or the disk.
+    Under gevent, SQLite and file operations block the whole worker, not only the greenlet doing them. The function
+    then runs in a native thread of the hub's thread pool while the calling greenlet waits cooperatively, so the other
+    requests of the worker keep being served. At most IO_THREADS functions run at once per worker, the other callers
+    wait for a thread. Otherwise (executor, development server, IO_THREADS set to 0), the function is called directly.
+
+    :param function: The function to call
+    :return: What the function returns, the exceptions it raises are raised to the caller
+    """
+    if not _is_cooperative():
+        return function(*args, **kwargs)
+
+    pool = gevent.get_hub().threadpool
+    if pool.maxsize != app.IO_THREADS:
+        pool.maxsize = app.IO_THREADS
+    # The function sees the context variables of the caller, i.e. the spans of the request being profiled
+    return pool.apply(contextvars.copy_context().run, (_run_in_pool, function, args, kwargs))
+
+
+def offloaded(function: Callable[..., T]) -> Callable[..., T]:
+    """ Decorator making every call of a function go through #run """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return run(function, *args, **kwargs)
+
+    return wrapper
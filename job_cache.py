@@ -0,0 +1,80 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class JobCache:
+    """ Bounded LRU cache of jobs and of the contents of their files, for the current process.
+        Each entry is tagged with the version of the job row it was read from. The version is incremented by every
+        write to the job, so a lookup with the current version from the database never returns stale data, even when
+        the job was changed by another process. """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        # job_id -> (version, job, {artifact name: contents})
+        self._entries: "OrderedDict[str, Tuple[int, object, Dict[str, str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self) -> None:
+        """ Replaces the lock in a forked child, the entries stay valid as they are checked against the job version """
+        self._lock = threading.Lock()
+
+    def _get_entry(self, job_id: str, version: int) -> Optional[Tuple[int, object, Dict[str, str]]]:
+        entry = self._entries.get(job_id)
+        if entry is None or entry[0] != version:
+            return None
+        self._entries.move_to_end(job_id)
+        return entry
+
+    def get_job(self, job_id: str, version: int):
+        """ Returns the cached job if it was cached with this version, None otherwise """
+        with self._lock:
+            entry = self._get_entry(job_id, version)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[1]
+
+    def put_job(self, job_id: str, version: int, job) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            entry = self._entries.get(job_id)
+            # Keep the cached artifacts if they are from the same version
+            artifacts = entry[2] if entry is not None and entry[0] == version else {}
+            self._entries[job_id] = (version, job, artifacts)
+            self._entries.move_to_end(job_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def get_artifact(self, job_id: str, version: int, name: str) -> Optional[str]:
+        """ Returns the cached contents of a job's file if they were cached with this version, None otherwise """
+        with self._lock:
+            entry = self._get_entry(job_id, version)
+            if entry is None or name not in entry[2]:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[2][name]
+
+    def put_artifact(self, job_id: str, version: int, name: str, contents: str) -> None:
+        """ Caches the contents of a job's file. Only done if the job itself is cached with this version. """
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is not None and entry[0] == version:
+                entry[2][name] = contents
+
+    def invalidate(self, job_id: str) -> None:
+        with self._lock:
+            self._entries.pop(job_id, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self._max_size, "hits": self._hits,
+                    "misses": self._misses}
@@ -1,11 +1,16 @@
-import os
-import shutil
 import sqlite3
+import time
 from enum import Enum
 from random import SystemRandom
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 import app
+import csr_engine
+import database
+import io_pool
+import metrics
+import storage
+from job_cache import JobCache
 
 
 class JobStatus(Enum):
@@ -23,87 +28,205 @@ class JobStatus(Enum):
 
 
 class Job:
-    def __init__(self, job_id: str, config_contents: str, key_size: int, status: JobStatus, error_message: str):
+    def __init__(self, job_id: str, config_contents: Optional[str], key_size: int, status: JobStatus,
+                 error_message: str, version: int = 0, key_algorithm: str = csr_engine.KEY_ALGORITHM_RSA,
+                 renewed_from: Optional[str] = None, updated_at: Optional[float] = None):
+        """ If config_contents is None, the config file is only read when #get_config_contents is first called """
         self._job_id = job_id
         self._config_contents = config_contents
         self._key_size = key_size
         self._status = status
         self._error_message = error_message
+        self._version = version
+        self._key_algorithm = key_algorithm
+        self._renewed_from = renewed_from
+        self._updated_at = updated_at
 
     def get_id(self) -> str:
         return self._job_id
 
     def get_config_contents(self) -> str:
+        """
+        :raises FileNotFoundError: Raised if the config file couldn't be read
+        """
+        if self._config_contents is None:
+            self._config_contents = _read_config(self._job_id)
         return self._config_contents
 
     def get_key_size(self) -> int:
         return self._key_size
 
+    def get_key_algorithm(self) -> str:
+        """ The algorithm of the job's key, one of csr_engine.KEY_ALGORITHMS """
+        return self._key_algorithm
+
+    def get_renewed_from(self) -> Optional[str]:
+        """ The id of the job this job renewed, None if it wasn't created by a renewal """
+        return self._renewed_from
+
     def get_status(self) -> JobStatus:
         return self._status
 
     def get_error_message(self) -> str:
         return self._error_message
 
+    def get_version(self) -> int:
+        """ The version of the job's row, incremented every time the job or its config file changes """
+        return self._version
+
+    def get_updated_at(self) -> Optional[float]:
+        """ The time (seconds since the epoch) the job or its config file last changed, along with its version. None if
+            it isn't known. """
+        return self._updated_at
+
+
+# Created on first use, since the cache size is defined in app which imports this module
+_cache: Optional[JobCache] = None
+
+
+def get_cache() -> JobCache:
+    global _cache
+    if _cache is None:
+        _cache = JobCache(app.JOB_CACHE_SIZE)
+    return _cache
+
 
 def initialize_db() -> None:
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    with database.connection() as conn:
         db = conn.cursor()
         db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY,"
                    "key_size INT NOT NULL,"
                    "status INT NOT NULL DEFAULT 0,"
-                   "error_message TEXT)")
+                   "error_message TEXT,"
+                   "version INT NOT NULL DEFAULT 0,"
+                   "key_algorithm TEXT NOT NULL DEFAULT 'rsa',"
+                   "renewed_from TEXT,"
+                   "created_at REAL,"
+                   "updated_at REAL)")
+        database.add_column_if_missing(db, "jobs", "version", "INT NOT NULL DEFAULT 0")
+        # Jobs created before other algorithms were supported all use RSA keys
+        database.add_column_if_missing(db, "jobs", "key_algorithm", "TEXT NOT NULL DEFAULT 'rsa'")
+        database.add_column_if_missing(db, "jobs", "renewed_from", "TEXT")
+        database.add_column_if_missing(db, "jobs", "created_at", "REAL")
+        database.add_column_if_missing(db, "jobs", "updated_at", "REAL")
+        # Used to list the jobs with a given status, ordered by id
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id)")
+        # Used by the reaper to find the expired jobs of a status
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated_at ON jobs (status, updated_at)")
+        # Jobs created before timestamps were recorded get the time of the upgrade, their retention starts from there.
+        # Filtering on every status lets the query use the index instead of scanning the table.
+        db.execute("UPDATE jobs SET created_at=COALESCE(created_at, ?), updated_at=? "
+                   "WHERE status IN ({}) AND updated_at IS NULL".format(",".join(str(s.value) for s in JobStatus)),
+                   (time.time(), time.time()))
         conn.commit()
 
 
-def create_job(config_contents: str, key_size: int) -> str:
-    def generate_random_id():
-        alphabet = list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890")  # length: 62
-        crypto = SystemRandom()
+def _generate_random_id():
+    alphabet = list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890")  # length: 62
+    crypto = SystemRandom()
+
+    x = ""
+    for i in range(10):
+        x += alphabet[crypto.randrange(62)]
+    return x
 
-        x = ""
-        for i in range(10):
-            x += alphabet[crypto.randrange(62)]
-        return x
 
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+@io_pool.offloaded
+def create_job(config_contents: str, key_size: int, key_algorithm: str = csr_engine.KEY_ALGORITHM_RSA,
+               renewed_from: Optional[str] = None) -> str:
+    with metrics.timer("csr_db_query_seconds", operation="create_job"), database.connection() as conn:
         db = conn.cursor()
-        rand_id = generate_random_id()
+        rand_id = _generate_random_id()
 
         while True:
             try:
-                db.execute("INSERT INTO jobs (id, key_size, status) VALUES (?, ?, ?)",
-                           (rand_id, key_size, JobStatus.CREATED.value))
+                db.execute("INSERT INTO jobs (id, key_size, status, key_algorithm, renewed_from, created_at, "
+                           "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (rand_id, key_size, JobStatus.CREATED.value, key_algorithm, renewed_from, time.time(),
+                            time.time()))
             except sqlite3.IntegrityError:
                 # If there is an IntegrityError, the random id is already in use, generate another one
-                rand_id = generate_random_id()
+                rand_id = _generate_random_id()
                 continue
 
-            conn.commit()
             break
 
-        folder_path = os.path.join(app.JOBS_FOLDER_PATH, rand_id)
-        os.makedirs(folder_path)
-
-        config_path = os.path.join(folder_path, "{}.conf".format(rand_id))
-        with open(config_path, "w") as f_config:
-            f_config.write(config_contents)
-            f_config.close()
+        try:
+            storage.get_storage().write(rand_id, "conf", config_contents.encode(), db)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            storage.get_storage().delete_job(rand_id)
+            raise
         return rand_id
 
 
+@io_pool.offloaded
+def create_jobs(configs: List[Tuple[str, int, str]], queue: bool, priority: int = 0,
+                batch: Optional[str] = None) -> List[str]:
+    """
+    Creates many jobs in a single transaction, either all of them are created or none are.
+
+    :param configs: A list of tuples containing the contents of the config file, the key size and the key algorithm
+    of each job
+    :param queue: If True, the jobs are added to the generation queue right away
+    :param priority: The priority of the jobs in the generation queue
+    :param batch: The batch the jobs belong to in the generation queue, each job is its own batch if not specified
+    :return: The ids of the created jobs, in the same order as the configs
+    """
+    # Imported here since queue_executor imports this module
+    from queue_executor import QueueExecutor
+
+    status = JobStatus.QUEUED if queue else JobStatus.CREATED
+    job_ids: List[str] = []
+
+    with metrics.timer("csr_db_query_seconds", operation="create_jobs"), database.connection() as conn:
+        db = conn.cursor()
+        try:
+            for config_contents, key_size, key_algorithm in configs:
+                while True:
+                    job_id = _generate_random_id()
+                    try:
+                        db.execute("INSERT INTO jobs (id, key_size, status, key_algorithm, created_at, updated_at) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)",
+                                   (job_id, key_size, status.value, key_algorithm, time.time(), time.time()))
+                        break
+                    except sqlite3.IntegrityError:
+                        # The random id is already in use, generate another one
+                        continue
+                job_ids.append(job_id)
+
+                # Write the config files before committing so that the executor never sees a job without its config
+                storage.get_storage().write(job_id, "conf", config_contents.encode(), db)
+
+            if queue:
+                QueueExecutor.insert_into_queue(db, job_ids, priority, batch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            for job_id in job_ids:
+                storage.get_storage().delete_job(job_id)
+            raise
+
+    if queue:
+        QueueExecutor.notify()
+    return job_ids
+
+
 def _get_job(job_id: str):
     """
     Returns the job in a tuple format.
 
     :param job_id: The id of the job to get
     :raises ValueError: Raised if no job can be found with the specified id
-    :return: A tuple containing the id, the RSA key size, the status of the job and an error message obtain when
-    generating the files (can be null)
+    :return: A tuple containing the id, the key size, the status of the job, an error message obtain when
+    generating the files (can be null), the version of the row, the key algorithm, the id of the renewed job
+    (can be null) and the time the job last changed (can be null)
     """
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    with metrics.timer("csr_db_query_seconds", operation="get_job"), database.connection() as conn:
         db = conn.cursor()
-        db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        db.execute("SELECT id, key_size, status, error_message, version, key_algorithm, renewed_from, updated_at "
+                   "FROM jobs WHERE id = ?", (job_id,))
         rows = db.fetchall()
 
         if len(rows) == 0:
@@ -114,66 +237,190 @@ def _get_job(job_id: str):
         return rows[0]
 
 
+@io_pool.offloaded
 def get_job(job_id: str) -> Job:
     """
-    Retrieves a job's information from the database.
+    Retrieves a job's information from the database. The config file is only read if the job isn't cached, or if it
+    changed since it was cached.
 
     :param job_id: The id of the job to retrieve.
     :raises ValueError: Raised if no job can be found with the specified id
     :raises FileNotFoundError: Raised if the config file couldn't be read
     :return: A Job object
     """
-    job = _get_job(job_id)
-    rsa_key_size = job[1]
-    status = JobStatus(job[2])
-    error_message = job[3]
+    row = _get_job(job_id)
+    version = row[4]
+
+    job = get_cache().get_job(job_id, version)
+    if job is None:
+        job = Job(job_id, _read_config(job_id), row[1], JobStatus(row[2]), row[3], version, row[5], row[6], row[7])
+        get_cache().put_job(job_id, version, job)
+    return job
+
+
+def _decode(data: bytes) -> str:
+    """ Decodes the contents of a file, with universal newlines like a file opened in text mode """
+    return data.decode().replace("\r\n", "\n").replace("\r", "\n")
+
+
+def get_job_file_path(job_id: str, extension: str) -> Optional[str]:
+    """ Returns the path of one of the files of a job, i.e. extension "key" for the private key. None if the storage
+        backend doesn't keep the files of the jobs on the local file system. """
+    return storage.get_storage().get_path(job_id, extension)
+
+
+@io_pool.offloaded
+def get_job_file(job: Job, extension: str) -> str:
+    """
+    Reads one of the files of a job. The files of the backends that aren't local (sqlite and object) are cached, the
+    local files are already cached by the OS.
+
+    :param job: The job, as returned by #get_job
+    :param extension: The extension of the file, i.e. "key" or "csr"
+    :raises FileNotFoundError: Raised if the file doesn't exist
+    :return: The contents of the file
+    """
+    if get_job_file_path(job.get_id(), extension) is not None:
+        return _decode(storage.get_storage().read(job.get_id(), extension))
+
+    contents = get_cache().get_artifact(job.get_id(), job.get_version(), extension)
+    if contents is None:
+        contents = _decode(storage.get_storage().read(job.get_id(), extension))
+        get_cache().put_artifact(job.get_id(), job.get_version(), extension, contents)
+    return contents
+
+
+@io_pool.offloaded
+def write_job_files(job_id: str, key_pem: bytes, csr_pem: bytes):
+    """
+    Saves the generated private key and CSR of a job. The caller then sets the status of the job.
+
+    :param job_id: The id of the job
+    :param key_pem: The PEM encoded private key
+    :param csr_pem: The PEM encoded CSR
+    """
+    storage.get_storage().write(job_id, "key", key_pem)
+    storage.get_storage().write(job_id, "csr", csr_pem)
+
+
+@io_pool.offloaded
+def delete_job_files(job_id: str):
+    """ Deletes the files of a job, i.e. the ones written for a job that was deleted while it was being generated """
+    storage.get_storage().delete_job(job_id)
 
-    # /%some_path%/job_id/job_id.conf
-    conf_path = os.path.join(app.JOBS_FOLDER_PATH, job_id, "{}.conf".format(job_id))
 
+@io_pool.offloaded
+def _read_config(job_id: str) -> str:
     try:
-        with open(conf_path, "r") as f:
-            return Job(job_id, f.read(), rsa_key_size, status, error_message)
+        return _decode(storage.get_storage().read(job_id, "conf"))
     except FileNotFoundError:
         raise FileNotFoundError("Could not open the config file for this job.")
 
 
-def get_jobs() -> List[Job]:
+@io_pool.offloaded
+def get_jobs(status: Optional[JobStatus] = None, after: Optional[str] = None, limit: int = 50) -> List[Job]:
     """
-    Retrieves all the jobs currently in the database.
+    Retrieves a page of jobs, ordered by id. The config files are only read if the contents are requested.
 
+    :param status: If specified, only the jobs with this status are returned
+    :param after: If specified, only the jobs with an id greater than this one are returned. Pass the id of the last
+    job of a page to get the next page.
+    :param limit: The maximum number of jobs to return
     :return: A list containing Job objects
     """
 
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    query = "SELECT id, key_size, status, error_message, version, key_algorithm, renewed_from, updated_at FROM jobs"
+    conditions = []
+    params = []
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status.value)
+    if after is not None:
+        conditions.append("id > ?")
+        params.append(after)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id LIMIT ?"
+    params.append(limit)
+
+    with metrics.timer("csr_db_query_seconds", operation="get_jobs"), database.connection() as conn:
         db = conn.cursor()
-        db.execute("SELECT id FROM jobs")
-        job_ids = db.fetchall()
-        result: List[Optional[Job]] = [None] * len(job_ids)
-        for i in range(len(job_ids)):
-            result[i] = get_job(job_ids[i][0])
-        return result
+        db.execute(query, params)
+        return [Job(job_id, None, key_size, JobStatus(status), error_message, version, key_algorithm, renewed_from,
+                    updated_at)
+                for job_id, key_size, status, error_message, version, key_algorithm, renewed_from, updated_at
+                in db.fetchall()]
 
 
+@io_pool.offloaded
 def set_job_status(job_id: str, status: JobStatus):
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    with metrics.timer("csr_db_query_seconds", operation="set_job_status"), database.connection() as conn:
         db = conn.cursor()
         # No need to catch error since query will not throw any, will just not do anything if id doesn't exist
-        db.execute("UPDATE jobs SET status=? WHERE id=?", (status.value, job_id))
+        db.execute("UPDATE jobs SET status=?, version=version+1, updated_at=? WHERE id=?",
+                   (status.value, time.time(), job_id))
+        conn.commit()
+    get_cache().invalidate(job_id)
+
+
+@io_pool.offloaded
+def set_job_result(job_id: str, status: JobStatus, error_message: Optional[str]) -> bool:
+    """
+    Sets the status and the error message of a job in a single write.
+
+    :param job_id: The id of the job
+    :param status: The new status of the job
+    :param error_message: The new error message, None to clear it
+    :return: False if the job doesn't exist (anymore)
+    """
+    with metrics.timer("csr_db_query_seconds", operation="set_job_result"), database.connection() as conn:
+        db = conn.cursor()
+        db.execute("UPDATE jobs SET status=?, error_message=?, version=version+1, updated_at=? WHERE id=?",
+                   (status.value, error_message, time.time(), job_id))
+        updated = db.rowcount > 0
         conn.commit()
+    get_cache().invalidate(job_id)
+    return updated
 
 
+@io_pool.offloaded
 def set_job_error_message(job_id: str, error_message: Optional[str]):
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    with metrics.timer("csr_db_query_seconds", operation="set_job_error_message"), database.connection() as conn:
         db = conn.cursor()
         if error_message is None:
             # No error message, provided, clear error_message column (set to NULL)
-            db.execute("UPDATE jobs SET error_message=NULL WHERE id=?", (job_id,))
+            db.execute("UPDATE jobs SET error_message=NULL, version=version+1, updated_at=? WHERE id=?",
+                       (time.time(), job_id))
         else:
-            db.execute("UPDATE jobs SET error_message=? WHERE id=?", (error_message, job_id))
+            db.execute("UPDATE jobs SET error_message=?, version=version+1, updated_at=? WHERE id=?",
+                       (error_message, time.time(), job_id))
+        conn.commit()
+    get_cache().invalidate(job_id)
+
+
+@io_pool.offloaded
+def update_job_config(job_id: str, config_contents: str):
+    """
+    Replaces the contents of a job's config file
+
+    :param job_id: The ID of the job to update
+    :param config_contents: The new contents of the config file
+    :raises ValueError: Raised if no job can be found with the specified id
+    """
+
+    with metrics.timer("csr_db_query_seconds", operation="update_job_config"), database.connection() as conn:
+        db = conn.cursor()
+        # The version is changed first, which takes the write lock: the config is only replaced once the change can be
+        # committed. The backends storing the config in the database replace it in the same transaction.
+        db.execute("UPDATE jobs SET version=version+1, updated_at=? WHERE id=?", (time.time(), job_id))
+        if db.rowcount == 0:
+            raise ValueError("No job found with that ID.")
+        storage.get_storage().write(job_id, "conf", config_contents.encode(), db)
         conn.commit()
+    get_cache().invalidate(job_id)
 
 
+@io_pool.offloaded
 def delete_job(job_id: str):
     """
     Deletes a certain job from the database and disk
@@ -185,11 +432,14 @@ def delete_job(job_id: str):
     _ = _get_job(job_id)
 
     # If no exception, job exists
-    with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    with metrics.timer("csr_db_query_seconds", operation="delete_job"), database.connection() as conn:
         db = conn.cursor()
         db.execute("DELETE FROM jobs WHERE id=?", (job_id,))
+        # A queued job leaves the queue with it. If it is being generated, the executor discards the result since it
+        # no longer holds the job's lease.
+        db.execute("DELETE FROM queue WHERE job_id=?", (job_id,))
         conn.commit()
+    get_cache().invalidate(job_id)
 
-    # Try to delete the folder containing the job's files
-    folder_path = os.path.join(app.JOBS_FOLDER_PATH, job_id)
-    shutil.rmtree(folder_path, ignore_errors=True)
+    # Delete the job's files
+    storage.get_storage().delete_job(job_id)
@@ -0,0 +1,94 @@
+import os
+from random import SystemRandom
+from typing import Dict, Optional
+
+import app
+import io_pool
+
+# Key sizes for which keys are pre-generated
+POOL_KEY_SIZES = [2048, 4096]
+
+
+def _pool_folder(key_size: int) -> str:
+    return os.path.join(app.KEY_POOL_PATH, str(key_size))
+
+
+def initialize_pool() -> None:
+    """ Creates the pool folders. Only the user running the app can access them since they contain private keys.
+        Partially written or half taken keys left behind by a crash are removed. """
+    os.makedirs(app.KEY_POOL_PATH, mode=0o700, exist_ok=True)
+    os.chmod(app.KEY_POOL_PATH, 0o700)
+    for key_size in POOL_KEY_SIZES:
+        folder_path = _pool_folder(key_size)
+        os.makedirs(folder_path, mode=0o700, exist_ok=True)
+
+        for entry in os.scandir(folder_path):
+            if not entry.name.endswith(".pem"):
+                os.remove(entry.path)
+
+
+@io_pool.offloaded
+def get_depth() -> Dict[int, int]:
+    """
+    Counts the keys available in the pool.
+
+    :return: A dict mapping the key size to the number of ready keys of that size
+    """
+    depth = {}
+    for key_size in POOL_KEY_SIZES:
+        try:
+            depth[key_size] = sum(1 for entry in os.scandir(_pool_folder(key_size)) if entry.name.endswith(".pem"))
+        except FileNotFoundError:
+            depth[key_size] = 0
+    return depth
+
+
+def add_key(key_size: int, key_pem: bytes) -> None:
+    """
+    Adds a pre-generated key to the pool.
+
+    :param key_size: The size of the RSA key
+    :param key_pem: The PEM encoded private key
+    """
+    folder_path = _pool_folder(key_size)
+    name = "{:016x}".format(SystemRandom().getrandbits(64))
+    tmp_path = os.path.join(folder_path, name + ".tmp")
+
+    # Write under a temporary name, the key only becomes available once it is completely written
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+        f.write(key_pem)
+    os.rename(tmp_path, os.path.join(folder_path, name + ".pem"))
+
+
+def take_key(key_size: int) -> Optional[bytes]:
+    """
+    Removes a key from the pool. A key is only ever returned once, even when several processes take keys at once.
+
+    :param key_size: The size of the RSA key
+    :return: The PEM encoded private key, or None if the pool has no key of that size
+    """
+    if key_size not in POOL_KEY_SIZES:
+        return None
+
+    try:
+        entries = list(os.scandir(_pool_folder(key_size)))
+    except FileNotFoundError:
+        return None
+
+    for entry in entries:
+        if not entry.name.endswith(".pem"):
+            continue
+
+        # Renaming is atomic, if another process took this key first the rename fails and we try the next one
+        taken_path = "{}.taken-{}".format(entry.path, os.getpid())
+        try:
+            os.rename(entry.path, taken_path)
+        except FileNotFoundError:
+            continue
+
+        with open(taken_path, "rb") as f:
+            key_pem = f.read()
+        os.remove(taken_path)
+        return key_pem
+
+    return None
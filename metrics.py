@@ -0,0 +1,182 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import app
+import database
+import io_pool
+
+# name -> (type, help, histogram buckets)
+_DEFINITIONS = {
+    "csr_jobs_total": ("counter", "Jobs processed by the queue executor, by result.", None),
+    "csr_jobs_released_total": ("counter", "Jobs interrupted because the workers were stopped, generated again later.",
+                                None),
+    "csr_jobs_expired_total": ("counter", "Jobs deleted by the reaper once their retention expired, by status.", None),
+    "csr_queue_wait_seconds": ("histogram", "Time between queueing a job and the start of its generation.",
+                               [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]),
+    "csr_generation_duration_seconds": ("histogram", "Time taken by a worker to generate the key and CSR of a job.",
+                                        [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]),
+    "csr_db_query_seconds": ("histogram", "Time spent in SQLite operations of the app, by operation.",
+                             [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5]),
+    "csr_executor_stage_seconds": ("histogram", "Time taken by each stage of the queue executor (claim, generate, "
+                                                "persist), recorded if profiling is enabled.",
+                                   [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 10, 30]),
+    "csr_http_request_duration_seconds": ("histogram", "Latency of the HTTP requests, by endpoint.",
+                                          [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]),
+}
+
+# Values recorded by this process since the last flush: (name, labels as JSON, series) -> value.
+# For counters the series is "", for histograms it is the upper bound of the bucket, "sum" or "count".
+_pending: Dict[Tuple[str, str, str], float] = {}
+_pending_lock = threading.Lock()
+# Whether this process started flushing its pending values
+_flusher_started = False
+
+
+def initialize_metrics() -> None:
+    with database.connection() as conn:
+        db = conn.cursor()
+        db.execute("CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL,"
+                   "labels TEXT NOT NULL,"
+                   "series TEXT NOT NULL,"
+                   "value REAL NOT NULL,"
+                   "PRIMARY KEY (name, labels, series))")
+        conn.commit()
+
+
+def _reset_after_fork() -> None:
+    """ Drops the values inherited by a forked child, which the parent flushes itself, and replaces the lock """
+    global _pending_lock, _flusher_started
+    _pending_lock = threading.Lock()
+    _pending.clear()
+    _flusher_started = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _add(key: Tuple[str, str, str], value: float) -> None:
+    global _flusher_started
+    with _pending_lock:
+        if not _flusher_started and not io_pool.in_pool():
+            # Under gevent, a thread started from the I/O pool would be a greenlet that never runs
+            _flusher_started = True
+            threading.Thread(target=_flush_periodically, daemon=True).start()
+        _pending[key] = _pending.get(key, 0) + value
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """ Increments a counter """
+    _add((name, json.dumps(labels, sort_keys=True), ""), value)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """ Records a value in a histogram """
+    labels_json = json.dumps(labels, sort_keys=True)
+    for bound in _DEFINITIONS[name][2]:
+        if value <= bound:
+            _add((name, labels_json, str(bound)), 1)
+            break
+    else:
+        _add((name, labels_json, "+Inf"), 1)
+    _add((name, labels_json, "sum"), value)
+    _add((name, labels_json, "count"), 1)
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """ Records the time taken by the block in a histogram """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def flush() -> None:
+    """ Adds the values recorded by this process to the totals shared by all processes """
+    with _pending_lock:
+        values = list(_pending.items())
+        _pending.clear()
+    if not values:
+        return
+
+    # A dedicated connection is used so that these writes aren't timed themselves
+    conn = database.connect()
+    try:
+        with conn:
+            conn.executemany("INSERT INTO metrics (name, labels, series, value) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (name, labels, series) DO UPDATE SET value = value + excluded.value",
+                             [(name, labels, series, value) for (name, labels, series), value in values])
+    except sqlite3.Error as e:
+        print("Could not save the metrics: {}".format(e))
+    finally:
+        conn.close()
+
+
+def _flush_periodically() -> None:
+    while True:
+        time.sleep(app.METRICS_FLUSH_INTERVAL)
+        io_pool.run(flush)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + "}"
+
+
+@io_pool.offloaded
+def render(gauges: List[Tuple[str, str, Dict[Tuple[Tuple[str, str], ...], float]]]) -> str:
+    """
+    Renders all the metrics in the Prometheus text format.
+
+    :param gauges: Gauges computed at scrape time, as a list of (name, help, {labels as tuple of items: value})
+    :return: The contents of the /metrics response
+    """
+    flush()
+    with database.connection() as conn:
+        db = conn.cursor()
+        db.execute("SELECT name, labels, series, value FROM metrics ORDER BY name, labels")
+        rows = db.fetchall()
+
+    # name -> labels -> series -> value
+    stored: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for name, labels, series, value in rows:
+        stored.setdefault(name, {}).setdefault(labels, {})[series] = value
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in _DEFINITIONS.items():
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels_json, series in stored.get(name, {}).items():
+            labels = json.loads(labels_json)
+            if metric_type == "counter":
+                lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(series.get("", 0))))
+                continue
+
+            cumulative = 0
+            for bound in [str(bound) for bound in buckets] + ["+Inf"]:
+                cumulative += series.get(bound, 0)
+                lines.append("{}_bucket{} {}".format(name, _format_labels(dict(labels, le=bound)),
+                                                     _format_value(cumulative)))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(series.get("sum", 0))))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels), _format_value(series.get("count", 0))))
+
+    for name, help_text, values in gauges:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in values.items():
+            lines.append("{}{} {}".format(name, _format_labels(dict(labels)), _format_value(value)))
+
+    return "\n".join(lines) + "\n"
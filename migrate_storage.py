@@ -0,0 +1,85 @@
+""" Copies the files of every job from the current storage backend (CSR_STORAGE) to another one, one job at a time.
+
+Stop the app first: jobs created or generated during the migration may not be copied. Once the migration completes,
+set CSR_STORAGE (and CSR_JOBS or CSR_OBJECT_STORE if needed) to the new backend and start the app again. An interrupted
+migration can be resumed with --after, the id of the last job it copied.
+
+Usage: python migrate_storage.py --to flat|sharded|sqlite|object [--path FOLDER] [--url URL] [--after JOB_ID]
+                                 [--delete]
+"""
+import argparse
+import os
+import sys
+
+import app
+import database
+import job_manager
+import storage
+
+# Number of job ids read from the database at once
+PAGE_SIZE = 500
+
+
+def migrate(source: storage.Storage, target: storage.Storage, after: str = "", delete: bool = False) -> int:
+    """
+    Copies the files of the jobs, in the order of their ids. Each file is read back from the target before the next job
+    is copied.
+
+    :param source: The backend to copy the files from
+    :param target: The backend to copy the files to
+    :param after: Only the jobs with an id greater than this one are copied
+    :param delete: If True, the files of each job are deleted from the source once copied
+    :raises RuntimeError: Raised if a file read back from the target is different
+    :return: The number of copied jobs
+    """
+    copied = 0
+    while True:
+        with database.connection() as conn:
+            job_ids = [row[0] for row in conn.execute("SELECT id FROM jobs WHERE id > ? ORDER BY id LIMIT ?",
+                                                      (after, PAGE_SIZE))]
+        if not job_ids:
+            return copied
+
+        for job_id in job_ids:
+            for name in sorted(source.list_names(job_id)):
+                data = source.read(job_id, name)
+                target.write(job_id, name, data)
+                if target.read(job_id, name) != data:
+                    raise RuntimeError("The {} of job {} was not copied correctly.".format(name, job_id))
+            if delete:
+                source.delete_job(job_id)
+            copied += 1
+        after = job_ids[-1]
+        print("Copied {} jobs, last job: {}".format(copied, after))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--to", required=True, choices=storage.BACKENDS)
+    parser.add_argument("--path", help="Root folder of the flat and sharded backends, CSR_JOBS by default")
+    parser.add_argument("--url", help="Object store of the object backend, CSR_OBJECT_STORE by default")
+    parser.add_argument("--after", default="", help="Resume after this job id")
+    parser.add_argument("--delete", action="store_true", help="Delete the files from the current backend once copied")
+    args = parser.parse_args()
+
+    folder_backends = ["flat", "sharded"]
+    if args.to == app.STORAGE_BACKEND and args.to not in folder_backends + ["object"]:
+        parser.error("The jobs are already stored in the {} backend.".format(args.to))
+    if args.to in folder_backends and app.STORAGE_BACKEND in folder_backends and \
+            os.path.abspath(args.path or app.JOBS_FOLDER_PATH) == os.path.abspath(app.JOBS_FOLDER_PATH):
+        parser.error("The jobs must be copied to another folder, use --path.")
+    if args.to == "object" and app.STORAGE_BACKEND == "object" and (args.url or app.OBJECT_STORE_URL) == \
+            app.OBJECT_STORE_URL:
+        parser.error("The jobs must be copied to another object store, use --url.")
+
+    job_manager.initialize_db()
+    source = storage.get_storage()
+    target = storage.create_storage(args.to, args.path, args.url)
+    target.initialize()
+
+    copied = migrate(source, target, args.after, args.delete)
+    print("Migration completed, {} jobs copied. Set CSR_STORAGE={} and start the app.".format(copied, args.to))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
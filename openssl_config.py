@@ -0,0 +1,356 @@
+import ipaddress
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+class UnsupportedConfigError(Exception):
+    """ Raised when a config file uses OpenSSL features that can only be handled by the openssl binary """
+    pass
+
+
+class InvalidConfigError(Exception):
+    """ Raised when a config file contains mistakes that would make the generation fail, whichever backend is used.
+        The message lists every mistake, one per line. """
+
+    def __init__(self, errors: List[Dict]):
+        super().__init__("\n".join("Line {}: {}".format(error["line"], error["error"]) if "line" in error
+                                   else error["error"] for error in errors))
+        self._errors = errors
+
+    def get_errors(self) -> List[Dict]:
+        """ List of {"line": number, "error": message} dicts, without a line if the mistake isn't on a given line """
+        return self._errors
+
+
+class ReqConfig:
+    def __init__(self, subject: List[Tuple[str, str]], sans: List[Tuple[str, str]], digest: str):
+        self._subject = subject
+        self._sans = sans
+        self._digest = digest
+
+    def get_subject(self) -> List[Tuple[str, str]]:
+        """ List of (field, value) tuples, in the order they appear in the config file """
+        return self._subject
+
+    def get_sans(self) -> List[Tuple[str, str]]:
+        """ List of (type, value) tuples where type is one of DNS, IP, email or URI """
+        return self._sans
+
+    def get_digest(self) -> str:
+        return self._digest
+
+
+# Top level keys of the [req] part of the config that we know how to handle
+_SUPPORTED_REQ_KEYS = ["distinguished_name", "req_extensions", "prompt", "default_md", "default_bits",
+                       "string_mask", "utf8", "encrypt_key"]
+_SUPPORTED_DIGESTS = ["sha256", "sha384", "sha512"]
+_SUPPORTED_SAN_TYPES = ["DNS", "IP", "email", "URI"]
+DEFAULT_DIGEST = "sha256"
+
+# Lengths (min, max) openssl accepts for the subject fields, longer or shorter values make it fail
+# The country is a PrintableString, whose length is counted in bytes: only ASCII characters fit
+_ASCII_FIELDS = ["C", "countryName"]
+_FIELD_LENGTHS = {
+    "C": (2, 2),
+    "countryName": (2, 2),
+    "ST": (1, 128),
+    "stateOrProvinceName": (1, 128),
+    "L": (1, 128),
+    "localityName": (1, 128),
+    "O": (1, 64),
+    "organizationName": (1, 64),
+    "OU": (1, 64),
+    "organizationalUnitName": (1, 64),
+    "CN": (1, 64),
+    "commonName": (1, 64),
+    "emailAddress": (1, 128),
+}
+# Very simple regex to validate string somewhat looks like email.
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+# Host names, optionally with a wildcard as the first label. Internationalized names must use their punycode form.
+_DNS_PATTERN = re.compile(r"(\*\.)?[a-zA-Z0-9_-]+(\.[a-zA-Z0-9_-]+)*\.?")
+
+
+def _error(message: str, line: Optional[int] = None) -> Dict:
+    return {"error": message} if line is None else {"line": line, "error": message}
+
+
+def _parse_value(value: str, line: str) -> str:
+    """
+    Removes the quotes and the comment around a value, the way openssl reads it.
+
+    :raises UnsupportedConfigError: Raised if the value uses variable expansion, escapes or partial quoting
+    """
+    if value[:1] in ["\"", "'"]:
+        end = value.find(value[0], 1)
+        if end == -1 or value[end + 1:].strip()[:1] not in ["", "#"]:
+            raise UnsupportedConfigError("Unsupported quoting: {}".format(line))
+        value = value[1:end]
+    else:
+        value = value.split("#", 1)[0].rstrip()
+        if "$" in value or "\"" in value or "'" in value:
+            # Variable expansion and quotes in the middle of values are left to openssl
+            raise UnsupportedConfigError("Variable expansion and partial quoting are not supported: {}".format(line))
+    if "\\" in value:
+        raise UnsupportedConfigError("Escapes are not supported: {}".format(line))
+    return value
+
+
+def _parse_sections(contents: str, errors: List[Dict]) -> Dict[str, List[Tuple[str, str, int]]]:
+    """
+    Splits the contents of an OpenSSL config file into its sections.
+
+    :param contents: The contents of the config file
+    :param errors: The lines that openssl can't read are added to this list
+    :raises UnsupportedConfigError: Raised once the whole file has been read, if a line uses anything outside of the
+    supported subset
+    :return: A dict mapping the section name to a list of (key, value, line number) tuples. Keys found before the first
+    section header are stored under the "req" section, which is where openssl req looks for them.
+    """
+    sections: Dict[str, List[Tuple[str, str, int]]] = {"req": []}
+    current = sections["req"]
+    unsupported = None
+
+    for number, line in enumerate(contents.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        if line.startswith("["):
+            section_match = re.fullmatch(r"\[\s*([^\]]+?)\s*\]\s*(#.*)?", line)
+            if section_match:
+                current = sections.setdefault(section_match.group(1), [])
+            else:
+                errors.append(_error("Could not parse the section header: {}".format(line), number))
+                current = []  # The options of the section can't be used
+            continue
+
+        if "=" not in line:
+            errors.append(_error("Missing equal sign: {}".format(line), number))
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip()
+        if not key:
+            errors.append(_error("Missing option name: {}".format(line), number))
+            continue
+
+        try:
+            current.append((key, _parse_value(value.strip(), line), number))
+        except UnsupportedConfigError as e:
+            unsupported = unsupported or e
+
+    if unsupported is not None:
+        raise unsupported
+    return sections
+
+
+def _find_duplicates(entries: List[Tuple[str, str, int]], errors: List[Dict]):
+    """ Reports the keys set more than once in a section. Repeated subject fields must be numbered (1.OU) instead. """
+    seen = set()
+    for key, _, line in entries:
+        if key in seen:
+            errors.append(_error("{} is set more than once, only the last value would be used.".format(key), line))
+        seen.add(key)
+
+
+def _check_subject_field(field: str, value: str) -> Optional[str]:
+    """ Returns the reason why openssl would refuse the value of a subject field, None if it accepts it """
+    if not value:
+        return None  # Empty fields are skipped by openssl
+    if field in _ASCII_FIELDS and not value.isascii():
+        return "{} must only contain ASCII characters: {}".format(field, value)
+    if field in _FIELD_LENGTHS:
+        min_length, max_length = _FIELD_LENGTHS[field]
+        if min_length == max_length and len(value) != min_length:
+            return "{} must be exactly {} characters long: {}".format(field, min_length, value)
+        if not min_length <= len(value) <= max_length:
+            return "{} must be at most {} characters long: {}".format(field, max_length, value)
+    if field == "emailAddress" and not EMAIL_PATTERN.fullmatch(value):
+        return "Invalid email address: {}".format(value)
+    return None
+
+
+def _check_san(san_type: str, value: str) -> Optional[str]:
+    """
+    Returns the reason why a subject alternative name is invalid, None if it is valid.
+
+    :raises UnsupportedConfigError: Raised for the special values only openssl understands
+    """
+    if not value:
+        return "The {} subject alternative name is empty.".format(san_type)
+    if san_type == "DNS" and not _DNS_PATTERN.fullmatch(value):
+        return "Invalid DNS name: {}".format(value)
+    if san_type == "URI" and not value.isascii():
+        return "URIs must only contain ASCII characters, use the punycode form of the domain: {}".format(value)
+    if san_type == "IP":
+        try:
+            ipaddress.ip_address(value)
+        except ValueError:
+            return "Invalid IP address: {}".format(value)
+    if san_type == "email":
+        if value in ["copy", "move"]:
+            raise UnsupportedConfigError("Unsupported email subject alternative name: {}".format(value))
+        if not EMAIL_PATTERN.fullmatch(value):
+            return "Invalid email address: {}".format(value)
+    return None
+
+
+def _read_config(sections: Dict[str, List[Tuple[str, str, int]]], errors: List[Dict]) -> ReqConfig:
+    """ Builds a ReqConfig from the sections of a config file, adding the mistakes it contains to the errors """
+    # Like openssl, the last value of an option is used
+    req = {key: (value, line) for key, value, line in sections["req"]}
+
+    for key in req:
+        if key not in _SUPPORTED_REQ_KEYS:
+            raise UnsupportedConfigError("Unsupported option: {}".format(key))
+    if req.get("prompt", ("", None))[0] != "no":
+        raise UnsupportedConfigError("Only prompt=no configs are supported.")
+
+    digest = req.get("default_md", (DEFAULT_DIGEST, None))[0]
+    if digest not in _SUPPORTED_DIGESTS:
+        raise UnsupportedConfigError("Unsupported digest: {}".format(digest))
+
+    subject = []
+    dn_section, dn_line = req.get("distinguished_name", (None, None))
+    if dn_section is None:
+        errors.append(_error("The distinguished_name option is missing."))
+    elif dn_section not in sections:
+        errors.append(_error("The {} section is missing.".format(dn_section), dn_line))
+    else:
+        _find_duplicates(sections[dn_section], errors)
+        for key, value, line in sections[dn_section]:
+            # OpenSSL allows prefixing a field with "N." to repeat it, the prefix isn't part of the field name
+            field = re.sub(r"^\d+\.", "", key)
+            problem = _check_subject_field(field, value)
+            if problem is not None:
+                errors.append(_error(problem, line))
+            subject.append((field, value))
+        if not any(value for _, value in subject):
+            errors.append(_error("The {} section doesn't contain any field.".format(dn_section), dn_line))
+
+    sans = []
+    ext_section, ext_line = req.get("req_extensions", (None, None))
+    if ext_section is not None:
+        if ext_section not in sections:
+            errors.append(_error("The {} section is missing.".format(ext_section), ext_line))
+            return ReqConfig(subject, sans, digest)
+
+        for key, value, line in sections[ext_section]:
+            if key != "subjectAltName":
+                raise UnsupportedConfigError("Unsupported extension: {}".format(key))
+
+            if value.startswith("@"):
+                # Reference to a section listing the names, i.e. DNS.1 = domain.tld
+                san_section = value[1:].strip()
+                if san_section not in sections:
+                    errors.append(_error("The {} section is missing.".format(san_section), line))
+                    continue
+                _find_duplicates(sections[san_section], errors)
+                entries = [(re.sub(r"\.\d+$", "", k), v, n) for k, v, n in sections[san_section]]
+            else:
+                # Inline list, i.e. DNS:domain.tld, DNS:www.domain.tld
+                entries = []
+                for entry in value.split(","):
+                    if ":" not in entry:
+                        errors.append(_error("Missing value of the subject alternative name: {}".format(entry.strip()),
+                                             line))
+                        continue
+                    san_type, san_value = entry.split(":", 1)
+                    entries.append((san_type.strip(), san_value.strip(), line))
+
+            for san_type, san_value, san_line in entries:
+                if san_type not in _SUPPORTED_SAN_TYPES:
+                    raise UnsupportedConfigError("Unsupported subject alternative name: {}".format(san_type))
+                problem = _check_san(san_type, san_value)
+                if problem is not None:
+                    errors.append(_error(problem, san_line))
+                sans.append((san_type, san_value))
+
+    return ReqConfig(subject, sans, digest)
+
+
+def _sorted(errors: List[Dict]) -> List[Dict]:
+    """ Sorts the errors in the order of the lines, the ones about the whole file first """
+    return sorted(errors, key=lambda error: error.get("line", 0))
+
+
+def parse_config(contents: str) -> ReqConfig:
+    """
+    Parses and validates the subset of the OpenSSL req config format that this app produces.
+
+    :param contents: The contents of the config file
+    :raises InvalidConfigError: Raised if the config file contains mistakes, all of them are reported at once
+    :raises UnsupportedConfigError: Raised if the config file uses anything outside of the supported subset, and
+    contains no mistake that could be found
+    :return: A ReqConfig object
+    """
+    errors: List[Dict] = []
+    try:
+        config = _read_config(_parse_sections(contents, errors), errors)
+    except UnsupportedConfigError:
+        if errors:
+            raise InvalidConfigError(_sorted(errors)) from None
+        raise
+    if errors:
+        raise InvalidConfigError(_sorted(errors))
+    return config
+
+
+def validate_config(contents: str) -> List[Dict]:
+    """
+    Looks for the mistakes of a config file, before it is saved or generated.
+    The configs using options outside of the supported subset can only be fully checked by openssl, only the mistakes
+    found before reaching these options are reported for them.
+
+    :param contents: The contents of the config file
+    :return: List of {"line": number, "error": message} dicts, empty if no mistake was found
+    """
+    try:
+        parse_config(contents)
+    except InvalidConfigError as e:
+        return e.get_errors()
+    except UnsupportedConfigError:
+        pass
+    return []
+
+
+def _render_value(value: str) -> str:
+    """ Quotes a value if needed so that openssl reads it as is """
+    if any(c in value for c in "\"\\\r\n"):
+        raise ValueError("Values can't contain double quotes, backslashes or line breaks: {}".format(value))
+    if any(c in value for c in "#'$") or value != value.strip():
+        return '"{}"'.format(value)
+    return value
+
+
+def render_config(config: ReqConfig) -> str:
+    """
+    Writes the contents of the config file describing a CSR, which parse_config reads back as the same config.
+
+    :param config: The subject, subject alternative names and digest of the CSR
+    :raises ValueError: Raised if a value contains characters that can't be written in a config file
+    :return: The contents of the config file
+    """
+    lines = ["distinguished_name = req_distinguished_name"]
+    if config.get_sans():
+        lines.append("req_extensions = req_ext")
+    lines.append("prompt=no")
+    if config.get_digest() != DEFAULT_DIGEST:
+        lines.append("default_md = {}".format(config.get_digest()))
+
+    lines.append("[req_distinguished_name]")
+    counts: Dict[str, int] = {}
+    for field, value in config.get_subject():
+        # Repeated fields must be numbered, otherwise openssl only keeps the last one
+        count = counts.get(field, 0)
+        counts[field] = count + 1
+        lines.append("{}{} = {}".format("{}.".format(count) if count else "", field, _render_value(value)))
+
+    if config.get_sans():
+        lines += ["[req_ext]", "subjectAltName = @alt_names", "[alt_names]"]
+        counts = {}
+        for san_type, value in config.get_sans():
+            counts[san_type] = counts.get(san_type, 0) + 1
+            lines.append("{}.{} = {}".format(san_type, counts[san_type], _render_value(value)))
+
+    return "\n".join(lines)
@@ -0,0 +1,168 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+import app
+import metrics
+
+try:
+    import gevent.monkey
+except ImportError:
+    # Only needed when running under gunicorn's gevent workers
+    gevent = None
+
+# Names of the spans of a request, in the order they appear in the Server-Timing header
+SPAN_NAMES = ["db", "fs", "render"]
+
+# Time (seconds) spent in each span by the request being handled, None outside of requests or if PROFILING is off.
+# Context variables follow the request into the threads of io_pool.
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+# Innermost span of the request being handled: [name, time spent in the spans nested in it]
+_current_span: ContextVar[Optional[list]] = ContextVar("current_span", default=None)
+
+# Held while this process samples its stacks, a single profile runs at once
+_sampler_lock = threading.Lock()
+
+
+def start_request() -> None:
+    """ Starts recording the spans of the request being handled, if PROFILING is enabled """
+    if app.PROFILING:
+        _request_timings.set({})
+        _current_span.set(None)
+
+
+def get_server_timing(total: float) -> Optional[str]:
+    """
+    Returns the value of the Server-Timing header of the request being handled.
+
+    :param total: The time (seconds) taken by the request so far
+    :return: The duration of each span and the total in milliseconds, None if the spans weren't recorded
+    """
+    timings = _request_timings.get()
+    if timings is None:
+        return None
+    return ", ".join("{};dur={:.2f}".format(name, timings.get(name, 0) * 1000) for name in SPAN_NAMES) + \
+        ", total;dur={:.2f}".format(total * 1000)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """ Adds the time taken by the block to the span of the request being handled, one of SPAN_NAMES. The time of
+        spans nested in the block is only counted in the nested spans. Does nothing outside of requests. """
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+
+    parent = _current_span.get()
+    current = [name, 0.0]
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        timings[name] = timings.get(name, 0) + elapsed - current[1]
+        if parent is not None:
+            parent[1] += elapsed
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """ Records the time taken by a stage of the queue executor (claim, generate or persist), if PROFILING is
+        enabled """
+    if app.PROFILING:
+        metrics.observe("csr_executor_stage_seconds", seconds, stage=name)
+
+
+def _is_patched(module: str) -> bool:
+    return gevent is not None and gevent.monkey.is_module_patched(module)
+
+
+def _original(module: str, name: str):
+    """ Returns a function of the standard library as it was before gevent patched it """
+    if _is_patched(module):
+        return gevent.monkey.get_original(module, name)
+    return getattr(sys.modules[module], name)
+
+
+def _fold(frame, thread_name: str) -> str:
+    """ Formats a stack as a line of the folded format read by flame graph tools, the root frame first """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def _sample(duration: float, stacks: Counter, done: List[bool]) -> None:
+    """ Samples the stacks of every thread of the process every PROFILER_INTERVAL seconds, for some time """
+    sleep = _original("time", "sleep")
+    own_id = _original("_thread", "get_ident")()
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            # Under gevent, the threading module lists greenlets, the threads are only known by their id
+            names = {} if _is_patched("threading") else {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[_fold(frame, names.get(thread_id, "thread-{}".format(thread_id)))] += 1
+            sleep(app.PROFILER_INTERVAL)
+    finally:
+        done.append(True)
+
+
+def _start_native_thread(target, *args) -> None:
+    """ Starts a thread of the operating system. Under gevent, threads started with the threading module are
+        greenlets, which only run when the others yield and can't sample them. """
+    _original("_thread", "start_new_thread")(target, args)
+
+
+def format_stacks(stacks: Counter) -> str:
+    """ Formats sampled stacks in the folded format: one "frame;frame;frame count" line per stack, which flamegraph.pl
+        and speedscope read """
+    return "".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common())
+
+
+def profile(duration: float) -> Optional[str]:
+    """
+    Samples the stacks of the threads of this process for some time. The stacks are sampled from a thread of their
+    own, the time the caller waits is spent sleeping (cooperatively under gevent). Under gevent, the stack of the main
+    thread is the one of the greenlet running at the time, or the hub's when all of them are waiting.
+
+    :param duration: The time (seconds) during which the stacks are sampled
+    :return: The sampled stacks in the folded format, None if the process is already being profiled
+    """
+    if not _sampler_lock.acquire(blocking=False):
+        return None
+    try:
+        stacks: Counter = Counter()
+        done: List[bool] = []
+        _start_native_thread(_sample, duration, stacks, done)
+        time.sleep(duration)
+        while not done:
+            time.sleep(app.PROFILER_INTERVAL)
+        return format_stacks(stacks)
+    finally:
+        _sampler_lock.release()
+
+
+def profile_to_file(duration: float, path: str) -> None:
+    """ Samples the stacks of this process in the background and writes them to a file once done, see #profile """
+    def run():
+        stacks = profile(duration)
+        if stacks is None:
+            return  # Already being profiled, the caller gives up waiting for the file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(stacks)
+        os.replace(tmp_path, path)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -1,79 +1,930 @@
+import math
+import multiprocessing
 import os
+import re
+import select
+import signal
+import socket
 import sqlite3
-import subprocess
 import threading
 import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Set, Tuple
 
 import app
+import csr_engine
+import database
+import io_pool
 import job_manager
+import key_pool
+import metrics
+import profiling
 from job_manager import JobStatus
 
 
+# Last timestamp given to a queued job by this process, so that timestamps never go backwards
+_last_timestamp = 0.0
+_timestamp_lock = threading.Lock()
+
+
+def _next_timestamp() -> float:
+    global _last_timestamp
+    with _timestamp_lock:
+        _last_timestamp = max(time.time(), _last_timestamp + 0.000001)
+        return _last_timestamp
+
+
+def _get_lane(key_algorithm: str, key_size: int) -> str:
+    """ Returns the lane of the queue used by the jobs with this kind of key: the key size for RSA keys, the
+        algorithm for the others """
+    if key_algorithm == csr_engine.KEY_ALGORITHM_RSA:
+        return str(key_size)
+    return key_algorithm
+
+
 class QueueExecutor(threading.Thread):
+    """ Takes the jobs from the queue table and hands them out to a pool of generation worker processes.
+        A job is claimed atomically with a lease before being handed out, so several executors (in other processes or
+        on other nodes sharing the database) can work on the same queue. The lease is renewed while the job is being
+        generated. If an executor dies, its leases expire and the jobs are claimed again, until a job reaches
+        QUEUE_MAX_ATTEMPTS attempts and is marked as an error.
+        When the queue is empty, idle workers refill the pool of pre-generated keys.
+        The executor sleeps until it is notified through a local socket that a job was queued, possibly by another
+        process. The queue is still checked periodically in case a notification is missed.
+
+        The order in which jobs are claimed depends on QUEUE_POLICY. With "fifo", jobs are claimed by priority, then
+        in the order they were queued. With "fair", each kind of key has its own lane and the lane whose next job has
+        the highest priority is served first, then the lane with the fewest jobs being generated. Within a lane, jobs
+        are claimed by priority, then by turn: the jobs of a batch take consecutive turns starting from the turn the
+        lane is at, so batches queued at the same time alternate and a job queued alone waits for at most one job of
+        each batch. In both cases, a lane never uses more than its QUEUE_LANE_LIMITS workers so that slow 4096 bits jobs
+        can't hold up every worker.
+
+        A job that runs for longer than GENERATION_TIMEOUT, or that is cancelled while it runs, is aborted. If the job
+        is generated by openssl, only its openssl process is killed and the worker reports the failure. Otherwise (the
+        cryptography backend runs in the worker itself), the workers of a process pool can't be stopped one by one, so
+        all of them are stopped and a new pool is started. The other jobs that were running are released and claimed
+        again, without counting as an attempt (counted by csr_jobs_released_total).
+        If a worker dies (killed, out of memory), the pool is broken: it is replaced by a new one and the jobs that were
+        running are released. Since the job that killed its worker can't be told apart from the others, their attempt
+        still counts, so that a job that keeps killing its worker ends up marked as an error. """
+
+    # Reasons for aborting a job. A released job was stopped because of another job or because the executor is
+    # stopping, it is generated again later.
+    ABORT_TIMEOUT = "timeout"
+    ABORT_CANCELLED = "cancelled"
+    ABORT_RELEASED = "released"
+    # A worker of the pool died while the job was being generated, the job is generated again later
+    ABORT_CRASHED = "crashed"
+
+    # Bounds (seconds) of the time clients are asked to wait when the queue is full, and the time used when the
+    # generation rate is unknown
+    RETRY_AFTER_MIN = 1
+    RETRY_AFTER_MAX = 3600
+    RETRY_AFTER_UNKNOWN = 60
+    # Time (seconds) a profile of the executor may take to be written, on top of its duration. The executor picks up the
+    # request as soon as it waits for a job or a worker.
+    PROFILE_ANSWER_DELAY = 5
+    # Time (seconds) a worker has to report a job once its openssl process was killed, before the workers are restarted
+    KILL_GRACE = 2
+
     def __init__(self):
         super().__init__()
         self._stop_flag = threading.Event()
+        # Set whenever a worker finishes a job, so that we can hand out the next job right away
+        self._wake_flag = threading.Event()
+        # Identifies the leases held by this executor
+        self._owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._last_lease_renewal = time.time()
+        # Socket receiving the notifications sent by #notify, None if it couldn't be created
+        self._socket: Optional[socket.socket] = None
+        # Inode of the socket's file, so that the file is only removed if it is still ours
+        self._socket_inode: Optional[int] = None
+
+        # Ids of the jobs currently being generated by the workers, with their lane
+        self._in_flight: Dict[str, str] = {}
+        # Time (time.monotonic) at which each job being generated is aborted
+        self._deadlines: Dict[str, float] = {}
+        # Jobs whose worker was stopped, with the reason (one of the ABORT_ constants)
+        self._aborted: Dict[str, str] = {}
+        # Number of pool keys currently being generated by the workers, by key size
+        self._pool_pending: Dict[int, int] = {key_size: 0 for key_size in key_pool.POOL_KEY_SIZES}
+        # Key sizes for which the pool went below the low watermark and is being refilled up to the high watermark
+        self._pool_refilling: Set[int] = set()
+        # Slot of each job being generated in #_openssl_pids, and the slots not used by any job
+        self._slots: Dict[str, int] = {}
+        self._free_slots: List[int] = list(range(app.WORKER_COUNT))
+        self._in_flight_lock = threading.Lock()
+        # Pid of the openssl process run by the workers for each slot, 0 while none runs. Written by the workers.
+        self._openssl_pids = self._get_context().Array("i", app.WORKER_COUNT, lock=False)
+        # Set when a worker of the pool died, the pool must be replaced
+        self._pool_broken = threading.Event()
 
         # Initialize the queue table if needed
-        with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+        with database.connection() as conn:
             db = conn.cursor()
-            db.execute("CREATE TABLE IF NOT EXISTS queue (job_id TEXT NOT NULL, timestamp INT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS queue (job_id TEXT NOT NULL, timestamp REAL NOT NULL,"
+                       "owner TEXT,"
+                       "lease_expires REAL,"
+                       "attempts INT NOT NULL DEFAULT 0,"
+                       "priority INT NOT NULL DEFAULT 0,"
+                       "lane TEXT,"
+                       "batch TEXT,"
+                       "turn INT NOT NULL DEFAULT 0,"
+                       "cancel_requested INT NOT NULL DEFAULT 0)")
+            # Queue tables created before leases existed
+            database.add_column_if_missing(db, "queue", "owner", "TEXT")
+            database.add_column_if_missing(db, "queue", "lease_expires", "REAL")
+            database.add_column_if_missing(db, "queue", "attempts", "INT NOT NULL DEFAULT 0")
+            # Queue tables created before priorities and lanes existed
+            database.add_column_if_missing(db, "queue", "priority", "INT NOT NULL DEFAULT 0")
+            database.add_column_if_missing(db, "queue", "lane", "TEXT")
+            database.add_column_if_missing(db, "queue", "batch", "TEXT")
+            database.add_column_if_missing(db, "queue", "turn", "INT NOT NULL DEFAULT 0")
+            db.execute("SELECT queue.job_id, jobs.key_algorithm, jobs.key_size FROM queue "
+                       "LEFT JOIN jobs ON jobs.id = queue.job_id WHERE queue.lane IS NULL")
+            for job_id, key_algorithm, key_size in db.fetchall():
+                if key_size is None:
+                    db.execute("DELETE FROM queue WHERE job_id=?", (job_id,))
+                else:
+                    db.execute("UPDATE queue SET lane=?, batch=? WHERE job_id=?",
+                               (_get_lane(key_algorithm, key_size), job_id, job_id))
+            # Queue tables created before jobs could be cancelled
+            database.add_column_if_missing(db, "queue", "cancel_requested", "INT NOT NULL DEFAULT 0")
+            # Used by the "fair" and "fifo" policies to find the next job to claim, and to find the last turn of a batch
+            db.execute("CREATE INDEX IF NOT EXISTS queue_lane_order ON queue (lane, priority DESC, turn, timestamp)")
+            db.execute("CREATE INDEX IF NOT EXISTS queue_order ON queue (priority DESC, timestamp)")
+            db.execute("CREATE INDEX IF NOT EXISTS queue_batch ON queue (lane, batch, turn)")
+            # A job is queued once, a second row would have it claimed and generated twice. Queue tables created before
+            # the index may hold duplicates, only the first row of each job is kept.
+            db.execute("DROP INDEX IF EXISTS queue_job_id")
+            db.execute("DELETE FROM queue WHERE rowid NOT IN (SELECT MIN(rowid) FROM queue GROUP BY job_id)")
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS queue_job_id_unique ON queue (job_id)")
+            # Jobs generated during the last QUEUE_RATE_WINDOW seconds, used to estimate the generation rate
+            db.execute("CREATE TABLE IF NOT EXISTS queue_history (lane TEXT NOT NULL, finished_at REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS queue_history_finished_at ON queue_history (finished_at)")
             conn.commit()
 
     def run(self):
-        conn = sqlite3.connect(app.SQLITE_DB_PATH)
-        db = conn.cursor()
+        self._socket = self._open_socket()
+        # Transactions are handled manually so that claims can use BEGIN IMMEDIATE
+        conn = database.connect(isolation_level=None)
+        pool = self._start_pool()
         while not self._stop_flag.is_set():
-            db.execute("SELECT job_id FROM queue ORDER BY timestamp LIMIT 1")
-            rows = db.fetchall()
-            if len(rows) > 0:
-                # Check that there actually is a job in the queue
+            self._wake_flag.clear()
+            self._renew_leases(conn)
+
+            if self._pool_broken.is_set():
+                print("A generation worker died, the workers are restarted.")
+                pool = self._restart_pool(pool, {})
+
+            aborted = self._find_jobs_to_abort(conn)
+            if aborted:
+                pool = self._abort_jobs(pool, aborted)
+
+            claimed = None
+            worker_available = self._busy_count() < app.WORKER_COUNT
+            if worker_available:
+                claim_started = time.perf_counter()
+                claimed = self._claim_next_job(conn)
 
-                job_id = rows[0][0]  # Only 1 row since we specified LIMIT 1
+            if claimed is not None:
+                self._dispatch(pool, *claimed)
+                profiling.record_stage("claim", time.perf_counter() - claim_started)
+            elif worker_available and self._refill_key_pool(pool):
+                # Queue is empty, a worker was given a pool key to generate instead
+                continue
+            else:
+                # If queue was empty or all workers are busy, sleep until a job is queued, a worker is available
+                # again or the executor is stopped
+                # Wake up in time to renew the leases of the jobs being generated, and to abort the jobs that time out
+                self._wait(min(app.QUEUE_POLL_INTERVAL, app.QUEUE_LEASE_DURATION / 3, self._time_to_next_deadline()))
+
+        # Interrupt the jobs in progress instead of waiting for them, they are generated again once an executor runs
+        self._stop_pool(pool, {})
+        conn.close()
+
+        if self._socket is not None:
+            self._socket.close()
+            self._remove_socket()
+
+    def stop(self):
+        """ Stops the executor. The jobs being generated are interrupted and put back in the queue. """
+        self._stop_flag.set()
+        self._wake()
 
-                rsa_key_size = job_manager.get_job(job_id).get_key_size()
+    @staticmethod
+    def _get_context() -> multiprocessing.context.BaseContext:
+        """ Returns the context the workers are started with. The workers aren't forked from this process, which may be
+            the gunicorn master: forking it would copy its threads, locks and connections, and the web workers it forks
+            later would inherit the pool's processes. They are forked from a forkserver process that only imported
+            csr_engine, or spawned where forkserver isn't available. """
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["csr_engine"])
+            return context
+        return multiprocessing.get_context("spawn")
 
-                folder_path = os.path.join(app.JOBS_FOLDER_PATH, job_id)
-                conf_path = os.path.join(folder_path, "{}.conf".format(job_id))
-                key_path = os.path.join(folder_path, "{}.key".format(job_id))
-                csr_path = os.path.join(folder_path, "{}.csr".format(job_id))
+    def _start_pool(self) -> ProcessPoolExecutor:
+        """ Starts a pool of workers """
+        return ProcessPoolExecutor(max_workers=app.WORKER_COUNT, mp_context=self._get_context(),
+                                   initializer=csr_engine.init_worker, initargs=(self._openssl_pids,))
 
-                cmd = "openssl req -new -newkey rsa:{} -nodes -keyout {} -out {} -config {}"\
-                    .format(rsa_key_size, key_path, csr_path, conf_path)
-                try:
-                    # use check_output so that output isn't printed to console
-                    subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+    def _stop_pool(self, pool: ProcessPoolExecutor, aborted: Dict[str, str]):
+        """
+        Stops all the workers of a pool right away.
 
-                    # Clear the error_message field in case it contains old message, set status to generated
-                    job_manager.set_job_error_message(job_id, None)
-                    job_manager.set_job_status(job_id, JobStatus.GENERATED)
+        :param pool: The pool to stop
+        :param aborted: The reason each aborted job is stopped for, the other jobs being generated are released
+        """
+        with self._in_flight_lock:
+            released = [job_id for job_id in self._in_flight if job_id not in aborted]
+            for job_id in self._in_flight:
+                self._aborted[job_id] = aborted.get(job_id, QueueExecutor.ABORT_RELEASED)
+        if released:
+            metrics.inc("csr_jobs_released_total", len(released))
 
-                except subprocess.CalledProcessError as e:
-                    # Error creating the CSR and key file
-                    # Setting the job status and saving error message
-                    job_manager.set_job_error_message(job_id, e.output.decode("utf-8"))
-                    job_manager.set_job_status(job_id, JobStatus.ERROR)
-                    print("Error code: {}  -  message: {}".format(e.returncode, e.output.decode("utf-8")))
+        # ProcessPoolExecutor has no public way to stop its workers
+        processes = list((pool._processes or {}).values())
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                # Stuck in native code, the signal handler can't run
+                process.kill()
+        # The futures of the stopped workers fail, which calls #_finish_job for each job
+        pool.shutdown(wait=True, cancel_futures=True)
 
-                db.execute("DELETE FROM queue WHERE job_id = ?", (job_id,))
-                conn.commit()
+    def _restart_pool(self, pool: ProcessPoolExecutor, aborted: Dict[str, str]) -> ProcessPoolExecutor:
+        """ Stops all the workers of a pool to abort some jobs, and returns a new pool """
+        for job_id, reason in aborted.items():
+            print("Aborting job {} ({}), the workers are restarted.".format(job_id, reason))
+        self._stop_pool(pool, aborted)
+        # The futures of the old pool failed when it was stopped, which isn't a crash of the new one
+        self._pool_broken.clear()
+        return self._start_pool()
 
+    def _abort_jobs(self, pool: ProcessPoolExecutor, aborted: Dict[str, str]) -> ProcessPoolExecutor:
+        """ Aborts jobs that timed out or were cancelled, and returns the pool to use from now on. The openssl process
+            of a job is killed alone, the workers are only restarted for the jobs that don't run openssl. """
+        remaining = {}
+        for job_id, reason in aborted.items():
+            if self._kill_openssl(job_id, reason):
+                print("Aborting job {} ({}), its openssl process is stopped.".format(job_id, reason))
             else:
-                # If queue was empty, sleep for 5 seconds and check again
-                i = 0
-                # Instead of sleeping 5 seconds, sleep 1 second 5 times so that we can stop quicker if the
-                # stop flag is set, instead of having to wait the whole 5 seconds.
-                while i < 5 and not self._stop_flag.is_set():
-                    time.sleep(1)
-                    i += 1
+                remaining[job_id] = reason
+        if remaining:
+            pool = self._restart_pool(pool, remaining)
+        return pool
 
-    def stop(self):
-        self._stop_flag.set()
+    def _kill_openssl(self, job_id: str, reason: str) -> bool:
+        """
+        Kills the openssl process generating a job, its worker then reports the job as failed.
+
+        :return: False if no openssl process runs for the job, or if it was already killed but the worker didn't report
+            the job within KILL_GRACE
+        """
+        with self._in_flight_lock:
+            slot = self._slots.get(job_id)
+            if slot is None or job_id in self._aborted:
+                return False
+            pid = self._openssl_pids[slot]
+            if pid == 0:
+                return False
+            self._aborted[job_id] = reason
+            self._deadlines[job_id] = time.monotonic() + QueueExecutor.KILL_GRACE
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # openssl just finished, the worker reports the job anyway
+        return True
+
+    def _find_jobs_to_abort(self, conn: sqlite3.Connection) -> Dict[str, str]:
+        """ Returns the jobs being generated that timed out or were cancelled, with the reason. A job that is already
+            being aborted is only returned again once its deadline passed. """
+        now = time.monotonic()
+        with self._in_flight_lock:
+            job_ids = [job_id for job_id in self._in_flight if job_id not in self._aborted]
+            aborted = {job_id: self._aborted.get(job_id, QueueExecutor.ABORT_TIMEOUT)
+                       for job_id, deadline in self._deadlines.items() if deadline <= now}
+        if not job_ids:
+            return aborted
+
+        rows = conn.execute("SELECT job_id FROM queue WHERE cancel_requested=1 AND owner=? AND job_id IN ({})".format(
+            ",".join("?" * len(job_ids))), [self._owner] + job_ids).fetchall()
+        aborted.update({job_id: QueueExecutor.ABORT_CANCELLED for job_id, in rows if job_id not in aborted})
+        return aborted
+
+    def _time_to_next_deadline(self) -> float:
+        with self._in_flight_lock:
+            if not self._deadlines:
+                return app.QUEUE_POLL_INTERVAL
+            return max(0.0, min(self._deadlines.values()) - time.monotonic())
+
+    def _open_socket(self) -> Optional[socket.socket]:
+        """ Creates the socket listening for notifications, returns None if it can't be created or if another executor
+            on this machine already listens on it """
+        if os.path.exists(app.QUEUE_SOCKET_PATH):
+            if QueueExecutor._is_socket_alive():
+                print("Another executor listens on {}, the queue will be polled instead.".format(
+                    app.QUEUE_SOCKET_PATH))
+                return None
+            try:
+                os.remove(app.QUEUE_SOCKET_PATH)  # Left behind if the app didn't stop cleanly
+            except FileNotFoundError:
+                pass
+
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(app.QUEUE_SOCKET_PATH)
+            sock.setblocking(False)
+            self._socket_inode = os.stat(app.QUEUE_SOCKET_PATH).st_ino
+            return sock
+        except (OSError, AttributeError) as e:
+            # AF_UNIX isn't available on every platform, fall back to checking the queue periodically
+            print("Could not create the queue notification socket, the queue will be polled instead: {}".format(e))
+            return None
+
+    @staticmethod
+    def _is_socket_alive() -> bool:
+        """ Returns whether a process listens on the socket's file, which isn't the case if it was left behind """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.connect(app.QUEUE_SOCKET_PATH)
+            return True
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        except OSError:
+            # Not allowed to use it, don't take it over either
+            return True
+
+    def _remove_socket(self):
+        """ Removes the socket's file, unless another executor replaced it since it was created """
+        try:
+            if os.stat(app.QUEUE_SOCKET_PATH).st_ino == self._socket_inode:
+                os.remove(app.QUEUE_SOCKET_PATH)
+        except FileNotFoundError:
+            pass
+
+    def _wake(self):
+        """ Wakes up the executor thread from within this process """
+        self._wake_flag.set()
+        if self._socket is not None:
+            QueueExecutor.notify()
+
+    def _wait(self, timeout: float):
+        """ Sleeps until the executor is woken up or the timeout is reached """
+        if self._socket is None:
+            self._wake_flag.wait(timeout)
+            return
+
+        if not self._wake_flag.is_set():
+            select.select([self._socket], [], [], timeout)
+
+        # Empty the socket, a single check of the queue handles all the notifications received so far
+        try:
+            while True:
+                message = self._socket.recv(256)
+                if message.startswith(b"profile "):
+                    self._start_profile(message.decode())
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _start_profile(message: str):
+        """ Starts sampling the stacks of this process, as requested by #profile """
+        match = re.fullmatch(r"profile ([0-9.]+) ([0-9a-f]{32})", message)
+        if not app.PROFILING or match is None:
+            return
+        # Only the name of the file is sent, so that other processes can't have the executor write anywhere else
+        profiling.profile_to_file(float(match.group(1)), os.path.join(app.PROFILES_PATH, match.group(2) + ".folded"))
+
+    def _busy_count(self) -> int:
+        """ Returns the number of workers currently generating a job or a pool key """
+        with self._in_flight_lock:
+            return len(self._in_flight) + sum(self._pool_pending.values())
+
+    def _full_lanes(self) -> Set[str]:
+        """ Returns the lanes that already use as many workers as they are allowed to """
+        with self._in_flight_lock:
+            running: Dict[str, int] = {}
+            for lane in self._in_flight.values():
+                running[lane] = running.get(lane, 0) + 1
+        return {lane for lane, limit in app.QUEUE_LANE_LIMITS.items() if running.get(lane, 0) >= limit}
+
+    def _find_next_job(self, db: sqlite3.Cursor, now: float) -> Optional[Tuple[int, str, float, int, str]]:
+        """
+        Finds the next job to claim according to QUEUE_POLICY, among the jobs that aren't leased by an executor or
+        whose lease expired.
+
+        :return: The rowid, id, timestamp, number of attempts and lane of the job, None if there is no job to claim
+        """
+        full_lanes = self._full_lanes()
+        if app.QUEUE_POLICY == "fifo":
+            db.execute("SELECT rowid, job_id, timestamp, attempts, lane FROM queue "
+                       "WHERE (owner IS NULL OR lease_expires < ?) AND lane NOT IN ({}) "
+                       "ORDER BY priority DESC, timestamp, rowid LIMIT 1".format(",".join("?" * len(full_lanes))),
+                       [now] + list(full_lanes))
+            return db.fetchone()
+
+        with self._in_flight_lock:
+            running = list(self._in_flight.values())
+        best = None
+        best_key = None
+        # Go through the lanes with the index instead of scanning the queue
+        db.execute("SELECT MIN(lane) FROM queue")
+        lane = db.fetchone()[0]
+        while lane is not None:
+            if lane not in full_lanes:
+                db.execute("SELECT rowid, job_id, timestamp, attempts, lane, priority FROM queue "
+                           "WHERE lane = ? AND (owner IS NULL OR lease_expires < ?) "
+                           "ORDER BY priority DESC, turn, timestamp, rowid LIMIT 1", (lane, now))
+                row = db.fetchone()
+                if row is not None:
+                    # Highest priority first, then the lane with the fewest running jobs, then the oldest job
+                    key = (-row[5], running.count(lane), row[2])
+                    if best_key is None or key < best_key:
+                        best, best_key = row[:5], key
+            db.execute("SELECT MIN(lane) FROM queue WHERE lane > ?", (lane,))
+            lane = db.fetchone()[0]
+        return best
+
+    def _claim_next_job(self, conn: sqlite3.Connection) -> Optional[Tuple[str, float, str]]:
+        """
+        Claims the next job in the queue according to QUEUE_POLICY.
+        Jobs that already reached the maximum number of attempts are marked as errors instead.
+
+        :return: The id of the claimed job, the time it was queued at and its lane, None if there is no job to claim
+        """
+        while True:
+            now = time.time()
+            db = conn.cursor()
+            # Lock the database for writing right away so that no other executor can claim the same job
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._find_next_job(db, now)
+                if row is None:
+                    db.execute("COMMIT")
+                    return None
+
+                rowid, job_id, queued_at, attempts, lane = row
+                if attempts >= app.QUEUE_MAX_ATTEMPTS:
+                    # The executors working on this job kept dying, give up on it
+                    db.execute("DELETE FROM queue WHERE rowid = ?", (rowid,))
+                    db.execute("UPDATE jobs SET status=?, error_message=?, version=version+1, updated_at=? WHERE id=?",
+                               (JobStatus.ERROR.value, "The generation of this job was interrupted {} times, "
+                                                       "giving up.".format(attempts), now, job_id))
+                    db.execute("COMMIT")
+                    print("Job {} reached the maximum number of attempts and was marked as an error.".format(job_id))
+                    continue
+
+                db.execute("UPDATE queue SET owner=?, lease_expires=?, attempts=attempts+1 WHERE rowid=?",
+                           (self._owner, now + app.QUEUE_LEASE_DURATION, rowid))
+                db.execute("COMMIT")
+                return job_id, queued_at, lane
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def _renew_leases(self, conn: sqlite3.Connection):
+        """ Extends the leases of the jobs being generated by this executor, at most every third of the lease """
+        now = time.time()
+        if now - self._last_lease_renewal < app.QUEUE_LEASE_DURATION / 3:
+            return
+        self._last_lease_renewal = now
+
+        with self._in_flight_lock:
+            if not self._in_flight:
+                return
+        conn.execute("UPDATE queue SET lease_expires=? WHERE owner=?", (now + app.QUEUE_LEASE_DURATION, self._owner))
+
+    def _owns_job(self, job_id: str) -> bool:
+        """ Returns whether this executor still holds the lease of a job """
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("SELECT 1 FROM queue WHERE job_id=? AND owner=?", (job_id, self._owner))
+            return db.fetchone() is not None
+
+    def _dispatch(self, pool: ProcessPoolExecutor, job_id: str, queued_at: float, lane: str):
+        """ Submits the generation of a job to the worker pool """
+        try:
+            job = job_manager.get_job(job_id)
+        except (ValueError, FileNotFoundError):
+            # Job was deleted while it was in the queue, nothing to generate
+            self._remove_from_queue(job_id)
+            return
+
+        with self._in_flight_lock:
+            self._in_flight[job_id] = lane
+            # Left over if the job completed while its worker was being stopped
+            self._aborted.pop(job_id, None)
+            # The worker stops openssl itself after GENERATION_TIMEOUT, leave it time to report it
+            self._deadlines[job_id] = time.monotonic() + app.GENERATION_TIMEOUT + 2
+            slot = self._free_slots.pop()
+            self._slots[job_id] = slot
+            self._openssl_pids[slot] = 0
+
+        labels = {"backend": app.GENERATION_BACKEND, "key_algorithm": job.get_key_algorithm(),
+                  "key_size": job.get_key_size()}
+        metrics.observe("csr_queue_wait_seconds", max(0.0, time.time() - queued_at), **labels)
+
+        # Use a pre-generated key if one is available so that the worker only has to sign the CSR. Only RSA keys are
+        # pooled, the others are generated faster than a key can be read from the pool.
+        key_pem = None
+        if job.get_key_algorithm() == csr_engine.KEY_ALGORITHM_RSA:
+            key_pem = key_pool.take_key(job.get_key_size())
+
+        started = time.monotonic()
+        try:
+            future = pool.submit(csr_engine.generate_job, slot, job.get_config_contents(), job.get_key_size(),
+                                 app.GENERATION_BACKEND, key_pem, job.get_key_algorithm(), app.GENERATION_TIMEOUT)
+        except BrokenProcessPool:
+            # A worker died since the last check, the job wasn't started: put it and its key back
+            if key_pem is not None:
+                key_pool.add_key(job.get_key_size(), key_pem)
+            self._finish_aborted_job(job_id, QueueExecutor.ABORT_RELEASED)
+            self._pool_crashed()
+            return
+        future.add_done_callback(lambda f: self._finish_job(job_id, f, started, labels))
+
+    def _refill_key_pool(self, pool: ProcessPoolExecutor) -> bool:
+        """
+        Submits the generation of a pool key if the pool needs one.
+
+        :return: True if a key generation was submitted
+        """
+        depth = key_pool.get_depth()
+        refill_size = None
+        with self._in_flight_lock:
+            for key_size in key_pool.POOL_KEY_SIZES:
+                count = depth[key_size] + self._pool_pending[key_size]
+                if count < app.KEY_POOL_LOW:
+                    self._pool_refilling.add(key_size)
+                if key_size not in self._pool_refilling:
+                    continue
+                if count >= app.KEY_POOL_HIGH:
+                    self._pool_refilling.discard(key_size)
+                    continue
+                refill_size = key_size
+                self._pool_pending[key_size] += 1
+                break
+        if refill_size is None:
+            return False
+
+        # Submitted without holding the lock: if the future is already done, the callback runs right away and takes it
+        try:
+            future = pool.submit(csr_engine.generate_key, refill_size)
+        except BrokenProcessPool:
+            with self._in_flight_lock:
+                self._pool_pending[refill_size] -= 1
+            self._pool_crashed()
+            return False
+        future.add_done_callback(lambda f: self._finish_pool_key(refill_size, f))
+        return True
+
+    def _finish_pool_key(self, key_size: int, future: Future):
+        """ Adds a key generated by a worker to the pool. Called from the pool's thread when the worker is done. """
+        try:
+            key_pool.add_key(key_size, future.result())
+        except BrokenProcessPool:
+            # A worker died, or the workers were stopped to abort a job or because the executor is stopping
+            self._pool_crashed()
+        except Exception as e:
+            print("Error generating a {} bits pool key  -  message: {}".format(key_size, e))
+        finally:
+            with self._in_flight_lock:
+                self._pool_pending[key_size] -= 1
+            self._wake()
+
+    def _pool_crashed(self):
+        """ Has the executor thread replace the pool, whose workers can't be used anymore """
+        self._pool_broken.set()
+        self._wake()
+
+    def _job_done(self, job_id: str):
+        """ Frees the worker of a job """
+        with self._in_flight_lock:
+            self._in_flight.pop(job_id, None)
+            self._deadlines.pop(job_id, None)
+            slot = self._slots.pop(job_id, None)
+            if slot is not None:
+                self._free_slots.append(slot)
+        self._wake()
+
+    def _finish_aborted_job(self, job_id: str, reason: str):
+        """ Updates a job whose worker was stopped. Called from the pool's thread. """
+        try:
+            if reason == QueueExecutor.ABORT_RELEASED:
+                # Give the job back to the queue, the interruption wasn't caused by the job itself
+                with database.connection() as conn:
+                    conn.execute("UPDATE queue SET owner=NULL, lease_expires=NULL, attempts=MAX(attempts-1, 0) "
+                                 "WHERE job_id=? AND owner=?", (job_id, self._owner))
+                return
+            if reason == QueueExecutor.ABORT_CRASHED:
+                # Give the job back to the queue, the attempt counts in case the job itself killed the worker
+                with database.connection() as conn:
+                    conn.execute("UPDATE queue SET owner=NULL, lease_expires=NULL WHERE job_id=? AND owner=?",
+                                 (job_id, self._owner))
+                return
+
+            if self._owns_job(job_id):
+                if reason == QueueExecutor.ABORT_TIMEOUT:
+                    job_manager.set_job_result(job_id, JobStatus.ERROR, "The generation of this job took longer than "
+                                                                        "{:g} seconds and was stopped."
+                                               .format(app.GENERATION_TIMEOUT))
+                    print("Job {} timed out.".format(job_id))
+                else:
+                    # Cancelled, the job can be edited and generated again
+                    job_manager.set_job_result(job_id, JobStatus.CREATED, None)
+                self._remove_from_queue(job_id)
+        finally:
+            self._job_done(job_id)
+
+    def _finish_job(self, job_id: str, future: Future, started: float, labels: Dict[str, object]):
+        """ Saves the result of a worker. Called from the pool's thread when the worker is done. """
+        with self._in_flight_lock:
+            reason = self._aborted.pop(job_id, None)
+            lane = self._in_flight.get(job_id)
+        if reason is None and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            # The worker of this job, or of another one, died
+            print("The worker generating job {} died, the job is put back in the queue.".format(job_id))
+            reason = QueueExecutor.ABORT_CRASHED
+            self._pool_crashed()
+        if reason is not None:
+            self._finish_aborted_job(job_id, reason)
+            return
+
+        metrics.observe("csr_generation_duration_seconds", time.monotonic() - started, **labels)
+        profiling.record_stage("generate", time.monotonic() - started)
+        persist_started = time.perf_counter()
+        if not self._owns_job(job_id):
+            # The lease expired and another executor claimed the job (or it was deleted), the result is discarded
+            self._job_done(job_id)
+            return
+
+        try:
+            key_pem, csr_pem = future.result()
+
+            job_manager.write_job_files(job_id, key_pem, csr_pem)
+
+            # Clear the error_message field in case it contains old message, set status to generated
+            if not job_manager.set_job_result(job_id, JobStatus.GENERATED, None):
+                # Deleted while its files were being written, which the deletion may have missed
+                job_manager.delete_job_files(job_id)
+                return
+            metrics.inc("csr_jobs_total", result="generated", **labels)
+
+        except Exception as e:
+            # Error creating the CSR and key file (GenerationError), or the worker itself failed
+            # Setting the job status and saving error message
+            job_manager.set_job_result(job_id, JobStatus.ERROR, str(e))
+            metrics.inc("csr_jobs_total", result="error", **labels)
+            print("Error generating job {}  -  message: {}".format(job_id, e))
+
+        finally:
+            self._remove_from_queue(job_id, lane)
+            profiling.record_stage("persist", time.perf_counter() - persist_started)
+            self._job_done(job_id)
 
     @staticmethod
-    def add_to_queue(job_id: str):
-        with sqlite3.connect(app.SQLITE_DB_PATH) as conn:
+    def _remove_from_queue(job_id: str, lane: Optional[str] = None):
+        """
+        Removes a job from the queue.
+
+        :param job_id: The id of the job
+        :param lane: The lane of the job if it was generated (or failed), it then counts towards the generation rate
+        """
+        with database.connection() as conn:
             db = conn.cursor()
-            timestamp = int(time.time())
-            db.execute("INSERT INTO queue (job_id, timestamp) VALUES (?, ?)", (job_id, timestamp))
+            db.execute("DELETE FROM queue WHERE job_id = ?", (job_id,))
+            if lane is not None:
+                now = time.time()
+                db.execute("INSERT INTO queue_history (lane, finished_at) VALUES (?, ?)", (lane, now))
+                db.execute("DELETE FROM queue_history WHERE finished_at < ?", (now - app.QUEUE_RATE_WINDOW,))
             conn.commit()
+
+    @staticmethod
+    @io_pool.offloaded
+    def get_depth() -> Dict[Tuple[str, bool], int]:
+        """ Returns the number of jobs in the queue, by lane and by whether they are being generated """
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("SELECT lane, owner IS NOT NULL AND lease_expires >= ?, COUNT(*) FROM queue GROUP BY 1, 2",
+                       (time.time(),))
+            return {(lane, bool(running)): count for lane, running, count in db.fetchall()}
+
+    @staticmethod
+    @io_pool.offloaded
+    def get_generation_rates() -> Dict[str, float]:
+        """ Returns the number of jobs generated per second during the last QUEUE_RATE_WINDOW seconds, by lane """
+        now = time.time()
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("SELECT lane, COUNT(*), MIN(finished_at) FROM queue_history WHERE finished_at >= ? "
+                       "GROUP BY lane", (now - app.QUEUE_RATE_WINDOW,))
+            # Measured since the first job of the window, so that the rate isn't underestimated right after a start
+            return {lane: count / max(now - first, 1.0) for lane, count, first in db.fetchall()}
+
+    @staticmethod
+    def _estimate_wait(job_count: int, rate: float) -> int:
+        """ Returns the time (seconds) needed to generate a number of jobs at a rate, within the RETRY_AFTER_ bounds """
+        if rate <= 0:
+            return QueueExecutor.RETRY_AFTER_UNKNOWN
+        return min(max(math.ceil(job_count / rate), QueueExecutor.RETRY_AFTER_MIN), QueueExecutor.RETRY_AFTER_MAX)
+
+    @staticmethod
+    @io_pool.offloaded
+    def check_admission(keys: List[Tuple[str, int]]) -> Optional[int]:
+        """
+        Checks whether jobs can be added to the queue without going over QUEUE_MAX_DEPTH and QUEUE_MAX_LANE_DEPTH.
+        The check isn't part of the transaction adding the jobs, so concurrent requests can go slightly over the limits.
+
+        :param keys: The key algorithm and key size of each job to add
+        :raises ValueError: Raised if there are more jobs than a limit allows even with an empty queue
+        :return: None if the jobs can be added, otherwise the estimated time (seconds) until there is room for them
+        """
+        added: Dict[str, int] = {}
+        for key_algorithm, key_size in keys:
+            lane = _get_lane(key_algorithm, key_size)
+            added[lane] = added.get(lane, 0) + 1
+
+        if 0 < app.QUEUE_MAX_DEPTH < len(keys):
+            raise ValueError("At most {} jobs can be queued at once.".format(app.QUEUE_MAX_DEPTH))
+        limited = {lane: count for lane, count in added.items() if lane in app.QUEUE_MAX_LANE_DEPTH}
+        for lane, count in limited.items():
+            if count > app.QUEUE_MAX_LANE_DEPTH[lane]:
+                raise ValueError("At most {} jobs of the {} lane can be queued at once."
+                                 .format(app.QUEUE_MAX_LANE_DEPTH[lane], lane))
+        if app.QUEUE_MAX_DEPTH <= 0 and not limited:
+            return None
+
+        depth: Dict[str, int] = {}
+        for (lane, _), count in QueueExecutor.get_depth().items():
+            depth[lane] = depth.get(lane, 0) + count
+
+        # Number of jobs that must leave the queue before there is room, overall (None) and by lane
+        excess: Dict[Optional[str], int] = {}
+        if app.QUEUE_MAX_DEPTH > 0:
+            excess[None] = sum(depth.values()) + len(keys) - app.QUEUE_MAX_DEPTH
+        for lane, count in limited.items():
+            excess[lane] = depth.get(lane, 0) + count - app.QUEUE_MAX_LANE_DEPTH[lane]
+        excess = {lane: count for lane, count in excess.items() if count > 0}
+        if not excess:
+            return None
+
+        rates = QueueExecutor.get_generation_rates()
+        return max(QueueExecutor._estimate_wait(count, sum(rates.values()) if lane is None else rates.get(lane, 0))
+                   for lane, count in excess.items())
+
+    @staticmethod
+    @io_pool.offloaded
+    def get_position(job_id: str) -> Optional[Tuple[int, bool, Optional[int]]]:
+        """
+        Estimates when a queued job will be generated, according to QUEUE_POLICY. Jobs queued later with a higher
+        priority, or in another batch, can still be claimed before it.
+
+        :param job_id: The id of the job
+        :return: A tuple containing the number of waiting jobs claimed before it, whether it is being generated and the
+        estimated time (seconds) until it is generated, None if unknown. None if the job isn't in the queue
+        """
+        now = time.time()
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("SELECT lane, priority, turn, timestamp, rowid, owner IS NOT NULL AND lease_expires >= ? "
+                       "FROM queue WHERE job_id=?", (now, job_id))
+            row = db.fetchone()
+            if row is None:
+                return None
+            lane, priority, turn, timestamp, rowid, running = row
+            if running:
+                return 0, True, None
+
+            if app.QUEUE_POLICY == "fifo":
+                db.execute("SELECT COUNT(*) FROM queue WHERE (owner IS NULL OR lease_expires < ?) "
+                           "AND (-priority, timestamp, rowid) < (?, ?, ?)", (now, -priority, timestamp, rowid))
+            else:
+                db.execute("SELECT COUNT(*) FROM queue WHERE lane = ? AND (owner IS NULL OR lease_expires < ?) "
+                           "AND (-priority, turn, timestamp, rowid) < (?, ?, ?, ?)",
+                           (lane, now, -priority, turn, timestamp, rowid))
+            ahead = db.fetchone()[0]
+
+        rates = QueueExecutor.get_generation_rates()
+        rate = sum(rates.values()) if app.QUEUE_POLICY == "fifo" else rates.get(lane, 0)
+        return ahead, False, math.ceil((ahead + 1) / rate) if rate > 0 else None
+
+    @staticmethod
+    @io_pool.offloaded
+    def cancel(job_id: str) -> bool:
+        """
+        Cancels the generation of a queued job. A job that is waiting in the queue is removed from it right away and
+        its status is set back to CREATED. A job being generated is aborted by the executor generating it.
+
+        :param job_id: The id of the job
+        :return: True if the job was removed from the queue, False if the executor was asked to abort it
+        """
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("DELETE FROM queue WHERE job_id=? AND (owner IS NULL OR lease_expires < ?)",
+                       (job_id, time.time()))
+            removed = db.rowcount > 0
+            if removed:
+                db.execute("UPDATE jobs SET status=?, error_message=NULL, version=version+1, updated_at=? WHERE id=?",
+                           (JobStatus.CREATED.value, time.time(), job_id))
+            else:
+                db.execute("UPDATE queue SET cancel_requested=1 WHERE job_id=?", (job_id,))
+            conn.commit()
+
+        if removed:
+            job_manager.get_cache().invalidate(job_id)
+        else:
+            QueueExecutor.notify()
+        return removed
+
+    @staticmethod
+    @io_pool.offloaded
+    def add_to_queue(job_id: str, priority: int = 0):
+        with database.connection() as conn:
+            db = conn.cursor()
+            QueueExecutor.insert_into_queue(db, [job_id], priority)
+            conn.commit()
+        QueueExecutor.notify()
+
+    @staticmethod
+    def insert_into_queue(db: sqlite3.Cursor, job_ids: List[str], priority: int = 0, batch: Optional[str] = None):
+        """
+        Inserts jobs in the queue as part of the caller's transaction. The caller must commit and then call #notify.
+        Jobs that are already in the queue keep their place.
+
+        :param db: The cursor of the caller's transaction, the jobs must already be in the jobs table
+        :param job_ids: The ids of the jobs to queue, in the order they should be generated
+        :param priority: Jobs with a higher priority are claimed first
+        :param batch: The batch the jobs belong to, each job is its own batch if not specified
+        """
+        rows = []
+        # Next turn of the batch in each lane
+        turns: Dict[str, int] = {}
+        for job_id in job_ids:
+            db.execute("SELECT key_algorithm, key_size FROM jobs WHERE id=?", (job_id,))
+            lane = _get_lane(*db.fetchone())
+            if batch is None or lane not in turns:
+                # Start at the turn the lane is at, or after the jobs of the batch that are still queued
+                db.execute("SELECT MIN(turn) FROM queue WHERE lane=?", (lane,))
+                turn = db.fetchone()[0] or 0
+                if batch is not None:
+                    db.execute("SELECT MAX(turn) + 1 FROM queue WHERE lane=? AND batch=?", (lane, batch))
+                    turn = max(turn, db.fetchone()[0] or 0)
+                turns[lane] = turn
+            rows.append((job_id, _next_timestamp(), priority, lane, batch or job_id, turns[lane]))
+            if batch is not None:
+                turns[lane] += 1
+        db.executemany("INSERT OR IGNORE INTO queue (job_id, timestamp, priority, lane, batch, turn) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def profile(duration: float) -> Optional[str]:
+        """
+        Samples the stacks of the process running the executor (see profiling.profile), from any process on this
+        machine. The executor picks up the request the next time it waits for a job or a worker.
+
+        :param duration: The time (seconds) during which the stacks are sampled
+        :return: The sampled stacks in the folded format, None if the executor didn't answer in time: it isn't running
+        on this machine, or it is already being profiled
+        """
+        os.makedirs(app.PROFILES_PATH, exist_ok=True)
+        name = uuid.uuid4().hex
+        path = os.path.join(app.PROFILES_PATH, name + ".folded")
+        if not QueueExecutor._send("profile {:g} {}".format(duration, name).encode()):
+            return None
+
+        deadline = time.monotonic() + duration + QueueExecutor.PROFILE_ANSWER_DELAY
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            try:
+                with open(path, "r") as f:
+                    stacks = f.read()
+            except FileNotFoundError:
+                continue
+            os.remove(path)
+            return stacks
+        return None
+
+    @staticmethod
+    def notify():
+        """ Wakes up the executor so that it checks the queue right away. Works from any process on this machine and
+            does nothing if the executor isn't running. """
+        QueueExecutor._send(b"\0")
+
+    @staticmethod
+    def _send(message: bytes) -> bool:
+        """ Sends a message to the executor's socket, returns False if it couldn't be sent """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.setblocking(False)
+                sock.sendto(message, app.QUEUE_SOCKET_PATH)
+            return True
+        except (OSError, AttributeError):
+            # Executor isn't listening or its buffer is full (it will check the queue anyway)
+            return False
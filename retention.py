@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+import time
+from typing import List
+
+import app
+import database
+import job_manager
+import metrics
+import storage
+from job_manager import JobStatus
+
+
+class Reaper(threading.Thread):
+    """ Deletes the jobs that expired according to RETENTION_DAYS, in the background.
+        Every RETENTION_INTERVAL seconds, the expired jobs are deleted RETENTION_BATCH_SIZE at a time, each batch in its
+        own short transaction followed by a pause, so that requests and the executor are only held up for a moment.
+        The pages freed in the database are then given back to the file system a few at a time. """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._stop_flag = threading.Event()
+
+    def run(self):
+        while not self._stop_flag.is_set():
+            try:
+                self.reap()
+            except (sqlite3.Error, OSError) as e:
+                print("Could not delete the expired jobs: {}".format(e))
+            self._stop_flag.wait(app.RETENTION_INTERVAL)
+
+    def stop(self):
+        """ Stops the reaper after the current batch """
+        self._stop_flag.set()
+
+    def reap(self) -> int:
+        """
+        Deletes the expired jobs.
+
+        :return: The number of deleted jobs
+        """
+        deleted = 0
+        for status, days in app.RETENTION_DAYS:
+            if status == JobStatus.QUEUED:
+                continue  # Still in the queue, the executor would have nothing to generate
+            cutoff = time.time() - days * 24 * 3600
+            while not self._stop_flag.is_set():
+                job_ids = self._delete_batch(status, cutoff)
+                if job_ids:
+                    deleted += len(job_ids)
+                    metrics.inc("csr_jobs_expired_total", len(job_ids), status=status.name.lower())
+                if len(job_ids) < app.RETENTION_BATCH_SIZE:
+                    break
+                self._stop_flag.wait(app.RETENTION_BATCH_PAUSE)
+
+        if deleted:
+            print("Deleted {} expired jobs.".format(deleted))
+            self._vacuum()
+        return deleted
+
+    @staticmethod
+    def _delete_batch(status: JobStatus, cutoff: float) -> List[str]:
+        """ Deletes up to RETENTION_BATCH_SIZE jobs with a status that didn't change since the cutoff, returns their
+            ids """
+        with database.connection() as conn:
+            db = conn.cursor()
+            # Lock the database for writing before reading, so that a job that changes in the meantime isn't deleted
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("SELECT id FROM jobs WHERE status=? AND updated_at < ? LIMIT ?",
+                       (status.value, cutoff, app.RETENTION_BATCH_SIZE))
+            job_ids = [row[0] for row in db.fetchall()]
+            db.executemany("DELETE FROM jobs WHERE id=?", [(job_id,) for job_id in job_ids])
+            conn.commit()
+
+        for job_id in job_ids:
+            job_manager.get_cache().invalidate(job_id)
+            storage.get_storage().delete_job(job_id)
+        return job_ids
+
+    def _vacuum(self):
+        """ Gives the free pages of the database back to the file system, RETENTION_VACUUM_PAGES at a time. Only
+            databases using incremental auto vacuum can be shrunk without rewriting the whole file, the free pages of
+            the others are reused by the next jobs. """
+        with database.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  # 2 is INCREMENTAL
+                return
+
+        while not self._stop_flag.is_set():
+            with database.connection() as conn:
+                if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                    return
+                # The pragma frees one page per step, executescript runs it to completion
+                conn.executescript("PRAGMA incremental_vacuum({})".format(app.RETENTION_VACUUM_PAGES))
+            self._stop_flag.wait(app.RETENTION_BATCH_PAUSE)
@@ -1,115 +1,273 @@
+import hmac
+import io
+import json
 import os
-import re
-import textwrap
-from typing import List, Tuple
+import tarfile
+import time
+import uuid
+import zipfile
+from typing import Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import urlencode
 
-from flask import Blueprint, request, render_template, redirect
+from flask import Blueprint, request, render_template, redirect, send_file, make_response, Response, g
 
 import app
+import csr_engine
+import io_pool
 import job_manager
+import key_pool
+import metrics
+import openssl_config
+import profiling
+import status_watcher
 from job_manager import JobStatus
 from queue_executor import QueueExecutor
 
 route_app = Blueprint('route_app', __name__)
 
+# Number of jobs shown per page by /jobs, by default and at most
+JOBS_PAGE_SIZE = 50
+JOBS_MAX_PAGE_SIZE = 500
+# Cache lifetime (seconds) of the responses that can never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Server-sent events: time (seconds) after which a stream is closed (clients reconnect), interval between keepalives,
+# and longest wait allowed for long polling
+EVENTS_MAX_DURATION = 300
+EVENTS_KEEPALIVE = 15
+STATUS_MAX_WAIT = 60
+# Highest priority accepted by the generate routes, jobs with a higher priority are generated first
+MAX_PRIORITY = 9
+# Duration (seconds) of the profiles taken by /admin/profile, by default and at most
+PROFILE_DURATION = 10
+PROFILE_MAX_DURATION = 120
+# Formats supported by the bundle routes. The json bundle of many jobs has one JSON document per line (JSON Lines),
+# the bundle of a single job is sent as a plain JSON document.
+BUNDLE_MIMETYPES = {
+    "json": "application/x-ndjson",
+    "pem": "application/x-pem-file",
+    "tar": "application/x-tar",
+    "zip": "application/zip",
+}
+
+
+@route_app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+    profiling.start_request()
+
+
+@route_app.after_request
+def _record_latency(response):
+    # Streamed responses (events, bundles) are only timed until their headers are sent
+    if "request_start" in g:
+        elapsed = time.perf_counter() - g.request_start
+        metrics.observe("csr_http_request_duration_seconds", elapsed,
+                        endpoint=request.endpoint, method=request.method, status=response.status_code)
+        server_timing = profiling.get_server_timing(elapsed)
+        if server_timing is not None:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+
+def _render(template_name: str, **context) -> str:
+    """ Renders a template, the time it takes is counted in the "render" span when profiling """
+    with profiling.span("render"):
+        return render_template(template_name, **context)
+
 
 @route_app.route('/', methods=["GET"])
 def get_form():
     """ This route shows a form to create a new job """
 
-    return render_template("index.html")
+    return _render("index.html")
 
 
-@route_app.route('/form', methods=["POST"])
-def form_route():
-    """ This route receives the form data from the index page, checks if there are any errors
-        and creates the job if everything is valid. Redirects the user to /job/{job_id} """
+def _build_config(fields: Mapping[str, str]) -> Tuple[str, int, str]:
+    """
+    Validates the fields describing a CSR and builds the contents of its OpenSSL config file.
+
+    :param fields: The fields of the form on the index page
+    :raises ValueError: Raised if a field is missing or invalid, the message describes the problem
+    :return: A tuple containing the contents of the config file, the key size and the key algorithm
+    """
 
     # Validate all the required fields
-    if "rsa_key_size" not in request.form:
-        return "An RSA key size must be specified.", 400
-    rsa_key_size = request.form['rsa_key_size']
-    if rsa_key_size not in ['2048', '4096']:
-        return "Wrong RSA key size option.", 400
-    rsa_key_size = int(rsa_key_size)
-
-    if "country" not in request.form:
-        return "A country must be specified.", 400
-    country = request.form["country"].strip()
+    key_algorithm = fields.get("key_algorithm", csr_engine.KEY_ALGORITHM_RSA)
+    if key_algorithm not in csr_engine.KEY_ALGORITHMS:
+        raise ValueError("Wrong key algorithm option.")
+
+    if key_algorithm == csr_engine.KEY_ALGORITHM_RSA:
+        if "rsa_key_size" not in fields:
+            raise ValueError("An RSA key size must be specified.")
+        key_size = fields['rsa_key_size']
+        if key_size not in ['2048', '4096']:
+            raise ValueError("Wrong RSA key size option.")
+        key_size = int(key_size)
+    else:
+        key_size = csr_engine.EC_KEY_SIZES[key_algorithm]
+
+    if "country" not in fields:
+        raise ValueError("A country must be specified.")
+    country = fields["country"].strip()
     if not country:
-        return "A country must be specified.", 400
+        raise ValueError("A country must be specified.")
 
-    if "state" not in request.form:
-        return "A state must be specified.", 400
-    state = request.form["state"].strip()
+    if "state" not in fields:
+        raise ValueError("A state must be specified.")
+    state = fields["state"].strip()
     if not state:
-        return "A state must be specified.", 400
+        raise ValueError("A state must be specified.")
 
-    if "city" not in request.form:
-        return "A city must be specified.", 400
-    city = request.form["city"].strip()
+    if "city" not in fields:
+        raise ValueError("A city must be specified.")
+    city = fields["city"].strip()
     if not city:
-        return "A city must be specified.", 400
+        raise ValueError("A city must be specified.")
 
-    if "organization" not in request.form:
-        return "An organization must be specified.", 400
-    organization = request.form["organization"].strip()
+    if "organization" not in fields:
+        raise ValueError("An organization must be specified.")
+    organization = fields["organization"].strip()
     if not organization:
-        return "A organization must be specified.", 400
+        raise ValueError("A organization must be specified.")
 
-    if "fqdn" not in request.form:
-        return "An FQDN must be specified.", 400
-    fqdn = request.form["fqdn"].strip()
+    if "fqdn" not in fields:
+        raise ValueError("An FQDN must be specified.")
+    fqdn = fields["fqdn"].strip()
     if not fqdn:
-        return "An FQDN must be specified.", 400
+        raise ValueError("An FQDN must be specified.")
 
-    # Optional values
-    organizational_unit = request.form.get("OU", "").strip()
+    subject = [("C", country), ("ST", state), ("L", city), ("O", organization)]
 
-    email = request.form.get("email", "").strip()
-    if email != "" and not re.fullmatch(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", email):
-        return "A valid email must be provided", 400  # Very simple regex to validate string somewhat looks like email.
+    # Optional values
+    organizational_unit = fields.get("OU", "").strip()
+    if organizational_unit:
+        subject.append(("OU", organizational_unit))
 
-    raw_sans = request.form.get("san", "").strip()
-    san_list = []
-    if raw_sans != "":
-        san_list = [s.strip() for s in raw_sans.split(",") if s.strip()]  # Add non-empty stripped strings
-        san_list = list(set(san_list))  # Remove the duplicates
+    email = fields.get("email", "").strip()
+    if email:
+        subject.append(("emailAddress", email))
+    subject.append(("CN", fqdn))
 
+    raw_sans = fields.get("san", "").strip()
+    # Add non-empty stripped strings, without the duplicates
+    san_list = list(dict.fromkeys(s.strip() for s in raw_sans.split(",") if s.strip()))
     if fqdn not in san_list:
         san_list = [fqdn] + san_list  # Prepend the fqdn if it is not already in the list
 
-    config_file_contents = """\
-    distinguished_name = req_distinguished_name
-    req_extensions = req_ext
-    prompt=no
-    [req_distinguished_name]
-    C = {}
-    ST = {}
-    L = {}
-    O = {}""".format(country, state, city, organization)
+    config = openssl_config.ReqConfig(subject, [("DNS", san) for san in san_list], openssl_config.DEFAULT_DIGEST)
+    config_file_contents = openssl_config.render_config(config)
+    # The config is read back to check the values the same way the configs edited by the users are checked
+    errors = openssl_config.validate_config(config_file_contents)
+    if errors:
+        raise ValueError(" ".join(error["error"] for error in errors))
 
-    if organizational_unit:
-        config_file_contents += "\nOU = " + organizational_unit
+    return config_file_contents, key_size, key_algorithm
+
+
+def _queue_full_response(body, retry_after: int):
+    """ Returns a 429 response asking the client to retry once the queue has room for its jobs """
+    response = make_response(body, 429)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def _format_duration(seconds: int) -> str:
+    if seconds < 90:
+        return "{} seconds".format(seconds)
+    if seconds < 90 * 60:
+        return "{} minutes".format(round(seconds / 60))
+    return "{} hours".format(round(seconds / 3600))
 
-    if email:
-        config_file_contents += "\nemailAddress = " + email
 
-    config_file_contents += '''
-    CN = {}
-    [req_ext]
-    subjectAltName = @alt_names
-    [alt_names]'''.format(fqdn)
-    config_file_contents = textwrap.dedent(config_file_contents)  # Dedent to allow the use of multiline string
+def _parse_priority(value) -> int:
+    """
+    Validates the generation priority of a job.
 
-    for i in range(len(san_list)):
-        config_file_contents += "\nDNS.{} = {}".format(i + 1, san_list[i])
+    :param value: The priority as received, None if it wasn't specified
+    :raises ValueError: Raised if the priority isn't an integer between 0 and MAX_PRIORITY
+    :return: The priority, 0 if it wasn't specified
+    """
+    if value is None or value == "":
+        return 0
+    try:
+        priority = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("The priority must be an integer.")
+    if not 0 <= priority <= MAX_PRIORITY:
+        raise ValueError("The priority must be between 0 and {}.".format(MAX_PRIORITY))
+    return priority
+
+
+@route_app.route('/form', methods=["POST"])
+def form_route():
+    """ This route receives the form data from the index page, checks if there are any errors
+        and creates the job if everything is valid. Redirects the user to /job/{job_id} """
+
+    try:
+        config_file_contents, key_size, key_algorithm = _build_config(request.form)
+    except ValueError as e:
+        return str(e), 400
 
-    job_id = job_manager.create_job(config_file_contents, rsa_key_size)
+    job_id = job_manager.create_job(config_file_contents, key_size, key_algorithm)
 
     return redirect("/job/{}".format(job_id))
 
 
+@route_app.route("/jobs/bulk", methods=["POST"])
+def jobs_bulk():
+    """ This route creates many jobs at once. It receives a JSON document of the form
+        {"jobs": [{...fields of the index page form...}, ...], "generate": true, "priority": 0, "batch": "name"}
+        where "san" can also be a list. All jobs are validated before any is created. If "generate" is true, the
+        jobs are added to the generation queue right away, with the given priority (0 by default). The jobs of a
+        batch share the queue fairly with the other batches, all the jobs of the request are in the same batch if
+        none is specified. Returns the ids of the jobs, in the same order.
+        If queueing the jobs would go over the limits of the queue, no job is created and the response is a 429 with a
+        Retry-After header. """
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("jobs"), list):
+        return {"errors": [{"error": "A JSON object containing a list of jobs must be provided."}]}, 400
+
+    configs: List[Tuple[str, int, str]] = []
+    errors = []
+    for i, spec in enumerate(body["jobs"]):
+        if not isinstance(spec, dict):
+            errors.append({"index": i, "error": "Each job must be a JSON object."})
+            continue
+
+        fields = {key: ",".join(map(str, value)) if isinstance(value, list) else str(value)
+                  for key, value in spec.items()}
+        try:
+            configs.append(_build_config(fields))
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+
+    try:
+        priority = _parse_priority(body.get("priority"))
+    except ValueError as e:
+        errors.append({"error": str(e)})
+    batch = body.get("batch")
+    if batch is not None and not isinstance(batch, str):
+        errors.append({"error": "The batch must be a string."})
+
+    if errors:
+        return {"errors": errors}, 400
+
+    if body.get("generate", False):
+        try:
+            retry_after = QueueExecutor.check_admission([(key_algorithm, key_size)
+                                                         for _, key_size, key_algorithm in configs])
+        except ValueError as e:
+            return {"errors": [{"error": str(e)}]}, 400
+        if retry_after is not None:
+            return _queue_full_response({"errors": [{"error": "The generation queue is full, retry in {} seconds."
+                                                    .format(retry_after)}]}, retry_after)
+
+    job_ids = job_manager.create_jobs(configs, bool(body.get("generate", False)), priority,
+                                      batch or uuid.uuid4().hex)
+    return {"job_ids": job_ids}, 201
+
+
 @route_app.route("/job/<job_id>", methods=["GET"])
 def job_info(job_id):
     """ This route shows the contents of the OpenSSL config file. User can change the contents of the file and save
@@ -122,30 +280,73 @@ def job_info(job_id):
         return str(e), 404
 
     conf_file_lines = len(conf_content.split("\n"))
-    return render_template("job_info.html", job_id=job_id, conf_file_lines=conf_file_lines)
+    return _render("job_info.html", job_id=job_id, conf_file_lines=conf_file_lines)
+
+
+def _config_errors_response(job_id: str, config_contents: str, errors: List[dict]):
+    """ Shows the edit page of a job with the mistakes found in its config, keeping the contents that were sent """
+    return _render("job_info.html", job_id=job_id, conf_file_lines=len(config_contents.split("\n")),
+                   conf_contents=config_contents, errors=errors), 400
 
 
 @route_app.route("/job/<job_id>", methods=["POST"])
 def job_update(job_id):
     """ This route receives the new contents of the config file and tries to save it to disk.
-        Redirects to /job/{job_id} """
+        Redirects to /job/{job_id}, or shows the mistakes found in the config without saving it """
 
     if "confFile" not in request.form:
         return "The contents of the config file must be specified.", 400
 
-    conf_path = os.path.join(app.JOBS_FOLDER_PATH, job_id, "{}.conf".format(job_id))
+    try:
+        job_manager.get_job(job_id)
+    except ValueError as e:
+        return str(e), 404
+    except FileNotFoundError:
+        pass  # The job exists, saving the config replaces the missing file
+
+    errors = openssl_config.validate_config(request.form["confFile"])
+    if errors:
+        return _config_errors_response(job_id, request.form["confFile"], errors)
 
-    with open(conf_path, "w", newline='\n') as f:
-        f.write(request.form['confFile'])
+    try:
+        job_manager.update_job_config(job_id, request.form['confFile'])
+    except ValueError as e:
+        return str(e), 404
 
     return redirect("/job/{}".format(job_id))
 
 
 @route_app.route("/jobs", methods=["GET"])
 def job_list():
-    """ This route lists all existing jobs with links to them """
+    """ This route lists the existing jobs with links to them, one page at a time.
+        Query parameters: status (only show the jobs with that status), after (id of the last job of the previous
+        page) and limit (number of jobs per page) """
+
+    status = None
+    if request.args.get("status"):
+        try:
+            status = JobStatus[request.args["status"].upper()]
+        except KeyError:
+            return "Unknown job status.", 400
+
+    try:
+        limit = min(int(request.args.get("limit", JOBS_PAGE_SIZE)), JOBS_MAX_PAGE_SIZE)
+    except ValueError:
+        return "The limit must be a number.", 400
+    if limit < 1:
+        return "The limit must be positive.", 400
+
+    after = request.args.get("after") or None
+
+    # Get one more job than needed to know if there is a next page
+    jobs = job_manager.get_jobs(status, after, limit + 1)
+    next_page = None
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        next_page = "/jobs?" + urlencode({key: value for key, value in
+                                          [("status", request.args.get("status")), ("after", jobs[-1].get_id()),
+                                           ("limit", request.args.get("limit"))] if value})
 
-    jobs = job_manager.get_jobs()
     # Format of tuples: (job_id, status, link to show)
     formatted_jobs: List[Tuple[str, str, str]] = []
 
@@ -159,7 +360,8 @@ def job_list():
 
         formatted_jobs.append((job.get_id(), job.get_status().name.capitalize(), link))
 
-    return render_template("job_list.html", job_list=formatted_jobs)
+    return _render("job_list.html", job_list=formatted_jobs, next_page=next_page,
+                   statuses=[s.name.capitalize() for s in JobStatus])
 
 
 @route_app.route("/job/<job_id>/generate", methods=["GET"])
@@ -177,32 +379,197 @@ def job_generation_info(job_id):
 
     if status == JobStatus.CREATED:
         # Job only created, not generated
-        return render_template("job_not_generated.html", job_id=job_id)
+        return _render("job_not_generated.html", job_id=job_id)
     elif status == JobStatus.QUEUED:
-        # Job already in queue
-        return "The job is in the queue, please wait."
+        # Job already in queue, the page reloads itself once the job is done
+        position = QueueExecutor.get_position(job_id)
+        ahead, running, eta = position if position is not None else (None, False, None)
+        return _render("job_queued.html", job_id=job_id, ahead=ahead, running=running,
+                       eta=_format_duration(eta) if eta is not None else None)
     elif status == JobStatus.GENERATED:
         # Job is generated, show results
-        return render_template("job_generated.html", job_id=job_id)
+        return _render("job_generated.html", job_id=job_id, version=job.get_version(),
+                       renewed_from=job.get_renewed_from())
     elif status == JobStatus.ERROR:
-        split_error = job.get_error_message().split("\r\n")
-        return render_template("job_error.html", job_id=job_id, split_error=split_error)
+        split_error = job.get_error_message().splitlines()
+        return _render("job_error.html", job_id=job_id, split_error=split_error)
+
+
+def _format_event(job_id: str, status: JobStatus) -> str:
+    return "event: status\ndata: {}\n\n".format(json.dumps({"job_id": job_id, "status": status.name}))
+
+
+@route_app.route("/job/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """ This route streams the status of a job as server-sent events. The current status is sent right away, then
+        every change is sent as soon as it happens. The stream ends once the job is generated or in error. """
+
+    try:
+        status = job_manager.get_job(job_id).get_status()
+    except (ValueError, FileNotFoundError) as e:
+        return str(e), 404
+
+    def stream():
+        current = status
+        yield _format_event(job_id, current)
+
+        watcher = status_watcher.get_watcher()
+        deadline = time.monotonic() + EVENTS_MAX_DURATION
+        while current not in [JobStatus.GENERATED, JobStatus.ERROR] and time.monotonic() < deadline:
+            new_status = watcher.wait_for_change(job_id, current, EVENTS_KEEPALIVE)
+            if new_status is None:
+                # Comment line, keeps proxies from closing the idle connection
+                yield ": keepalive\n\n"
+                continue
+            current = new_status
+            yield _format_event(job_id, current)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    response.headers["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the events
+    return response
+
+
+@route_app.route("/job/<job_id>/status", methods=["GET"])
+def job_status(job_id):
+    """ This route returns the status of a job in JSON format. For long polling, pass the status you already know
+        (?status=QUEUED) and the number of seconds to wait (?wait=30): the response is sent as soon as the status is
+        different, or once the time runs out. For a queued job, the response also contains the number of jobs ahead of
+        it, whether it is being generated and the estimated time (seconds) until it is generated, null if unknown. """
+
+    try:
+        status = job_manager.get_job(job_id).get_status()
+    except (ValueError, FileNotFoundError) as e:
+        return str(e), 404
+
+    known_status = request.args.get("status", "").upper()
+    try:
+        wait = min(float(request.args.get("wait", 0)), STATUS_MAX_WAIT)
+    except ValueError:
+        return "The wait must be a number.", 400
+
+    if known_status == status.name and wait > 0:
+        new_status = status_watcher.get_watcher().wait_for_change(job_id, status, wait)
+        if new_status is not None:
+            status = new_status
+
+    result = {"job_id": job_id, "status": status.name}
+    if status == JobStatus.QUEUED:
+        position = QueueExecutor.get_position(job_id)
+        if position is not None:
+            result["queue"] = dict(zip(["ahead", "running", "estimated_seconds"], position))
+    return result
 
 
 @route_app.route("/job/<job_id>/generate", methods=["POST"])
 def job_generate(job_id):
-    """ This route adds the job to the generation queue """
+    """ This route adds the job to the generation queue, with the priority given by the optional "priority" field.
+        Jobs whose config contains mistakes aren't queued, the edit page shows the mistakes instead. If the queue is
+        full, the job isn't queued and the response is a 429 with a Retry-After header. A job that is already queued
+        gets a 409. """
 
     try:
-        _ = job_manager.get_job(job_id)
+        job = job_manager.get_job(job_id)
     except (ValueError, FileNotFoundError) as e:
         return str(e), 404
 
+    if job.get_status() == JobStatus.QUEUED:
+        return "This job is already queued.", 409
+
+    try:
+        priority = _parse_priority(request.form.get("priority"))
+    except ValueError as e:
+        return str(e), 400
+
+    try:
+        config_contents = job.get_config_contents()
+    except FileNotFoundError as e:
+        return str(e), 404
+    errors = openssl_config.validate_config(config_contents)
+    if errors:
+        return _config_errors_response(job_id, config_contents, errors)
+
+    try:
+        retry_after = QueueExecutor.check_admission([(job.get_key_algorithm(), job.get_key_size())])
+    except ValueError as e:
+        return str(e), 400
+    if retry_after is not None:
+        return _queue_full_response("The generation queue is full, please retry in {}.".format(
+            _format_duration(retry_after)), retry_after)
+
     job_manager.set_job_status(job_id, JobStatus.QUEUED)
-    QueueExecutor.add_to_queue(job_id)
+    QueueExecutor.add_to_queue(job_id, priority)
     return redirect(request.path)
 
 
+@route_app.route("/job/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    """ This route cancels the generation of a queued job, whether it is waiting in the queue or being generated. The
+        job goes back to the CREATED status. Redirects to /job/{job_id}/generate """
+
+    try:
+        job = job_manager.get_job(job_id)
+    except (ValueError, FileNotFoundError) as e:
+        return str(e), 404
+
+    if job.get_status() != JobStatus.QUEUED:
+        return "Only queued jobs can be cancelled.", 409
+
+    QueueExecutor.cancel(job_id)
+    return redirect("/job/{}/generate".format(job_id))
+
+
+@route_app.route("/job/<job_id>/renew", methods=["POST"])
+def job_renew(job_id):
+    """ This route renews a generated job: a new job is created with the edited config ("confFile", the config of the
+        renewed job if not specified) and its CSR is signed with the key of the renewed job, or with the private key
+        uploaded as "private_key". Since no key is generated, the new job is generated right away instead of going
+        through the queue. Redirects the user to /job/{new_job_id}/generate
+        If the config contains mistakes, no job is created and the response lists them: {"errors": [{"line": 3,
+        "error": "..."}, ...]}. If the CSR can't be signed, no job is created either and the response is a 400 with
+        the error. """
+
+    try:
+        job = job_manager.get_job(job_id)
+    except (ValueError, FileNotFoundError) as e:
+        return str(e), 404
+
+    if job.get_status() != JobStatus.GENERATED:
+        return "Only generated jobs can be renewed.", 409
+
+    config_contents = request.form.get("confFile") or job.get_config_contents()
+    errors = openssl_config.validate_config(config_contents)
+    if errors:
+        return {"errors": errors}, 400
+    upload = request.files.get("private_key")
+    if upload is not None and upload.filename:
+        key_pem = upload.read()
+        try:
+            key_algorithm, key_size = csr_engine.describe_key(key_pem)
+        except ValueError as e:
+            return str(e), 400
+        if key_algorithm == csr_engine.KEY_ALGORITHM_RSA and key_size < 2048:
+            return "RSA keys must be at least 2048 bits long.", 400
+    else:
+        try:
+            key_pem = job_manager.get_job_file(job, "key").encode()
+        except FileNotFoundError:
+            return "The key of this job could not be found.", 404
+        key_algorithm, key_size = job.get_key_algorithm(), job.get_key_size()
+
+    # The job is only created once its CSR is signed, a renewal that fails leaves nothing behind
+    try:
+        key_pem, csr_pem = io_pool.run(csr_engine.generate, config_contents, key_size, app.GENERATION_BACKEND,
+                                       key_pem, key_algorithm, app.GENERATION_TIMEOUT)
+    except (csr_engine.GenerationError, ValueError) as e:
+        return str(e), 400
+
+    new_job_id = job_manager.create_job(config_contents, key_size, key_algorithm, renewed_from=job_id)
+    job_manager.write_job_files(new_job_id, key_pem, csr_pem)
+    job_manager.set_job_result(new_job_id, JobStatus.GENERATED, None)
+    return redirect("/job/{}/generate".format(new_job_id))
+
+
 @route_app.route("/job/<job_id>/delete", methods=["POST"])
 def job_delete(job_id):
     """ This route deletes the provided job from the database and disk """
@@ -213,9 +580,11 @@ def job_delete(job_id):
         return str(e), 404
 
 
-@route_app.route("/job/<job_id>/key", methods=["GET"])
-def job_get_key(job_id):
-    """ This route returns the value of the SSL key for a generated job """
+def _send_generated_file(job_id: str, extension: str):
+    """ Sends the key or CSR file of a generated job. The response supports conditional requests.
+        Since the files only change if the job is generated again, which changes its version, requests specifying the
+        current version of the job (?v=version) can be cached forever. Other requests must revalidate, with the ETag or
+        with the time the job last changed. """
 
     try:
         job = job_manager.get_job(job_id)
@@ -226,43 +595,199 @@ def job_get_key(job_id):
     if job.get_status() != JobStatus.GENERATED:
         return "Job hasn't generated yet", 404
 
-    # Get key file
-    # %jobs_path%/job_id/job_id.key
-    key_path = os.path.join(app.JOBS_FOLDER_PATH, job_id, "{}.key".format(job_id))
+    etag = "{}-{}-{}".format(job_id, job.get_version(), extension)
+    path = job_manager.get_job_file_path(job_id, extension)
     try:
-        with open(key_path, "r") as f:
-            return f.read()
+        if path is not None:
+            # Served straight from the file (using sendfile when the server supports it)
+            response = send_file(path, mimetype="text/plain", etag=etag, last_modified=job.get_updated_at(),
+                                 conditional=True)
+        else:
+            response = make_response(job_manager.get_job_file(job, extension))
+            response.mimetype = "text/plain"
+            response.set_etag(etag)
+            if job.get_updated_at() is not None:
+                response.last_modified = job.get_updated_at()
+            response = response.make_conditional(request)
     except FileNotFoundError:
-        return "Couldn't open the key file, perhaps it hasn't properly generated.", 404
+        return "Couldn't open the {} file, perhaps it hasn't properly generated.".format(extension), 404
+
+    # The files contain a private key, they must not be stored by shared caches
+    response.cache_control.private = True
+    if request.args.get("v") == str(job.get_version()):
+        response.cache_control.no_cache = None  # Set by send_file
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@route_app.route("/job/<job_id>/key", methods=["GET"])
+def job_get_key(job_id):
+    """ This route returns the value of the SSL key for a generated job """
+
+    return _send_generated_file(job_id, "key")
 
 
 @route_app.route("/job/<job_id>/csr", methods=["GET"])
 def job_get_csr(job_id):
     """ This route returns the value of the SSL CSR file for a generated job """
 
+    return _send_generated_file(job_id, "csr")
+
+
+class _StreamBuffer:
+    """ Write-only file object collecting what tarfile/zipfile write, so that it can be streamed in chunks """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _read_bundle_files(job: job_manager.Job) -> List[Tuple[str, str]]:
+    """ Returns the (file name, contents) of the files of a generated job
+        :raises FileNotFoundError: Raised if a file is missing """
+    return [("{}.{}".format(job.get_id(), extension), job_manager.get_job_file(job, extension))
+            for extension in ["key", "csr"]] + [("{}.conf".format(job.get_id()), job.get_config_contents())]
+
+
+def _stream_bundles(jobs: Iterator[job_manager.Job], bundle_format: str) -> Iterator[bytes]:
+    """ Streams the files of the jobs one job at a time, in the requested format """
+    buffer = _StreamBuffer()
+    if bundle_format == "tar":
+        archive = tarfile.open(fileobj=buffer, mode="w|")
+    elif bundle_format == "zip":
+        archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED)
+
+    for job in jobs:
+        try:
+            files = _read_bundle_files(job)
+        except FileNotFoundError:
+            continue  # Files were deleted in the meantime, skip the job
+
+        if bundle_format == "json":
+            # One JSON document per line
+            document = {"job_id": job.get_id(), "key": files[0][1], "csr": files[1][1], "config": files[2][1]}
+            yield (json.dumps(document) + "\n").encode()
+        elif bundle_format == "pem":
+            yield (files[0][1] + files[1][1]).encode()
+        else:
+            for name, contents in files:
+                data = contents.encode()
+                path = "{}/{}".format(job.get_id(), name)
+                if bundle_format == "tar":
+                    info = tarfile.TarInfo(path)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    info.mode = 0o600
+                    archive.addfile(info, io.BytesIO(data))
+                else:
+                    archive.writestr(path, data)
+            yield buffer.pop()
+
+    if bundle_format in ["tar", "zip"]:
+        archive.close()
+        yield buffer.pop()
+
+
+@route_app.route("/job/<job_id>/bundle", methods=["GET"])
+def job_get_bundle(job_id):
+    """ This route returns the key, CSR and config of a generated job in a single response.
+        Query parameter format: json (default), pem (key followed by CSR), tar or zip.
+        Like the key and CSR routes, the response can be cached forever when ?v=version is given. """
+
+    bundle_format = request.args.get("format", "json")
+    if bundle_format not in BUNDLE_MIMETYPES:
+        return "Unknown bundle format.", 400
+
     try:
         job = job_manager.get_job(job_id)
     except (ValueError, FileNotFoundError) as e:
         return str(e), 404
 
-    # Job exists, check that it has been generated
     if job.get_status() != JobStatus.GENERATED:
         return "Job hasn't generated yet", 404
 
-    # Get csr file
-    # %jobs_path%/job_id/job_id.csr
-    csr_path = os.path.join(app.JOBS_FOLDER_PATH, job_id, "{}.csr".format(job_id))
-
     try:
-        with open(csr_path, "r") as f:
-            return f.read()
+        files = _read_bundle_files(job)
     except FileNotFoundError:
-        return "Couldn't open the csr file, perhaps it hasn't properly generated.", 404
+        return "Couldn't open the files of this job, perhaps it hasn't properly generated.", 404
+
+    mimetype = BUNDLE_MIMETYPES[bundle_format]
+    if bundle_format == "json":
+        data = json.dumps({"job_id": job_id, "key": files[0][1], "csr": files[1][1], "config": files[2][1]})
+        mimetype = "application/json"
+    else:
+        data = b"".join(_stream_bundles(iter([job]), bundle_format))
+    response = Response(data, mimetype=mimetype)
+    if bundle_format in ["tar", "zip"]:
+        response.headers["Content-Disposition"] = "attachment; filename={}.{}".format(job_id, bundle_format)
+
+    response.set_etag("{}-{}-{}".format(job_id, job.get_version(), bundle_format))
+    response.cache_control.private = True
+    if request.args.get("v") == str(job.get_version()):
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@route_app.route("/jobs/bundle", methods=["GET"])
+def jobs_get_bundle():
+    """ This route streams the files of many generated jobs, without loading them all in memory.
+        Query parameters: ids (comma separated ids, jobs that aren't generated are skipped), or no ids to get every
+        generated job, and format: json (one JSON document per line), pem, tar (default) or zip. """
+
+    bundle_format = request.args.get("format", "tar")
+    if bundle_format not in BUNDLE_MIMETYPES:
+        return "Unknown bundle format.", 400
+
+    raw_ids = request.args.get("ids", "").strip()
+    job_ids = [job_id.strip() for job_id in raw_ids.split(",") if job_id.strip()]
+
+    def iter_jobs() -> Iterator[job_manager.Job]:
+        if job_ids:
+            for job_id in job_ids:
+                try:
+                    job = job_manager.get_job(job_id)
+                except (ValueError, FileNotFoundError):
+                    continue
+                if job.get_status() == JobStatus.GENERATED:
+                    yield job
+        else:
+            # Go through the generated jobs one page at a time
+            after = None
+            while True:
+                page = job_manager.get_jobs(JobStatus.GENERATED, after, JOBS_MAX_PAGE_SIZE)
+                yield from page
+                if len(page) < JOBS_MAX_PAGE_SIZE:
+                    break
+                after = page[-1].get_id()
+
+    response = Response(_stream_bundles(iter_jobs(), bundle_format), mimetype=BUNDLE_MIMETYPES[bundle_format])
+    if bundle_format in ["tar", "zip"]:
+        response.headers["Content-Disposition"] = "attachment; filename=jobs.{}".format(bundle_format)
+    return response
 
 
 @route_app.route("/job/<job_id>/config", methods=["GET"])
 def job_get_config(job_id):
-    """ This route returns the contents of the config file for an existing job """
+    """ This route returns the contents of the config file for an existing job.
+        The config only changes through job_update, which changes the version of the job used as the ETag, and the time
+        it last changed used as Last-Modified. """
 
     try:
         job = job_manager.get_job(job_id)
@@ -270,4 +795,93 @@ def job_get_config(job_id):
         return str(e), 404
 
     # Job exists
-    return job.get_config_contents()
+    response = make_response(job.get_config_contents())
+    response.mimetype = "text/plain"
+    response.set_etag("{}-{}".format(job_id, job.get_version()))
+    if job.get_updated_at() is not None:
+        response.last_modified = job.get_updated_at()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@io_pool.offloaded
+def _read_cleanup_report() -> Optional[dict]:
+    try:
+        with open(app.CLEANUP_REPORT_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+@route_app.route("/stats", methods=["GET"])
+def stats():
+    """ This route returns internal statistics used to size the app, in JSON format """
+
+    return {
+        "key_pool": {str(key_size): depth for key_size, depth in key_pool.get_depth().items()},
+        # The cache is per process, these are the stats of the worker that handled the request
+        "job_cache": dict(job_manager.get_cache().get_stats(), pid=os.getpid()),
+        "last_cleanup": _read_cleanup_report(),
+    }
+
+
+@route_app.route("/metrics", methods=["GET"])
+def metrics_route():
+    """ This route returns the metrics of all the processes of the app, in the Prometheus text format """
+
+    queue_depth = {}
+    for (lane, running), count in QueueExecutor.get_depth().items():
+        queue_depth[(("lane", lane), ("state", "running" if running else "waiting"))] = count
+    gauges = [
+        ("csr_queue_depth", "Jobs in the generation queue, by lane and by whether they are being generated.",
+         queue_depth),
+        ("csr_key_pool_depth", "Pre-generated keys available in the key pool, by key size.",
+         {(("key_size", key_size),): depth for key_size, depth in key_pool.get_depth().items()}),
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+def _is_admin_request() -> bool:
+    """ Returns whether the request is allowed to use the admin routes: it has the X-Admin-Token header set to
+        PROFILING_TOKEN, or it comes from this machine and doesn't have the header """
+    token = request.headers.get("X-Admin-Token")
+    if token is not None:
+        return app.PROFILING_TOKEN is not None and hmac.compare_digest(token.encode(), app.PROFILING_TOKEN.encode())
+    return request.remote_addr in ["127.0.0.1", "::1"]
+
+
+@route_app.route("/admin/profile", methods=["GET"])
+def admin_profile():
+    """ This route samples the stacks of a process for ?seconds=N seconds and returns them in the folded format read by
+        flame graph tools (flamegraph.pl, speedscope): the process handling the request by default, or the process
+        running the queue executor with ?process=executor. Only available if PROFILING is enabled, to requests from
+        this machine or with the PROFILING_TOKEN. """
+
+    if not app.PROFILING:
+        return "Profiling is disabled, set CSR_PROFILING=1 to enable it.", 404
+    if not _is_admin_request():
+        return "Profiles can only be requested from this machine or with the admin token.", 403
+
+    try:
+        seconds = float(request.args.get("seconds", PROFILE_DURATION))
+    except ValueError:
+        return "The number of seconds must be a number.", 400
+    if not 0 < seconds <= PROFILE_MAX_DURATION:
+        return "The number of seconds must be between 0 and {}.".format(PROFILE_MAX_DURATION), 400
+
+    process = request.args.get("process", "worker")
+    if process == "worker":
+        stacks = profiling.profile(seconds)
+        if stacks is None:
+            return "This process is already being profiled.", 409
+    elif process == "executor":
+        stacks = QueueExecutor.profile(seconds)
+        if stacks is None:
+            return "The queue executor didn't answer, it may not run on this machine or already be profiled.", 503
+    else:
+        return "Unknown process, must be worker or executor.", 400
+
+    response = Response(stacks, mimetype="text/plain")
+    response.cache_control.no_store = True
+    return response
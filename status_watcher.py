@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import app
+import database
+import io_pool
+from job_manager import JobStatus
+
+
+class _Waiter:
+    def __init__(self, known_status: JobStatus):
+        self.known_status = known_status
+        self.new_status: Optional[JobStatus] = None
+        self.event = threading.Event()
+
+
+class StatusWatcher(threading.Thread):
+    """ Notifies the requests waiting for the status of a job to change.
+        A single thread per process checks whether the database changed (PRAGMA data_version, which doesn't read any
+        table) every EVENTS_POLL_INTERVAL seconds. Only when it did, the statuses of all the watched jobs are read in
+        a single query. The cost is the same whether one or thousands of requests are waiting.
+        Under gevent the thread and the events are cooperative, so a waiting request only costs a greenlet, and the
+        queries run in the I/O pool (see io_pool). """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._waiters: Dict[str, List[_Waiter]] = {}
+        self._lock = threading.Lock()
+        # Set when a waiter is added, so that a change made before it was registered isn't missed
+        self._force_check = False
+
+    def wait_for_change(self, job_id: str, known_status: JobStatus, timeout: float) -> Optional[JobStatus]:
+        """
+        Waits until the status of a job is different from the one known by the caller.
+
+        :param job_id: The id of the job
+        :param known_status: The status the caller last saw
+        :param timeout: The maximum time to wait, in seconds
+        :return: The new status, or None if it didn't change before the timeout (or the job was deleted)
+        """
+        waiter = _Waiter(known_status)
+        with self._lock:
+            self._waiters.setdefault(job_id, []).append(waiter)
+            self._force_check = True
+
+        try:
+            waiter.event.wait(timeout)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(job_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(job_id, None)
+        return waiter.new_status
+
+    def run(self):
+        # Opened on first use, and again after an error
+        conn: Optional[sqlite3.Connection] = None
+        last_version = None
+        while True:
+            time.sleep(app.EVENTS_POLL_INTERVAL)
+
+            with self._lock:
+                job_ids = list(self._waiters)
+                force_check = self._force_check
+                self._force_check = False
+            if not job_ids:
+                continue
+
+            try:
+                if conn is None:
+                    conn = database.connect()
+                last_version, statuses = io_pool.run(self._read_statuses, conn, job_ids, last_version, force_check)
+            except sqlite3.Error as e:
+                # Keep watching, the waiters time out in the meantime if the database stays unavailable
+                print("Could not read the statuses of the watched jobs, retrying: {}".format(e))
+                if conn is not None:
+                    conn.close()
+                conn = None
+                last_version = None
+                with self._lock:
+                    self._force_check = True
+                continue
+            if statuses is None:
+                continue
+
+            with self._lock:
+                for job_id, waiters in self._waiters.items():
+                    status = statuses.get(job_id)
+                    for waiter in waiters:
+                        if status is None:
+                            # Job was deleted, wake up the waiter without a new status
+                            waiter.event.set()
+                        elif status != waiter.known_status:
+                            waiter.new_status = status
+                            waiter.event.set()
+
+    @staticmethod
+    def _read_statuses(conn: sqlite3.Connection, job_ids: List[str], last_version: Optional[int],
+                       force_check: bool) -> Tuple[int, Optional[Dict[str, JobStatus]]]:
+        """ Returns the version of the database and the statuses of the jobs, None if the database didn't change """
+        # Changes whenever another connection commits to the database
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == last_version and not force_check:
+            return data_version, None
+
+        statuses = {}
+        # Stay under SQLite's limit on the number of parameters
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            rows = conn.execute("SELECT id, status FROM jobs WHERE id IN ({})".format(",".join("?" * len(chunk))),
+                                chunk).fetchall()
+            statuses.update({job_id: JobStatus(status) for job_id, status in rows})
+        conn.commit()  # End the read transaction so that the next data_version sees new changes
+        return data_version, statuses
+
+
+_watcher: Optional[StatusWatcher] = None
+_watcher_pid: Optional[int] = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher() -> StatusWatcher:
+    """ Returns the watcher of the current process, starting it if needed """
+    global _watcher, _watcher_pid
+    with _watcher_lock:
+        if _watcher is None or _watcher_pid != os.getpid():
+            # Threads don't survive a fork, each gunicorn worker starts its own watcher
+            _watcher = StatusWatcher()
+            _watcher_pid = os.getpid()
+            _watcher.start()
+        return _watcher
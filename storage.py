@@ -0,0 +1,425 @@
+import abc
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+from typing import Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import app
+import database
+import profiling
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    # Only needed by the object storage backend with an s3:// store
+    boto3 = None
+
+# Names of the artifacts a job can have: its OpenSSL config, and once generated its private key and CSR
+ARTIFACT_NAMES = ["conf", "key", "csr"]
+BACKENDS = ["flat", "sharded", "sqlite", "object"]
+
+
+class Storage(abc.ABC):
+    """ Stores the artifacts of the jobs. Every read and write of the files of a job goes through the backend
+        returned by #get_storage, selected with STORAGE_BACKEND. """
+
+    def initialize(self) -> None:
+        """ Creates what the backend needs (folders, tables), called at startup """
+
+    @abc.abstractmethod
+    def write(self, job_id: str, name: str, data: bytes, db: Optional[sqlite3.Cursor] = None) -> None:
+        """
+        Saves an artifact of a job, replacing it if it exists. Readers never see a partially written artifact.
+
+        :param job_id: The id of the job
+        :param name: The name of the artifact, one of ARTIFACT_NAMES
+        :param data: The contents of the artifact
+        :param db: The cursor of the caller's transaction, if any. Backends storing the artifacts in the database
+        write them as part of it, so that they are committed (or rolled back) with the job.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, job_id: str, name: str) -> bytes:
+        """
+        :raises FileNotFoundError: Raised if the job doesn't have this artifact
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_job(self, job_id: str) -> None:
+        """ Deletes all the artifacts of a job, does nothing if it has none """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_names(self, job_id: str) -> Set[str]:
+        """ Returns the names of the artifacts of a job """
+        raise NotImplementedError
+
+    def get_path(self, job_id: str, name: str) -> Optional[str]:
+        """ Returns the path of the file holding an artifact, so that it can be sent without being read by the app. None
+            for the backends that don't store the artifacts as local files. """
+        return None
+
+    @abc.abstractmethod
+    def list_jobs(self) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+        """ Lists every job found in the storage, in no particular order, with the names of its artifacts and the time
+            its folder was last modified (None for the backends without folders). Jobs whose folder is empty are
+            listed with no artifacts. """
+        raise NotImplementedError
+
+
+class _FolderStorage(Storage):
+    """ Stores the artifacts of each job as files in a folder of its own: <folder>/<job_id>.<name> """
+
+    def __init__(self, root: str):
+        self._root = root
+
+    @abc.abstractmethod
+    def _job_folder(self, job_id: str) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _iter_job_folders(self) -> Iterator[os.DirEntry]:
+        raise NotImplementedError
+
+    def _path(self, job_id: str, name: str) -> str:
+        return os.path.join(self._job_folder(job_id), "{}.{}".format(job_id, name))
+
+    def get_path(self, job_id: str, name: str) -> Optional[str]:
+        return self._path(job_id, name)
+
+    def initialize(self) -> None:
+        os.makedirs(self._root, exist_ok=True)
+
+    def write(self, job_id: str, name: str, data: bytes, db: Optional[sqlite3.Cursor] = None) -> None:
+        folder = self._job_folder(job_id)
+        os.makedirs(folder, exist_ok=True)
+        # Written to a temporary file (only readable by the app since it may be a private key) and then renamed
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(job_id, name))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def read(self, job_id: str, name: str) -> bytes:
+        with open(self._path(job_id, name), "rb") as f:
+            return f.read()
+
+    def delete_job(self, job_id: str) -> None:
+        shutil.rmtree(self._job_folder(job_id), ignore_errors=True)
+
+    @staticmethod
+    def _names_in(folder_path: str, job_id: str) -> Set[str]:
+        try:
+            with os.scandir(folder_path) as entries:
+                file_names = {entry.name for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        return {name for name in ARTIFACT_NAMES if "{}.{}".format(job_id, name) in file_names}
+
+    def list_names(self, job_id: str) -> Set[str]:
+        return self._names_in(self._job_folder(job_id), job_id)
+
+    def list_jobs(self) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+        for entry in self._iter_job_folders():
+            yield entry.name, self._names_in(entry.path, entry.name), entry.stat().st_mtime
+
+
+class FlatStorage(_FolderStorage):
+    """ A folder per job in the root folder: <root>/<job_id>/<job_id>.<name>. This is the original layout, a single
+        folder holding every job gets slow to look up and list with hundreds of thousands of jobs. """
+
+    def _job_folder(self, job_id: str) -> str:
+        return os.path.join(self._root, job_id)
+
+    def _iter_job_folders(self) -> Iterator[os.DirEntry]:
+        with os.scandir(self._root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield entry
+
+
+class ShardedStorage(_FolderStorage):
+    """ The folders of the jobs are spread over two levels of sub-folders named after the hash of their id:
+        <root>/ab/cd/<job_id>/<job_id>.<name>. With 65536 shards, each folder stays small even with millions of
+        jobs. """
+
+    @staticmethod
+    def _shard(job_id: str) -> Tuple[str, str]:
+        digest = hashlib.sha256(job_id.encode()).hexdigest()
+        return digest[:2], digest[2:4]
+
+    def _job_folder(self, job_id: str) -> str:
+        return os.path.join(self._root, *self._shard(job_id), job_id)
+
+    def _iter_job_folders(self) -> Iterator[os.DirEntry]:
+        for first in sorted(os.listdir(self._root)):
+            first_path = os.path.join(self._root, first)
+            if len(first) != 2 or not os.path.isdir(first_path):
+                continue
+            for second in sorted(os.listdir(first_path)):
+                second_path = os.path.join(first_path, second)
+                if not os.path.isdir(second_path):
+                    continue
+                with os.scandir(second_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            yield entry
+
+
+class SqliteStorage(Storage):
+    """ Stores the artifacts as BLOBs in the database, next to the row of their job. Creating a job and its config is
+        a single transaction, and the artifacts are backed up with the database. """
+
+    def initialize(self) -> None:
+        with database.connection() as conn:
+            db = conn.cursor()
+            db.execute("CREATE TABLE IF NOT EXISTS artifacts (job_id TEXT NOT NULL,"
+                       "name TEXT NOT NULL,"
+                       "data BLOB NOT NULL,"
+                       "PRIMARY KEY (job_id, name))")
+            conn.commit()
+
+    def write(self, job_id: str, name: str, data: bytes, db: Optional[sqlite3.Cursor] = None) -> None:
+        query = ("INSERT INTO artifacts (job_id, name, data) VALUES (?, ?, ?) "
+                 "ON CONFLICT (job_id, name) DO UPDATE SET data = excluded.data")
+        if db is not None:
+            db.execute(query, (job_id, name, data))
+            return
+        with database.connection() as conn:
+            conn.execute(query, (job_id, name, data))
+            conn.commit()
+
+    def read(self, job_id: str, name: str) -> bytes:
+        with database.connection() as conn:
+            row = conn.execute("SELECT data FROM artifacts WHERE job_id=? AND name=?", (job_id, name)).fetchone()
+        if row is None:
+            raise FileNotFoundError("The {} of job {} could not be found.".format(name, job_id))
+        return bytes(row[0])
+
+    def delete_job(self, job_id: str) -> None:
+        with database.connection() as conn:
+            conn.execute("DELETE FROM artifacts WHERE job_id=?", (job_id,))
+            conn.commit()
+
+    def list_names(self, job_id: str) -> Set[str]:
+        with database.connection() as conn:
+            return {row[0] for row in conn.execute("SELECT name FROM artifacts WHERE job_id=?", (job_id,))}
+
+    def list_jobs(self) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+        with database.connection() as conn:
+            rows = conn.execute("SELECT job_id, name FROM artifacts ORDER BY job_id").fetchall()
+        yield from _group_by_job((job_id, name) for job_id, name in rows)
+
+
+def _group_by_job(names: Iterator[Tuple[str, str]]) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+    """ Groups (job id, artifact name) pairs sorted by job id """
+    current_id, current_names = None, set()
+    for job_id, name in names:
+        if job_id != current_id:
+            if current_id is not None:
+                yield current_id, current_names, None
+            current_id, current_names = job_id, set()
+        current_names.add(name)
+    if current_id is not None:
+        yield current_id, current_names, None
+
+
+class LocalObjectClient:
+    """ Stand-in for an object store, keeping each object in a file under a local folder. Used for development and
+        tests, or with a folder shared between nodes. """
+
+    def __init__(self, root: str):
+        self._root = root
+
+    def put(self, key: str, data: bytes) -> None:
+        path = os.path.join(self._root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self._root, key), "rb") as f:
+            return f.read()
+
+    def delete(self, keys: List[str]) -> None:
+        for key in keys:
+            path = os.path.join(self._root, key)
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))  # Like in an object store, nothing is left once the objects are gone
+            except OSError:
+                pass
+
+    def list(self, prefix: str) -> Iterator[str]:
+        """ Yields the keys starting with the prefix, sorted """
+        start = os.path.join(self._root, prefix.rpartition("/")[0])
+        for folder, folders, files in os.walk(start):
+            folders.sort()
+            relative = os.path.relpath(folder, self._root)
+            for file_name in sorted(files):
+                key = file_name if relative == "." else "{}/{}".format(relative.replace(os.sep, "/"), file_name)
+                if key.startswith(prefix) and not file_name.endswith(".tmp"):
+                    yield key
+
+
+class S3ObjectClient:
+    """ Objects stored in an S3 (or S3 compatible) bucket, under a prefix. Requires boto3. """
+
+    def __init__(self, bucket: str, prefix: str):
+        if boto3 is None:
+            raise RuntimeError("boto3 must be installed to use an s3:// object store.")
+        self._client = boto3.client("s3")
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def put(self, key: str, data: bytes) -> None:
+        self._client.put_object(Bucket=self._bucket, Key=self._prefix + key, Body=data)
+
+    def get(self, key: str) -> bytes:
+        try:
+            return self._client.get_object(Bucket=self._bucket, Key=self._prefix + key)["Body"].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ["NoSuchKey", "404"]:
+                raise FileNotFoundError("Object {} not found.".format(key))
+            raise
+
+    def delete(self, keys: List[str]) -> None:
+        # At most 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            self._client.delete_objects(Bucket=self._bucket, Delete={
+                "Objects": [{"Key": self._prefix + key} for key in keys[i:i + 1000]], "Quiet": True})
+
+    def list(self, prefix: str) -> Iterator[str]:
+        """ Yields the keys starting with the prefix, sorted """
+        paginator = self._client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=self._prefix + prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self._prefix):]
+
+
+class ObjectStorage(Storage):
+    """ Stores the artifacts in an object store, as <job_id>/<job_id>.<name> objects, so that several nodes can share
+        the jobs. """
+
+    def __init__(self, client):
+        self._client = client
+
+    @staticmethod
+    def _key(job_id: str, name: str) -> str:
+        return "{}/{}.{}".format(job_id, job_id, name)
+
+    def write(self, job_id: str, name: str, data: bytes, db: Optional[sqlite3.Cursor] = None) -> None:
+        self._client.put(self._key(job_id, name), data)
+
+    def read(self, job_id: str, name: str) -> bytes:
+        return self._client.get(self._key(job_id, name))
+
+    def delete_job(self, job_id: str) -> None:
+        keys = list(self._client.list(job_id + "/"))
+        if keys:
+            self._client.delete(keys)
+
+    def list_names(self, job_id: str) -> Set[str]:
+        keys = set(self._client.list(job_id + "/"))
+        return {name for name in ARTIFACT_NAMES if self._key(job_id, name) in keys}
+
+    def list_jobs(self) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+        def names() -> Iterator[Tuple[str, str]]:
+            for key in self._client.list(""):
+                job_id, _, file_name = key.partition("/")
+                if file_name.startswith(job_id + ".") and file_name[len(job_id) + 1:] in ARTIFACT_NAMES:
+                    yield job_id, file_name[len(job_id) + 1:]
+
+        yield from _group_by_job(names())
+
+
+class _ProfiledStorage(Storage):
+    """ Counts the time spent in the operations of another backend in the "fs" span of the requests, used when
+        PROFILING is enabled. The time spent in the database by the sqlite backend is counted in the "db" span. """
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+
+    def initialize(self) -> None:
+        self._storage.initialize()
+
+    def write(self, job_id: str, name: str, data: bytes, db: Optional[sqlite3.Cursor] = None) -> None:
+        with profiling.span("fs"):
+            self._storage.write(job_id, name, data, db)
+
+    def read(self, job_id: str, name: str) -> bytes:
+        with profiling.span("fs"):
+            return self._storage.read(job_id, name)
+
+    def delete_job(self, job_id: str) -> None:
+        with profiling.span("fs"):
+            self._storage.delete_job(job_id)
+
+    def list_names(self, job_id: str) -> Set[str]:
+        with profiling.span("fs"):
+            return self._storage.list_names(job_id)
+
+    def get_path(self, job_id: str, name: str) -> Optional[str]:
+        return self._storage.get_path(job_id, name)
+
+    def list_jobs(self) -> Iterator[Tuple[str, Set[str], Optional[float]]]:
+        return self._storage.list_jobs()
+
+
+def create_storage(backend: str, path: Optional[str] = None, url: Optional[str] = None) -> Storage:
+    """
+    Creates a storage backend.
+
+    :param backend: One of BACKENDS
+    :param path: The root folder of the folder backends, JOBS_FOLDER_PATH if not specified
+    :param url: The object store of the object backend (s3://bucket/prefix or file:///path), OBJECT_STORE_URL if not
+    specified
+    :raises ValueError: Raised if the backend or the object store is unknown
+    """
+    if backend == "flat":
+        return FlatStorage(path or app.JOBS_FOLDER_PATH)
+    if backend == "sharded":
+        return ShardedStorage(path or app.JOBS_FOLDER_PATH)
+    if backend == "sqlite":
+        return SqliteStorage()
+    if backend == "object":
+        parsed = urlparse(url or app.OBJECT_STORE_URL)
+        if parsed.scheme == "file":
+            return ObjectStorage(LocalObjectClient(parsed.path))
+        if parsed.scheme == "s3":
+            prefix = parsed.path.lstrip("/")
+            return ObjectStorage(S3ObjectClient(parsed.netloc, prefix + "/" if prefix else ""))
+        raise ValueError("Unknown object store: {}".format(url or app.OBJECT_STORE_URL))
+    raise ValueError("Unknown storage backend: {}".format(backend))
+
+
+# Created on first use by #get_storage
+_storage: Optional[Storage] = None
+
+
+def get_storage() -> Storage:
+    """ Returns the storage backend selected by STORAGE_BACKEND """
+    global _storage
+    if _storage is None:
+        _storage = create_storage(app.STORAGE_BACKEND)
+        if app.PROFILING:
+            _storage = _ProfiledStorage(_storage)
+    return _storage